@@ -0,0 +1,290 @@
+''' Compact the one record song files into a few compressed newline delimited JSON chunks before COPY.
+
+song_data is made of many small files with a single record each, so COPY spends most of its time opening files
+rather than loading records. The song files are read from a local directory or an S3 prefix, every record of a file
+is written one record per line into chunks of close to equal bytes, and each chunk is compressed with gzip or zstd. The number of chunks is a
+multiple of the number of slices so every slice of the cluster loads the same amount of data. As each chunk needs at
+least one record, fewer chunks are written and reported when there are fewer song files with valid JSON. Chunks are
+written to a local directory, standing in for S3 when run without a cluster, or to an S3 prefix for etl.py to copy
+with [S3] SONG_DATA and SONG_COMPRESSION set in dwh.cfg. COPY loads every file of the prefix, so the chunks of an earlier
+run are removed first, leaving other files in place.
+
+Parameters
+----------
+source (str) : S3 url prefix or local directory of the song files such as 's3://udacity-dend/song_data'
+output (str) : S3 url prefix or local directory to write the chunks to such as 's3://my-bucket/song_data_compacted'
+--slices (int) : number of slices in the Redshift cluster
+--chunk-mb (int) : largest uncompressed size of a chunk in MB, more chunks are written for larger sources
+--compression (str) : gzip, or zstd which requires the zstandard package
+--threads (int) : number of song files read at the same time
+--metrics-dir (str) : directory to write the run report and Prometheus textfile
+
+Returns
+-------
+None
+
+See Also
+--------
+dwh.cfg
+
+Example
+-------
+compact_songs.py s3://udacity-dend/song_data s3://my-bucket/song_data_compacted --slices 4
+
+'''
+
+import os
+import re
+import gzip
+import json
+import math
+import argparse
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from s3_manifest import parse_s3_url, list_objects, filter_objects, balance, group_bytes
+
+# COPY option and file extension of each compression
+COMPRESSIONS = {'gzip': ('GZIP', '.json.gz'), 'zstd': ('ZSTD', '.json.zst')}
+
+# file name of a chunk written by compact
+CHUNK = re.compile(r'song_data_\d{4}\.json\.(gz|zst)')
+
+WHITESPACE = re.compile(r'\s*')
+
+
+def local_objects(directory):
+    '''List the JSON files of a local directory like list_objects lists an S3 prefix.
+
+    Parameters
+    ----------
+    directory (str) : directory searched recursively
+
+    Returns
+    -------
+    objects (list) : dict of key, the file path, and size in bytes for each file, in path order
+    '''
+
+    objects = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith('.json'):
+                path = os.path.join(root, name)
+                objects.append({'key': path, 'size': os.path.getsize(path)})
+
+    return sorted(objects, key=lambda obj: obj['key'])
+
+
+def chunk_count(total_bytes, slices, chunk_mb):
+    '''Number of chunks, the smallest multiple of slices keeping chunks under chunk_mb.
+
+    Parameters
+    ----------
+    total_bytes (int) : bytes of all the song files
+    slices (int) : number of slices in the cluster
+    chunk_mb (int) : largest uncompressed size of a chunk in MB
+
+    Returns
+    -------
+    chunks (int) : number of chunks
+    '''
+
+    return max(1, math.ceil(total_bytes / (chunk_mb * 2**20 * slices))) * slices
+
+
+def json_records(data):
+    '''Parse every JSON record of a file, one record per line as COPY reads them, or pretty printed over several lines.
+
+    Parameters
+    ----------
+    data (bytes) : contents of the file in UTF-8
+
+    Returns
+    -------
+    records (list) : each record in file order, raising ValueError if the file is not a sequence of valid JSON values
+    '''
+
+    text = data.decode('utf-8')
+    decoder = json.JSONDecoder()
+    records = []
+    position = WHITESPACE.match(text).end()
+    while position < len(text):
+        record, position = decoder.raw_decode(text, position)
+        records.append(record)
+        position = WHITESPACE.match(text, position).end()
+
+    return records
+
+
+def clear_chunks(names, remove):
+    '''Remove the chunks of an earlier run, so COPY from the output prefix only loads the chunks written next.
+
+    Parameters
+    ----------
+    names (list) : names of the files directly in the output directory or S3 prefix
+    remove (function) : called with the name of each chunk to remove
+
+    Returns
+    -------
+    removed (list) : names of the chunks removed, other files are left in place
+    '''
+
+    removed = sorted(name for name in names if CHUNK.fullmatch(name))
+    for name in removed:
+        remove(name)
+
+    return removed
+
+
+def compress(data, compression):
+    '''Compress bytes with gzip or zstd.'''
+
+    if compression == 'zstd':
+        # optional dependency only needed for zstd chunks
+        import zstandard
+        return zstandard.ZstdCompressor().compress(data)
+
+    return gzip.compress(data)
+
+
+def compact(objects, read, write, slices=1, chunk_mb=64, compression='gzip', threads=8):
+    '''Write the records of the song files into compressed chunks of close to equal size.
+
+    Parameters
+    ----------
+    objects (list) : dict of key and size of each song file from list_objects or local_objects
+    read (function) : called with a key, returning the bytes of the file
+    write (function) : called with a chunk file name and its compressed bytes
+    slices (int) : number of slices in the cluster
+    chunk_mb (int) : largest uncompressed size of a chunk in MB
+    compression (str) : 'gzip' or 'zstd'
+    threads (int) : number of files read at the same time
+
+    Returns
+    -------
+    report (dict) : files_in, bytes_in, records, skipped keys of files that are not valid JSON, files_out, bytes_out
+        and slice_multiple, whether files_out is a multiple of slices. A file with an invalid record is skipped whole.
+    '''
+
+    extension = COMPRESSIONS[compression][1]
+    report = {'files_in': len(objects), 'bytes_in': group_bytes(objects), 'records': 0, 'skipped': [],
+        'files_out': 0, 'bytes_out': 0}
+
+    # balance leaves out empty groups, so there are fewer groups than chunks when there are fewer files
+    groups = balance(objects, chunk_count(report['bytes_in'], slices, chunk_mb))
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for group in groups:
+            with metrics.stage('compact', 'song_data') as record:
+                lines = []
+                for obj, data in zip(group, executor.map(read, [obj['key'] for obj in group])):
+                    record['bytes_read'] += len(data)
+                    try:
+                        # one record per line, as a file may hold pretty printed JSON
+                        lines += [json.dumps(song) for song in json_records(data)]
+                    except ValueError:
+                        report['skipped'].append(obj['key'])
+                        record['errors'] += 1
+                record['rows_in'] += len(group)
+                record['rows_out'] += len(lines)
+
+                # no chunk is written when every file of the group is skipped
+                if not lines:
+                    continue
+                body = compress(('\n'.join(lines) + '\n').encode('utf-8'), compression)
+                write(f"song_data_{report['files_out']:04d}{extension}", body)
+
+            report['records'] += len(lines)
+            report['files_out'] += 1
+            report['bytes_out'] += len(body)
+
+    report['slice_multiple'] = report['files_out'] % slices == 0
+
+    return report
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', type=str, help='S3 url prefix or local directory of the song files')
+    parser.add_argument('output', type=str, help='S3 url prefix or local directory to write the chunks to')
+    parser.add_argument('--slices', type=int, default=1, help='number of slices in the Redshift cluster')
+    parser.add_argument('--chunk-mb', type=int, default=64, help='largest uncompressed size of a chunk in MB')
+    parser.add_argument('--compression', choices=list(COMPRESSIONS), default='gzip', help='compression of the chunks')
+    parser.add_argument('--threads', type=int, default=8, help='song files read at the same time')
+    parser.add_argument('--metrics-dir', type=str, default=None, help='directory to write the run report and Prometheus textfile')
+    args = parser.parse_args()
+
+    run = metrics.start('redshift_compact_songs')
+
+    s3 = None
+    if args.source.startswith('s3://') or args.output.startswith('s3://'):
+        # optional dependency only needed for S3
+        import boto3
+
+        config = configparser.ConfigParser()
+        config.optionxform = str
+        config.read('dwh.cfg')
+
+        s3 = boto3.client(
+            's3',
+            aws_access_key_id=config['INFRASTRUCTURE']['KEY'],
+            aws_secret_access_key=config['INFRASTRUCTURE']['SECRET'],
+            region_name=config['INFRASTRUCTURE']['REGION']
+        )
+
+    with metrics.stage('discover', 'song_data') as record:
+        if args.source.startswith('s3://'):
+            bucket, prefix = parse_s3_url(args.source)
+            objects = filter_objects(list_objects(s3, bucket, prefix), prefix=prefix.rstrip('/') + '/', pattern='*.json')
+            def read(key):
+                return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        else:
+            objects = local_objects(args.source)
+            def read(key):
+                with open(key, 'rb') as fh:
+                    return fh.read()
+        record['rows_out'] += len(objects)
+
+    if args.output.startswith('s3://'):
+        output_bucket, output_prefix = parse_s3_url(args.output)
+        output_prefix = output_prefix.rstrip('/') + '/'
+        names = [obj['key'][len(output_prefix):] for obj in list_objects(s3, output_bucket, output_prefix)]
+        def remove(name):
+            s3.delete_object(Bucket=output_bucket, Key=output_prefix + name)
+        def write(name, body):
+            s3.put_object(Bucket=output_bucket, Key=output_prefix + name, Body=body)
+    else:
+        os.makedirs(args.output, exist_ok=True)
+        names = os.listdir(args.output)
+        def remove(name):
+            os.remove(os.path.join(args.output, name))
+        def write(name, body):
+            with open(os.path.join(args.output, name), 'wb') as fh:
+                fh.write(body)
+
+    try:
+        with metrics.stage('clear', 'song_data') as record:
+            removed = clear_chunks(names, remove)
+            record['rows_out'] += len(removed)
+        if removed:
+            print(f'Removed {len(removed)} chunks of an earlier run from {args.output}.')
+        report = compact(objects, read, write, args.slices, args.chunk_mb, args.compression, args.threads)
+    finally:
+        print(run.summary())
+        if args.metrics_dir:
+            run.write(args.metrics_dir)
+
+    saved = report['bytes_in'] - report['bytes_out']
+    print(f"Compacted {report['files_in']} files of {report['bytes_in']} bytes into {report['files_out']} files of "
+        f"{report['bytes_out']} bytes, saving {saved} bytes ({saved / max(report['bytes_in'], 1):.1%}).")
+    if report['skipped']:
+        print(f"Skipped {len(report['skipped'])} files that are not valid JSON: {report['skipped'][:10]}")
+    if not report['slice_multiple']:
+        print(f"Wrote {report['files_out']} chunks, not a multiple of {args.slices} slices, as there are too few song "
+            "files with valid JSON to give every slice a chunk.")
+    print(f"Set SONG_DATA = '{args.output}' and SONG_COMPRESSION = {COMPRESSIONS[args.compression][0]} in the [S3] "
+        "section of dwh.cfg to copy the chunks.")
+
+
+if __name__ == "__main__":
+    main()
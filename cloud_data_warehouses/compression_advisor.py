@@ -0,0 +1,251 @@
+''' Choose the compression encoding of each column from ANALYZE COMPRESSION after the first load.
+
+COPY runs with COMPUPDATE OFF so loading many small files stays fast, which leaves every column with its default
+encoding. Once the tables are loaded, ANALYZE COMPRESSION samples each table and estimates how much each column
+shrinks with its best encoding. The encodings are saved for create_tables.py --encodings, which adds ENCODE clauses
+to create_syntax(), and the projected savings are reported for each column: the MB of 1 MB blocks saved on disk and
+the MB not read by the dashboard queries scanning the column each time the dashboard is refreshed.
+
+ANALYZE COMPRESSION output and the blocks of each column are read from the cluster, or from a JSON file recorded
+with --record so the advisor can be run and changed without a cluster.
+
+Parameters
+----------
+--comprows (int) : rows sampled for each table, the Redshift default if not given
+--recorded (str) : JSON file of recorded output to read instead of analyzing the cluster
+--record (str) : JSON file to save the output read from the cluster
+--output (str) : JSON file to save the encodings of each column
+
+Returns
+-------
+None
+
+See Also
+--------
+create_tables.py --encodings
+
+Example
+-------
+compression_advisor.py --record compression.json
+compression_advisor.py --recorded compression.json --output column_encodings.json
+
+'''
+
+import re
+import json
+import argparse
+import configparser
+import psycopg2
+from sql_queries import create_syntax
+from explain_advisor import dashboard_queries
+
+# size of a Redshift disk block
+BLOCK_MB = 1
+
+column_blocks_query = """
+    SELECT
+        TRIM(perm.name) AS table_name,
+        TRIM(attribute.attname) AS column_name,
+        COUNT(*) AS blocks
+    FROM stv_blocklist AS blocks
+    JOIN (SELECT DISTINCT id, name FROM stv_tbl_perm) AS perm
+        ON perm.id = blocks.tbl
+    JOIN pg_attribute AS attribute
+        ON attribute.attrelid = blocks.tbl
+        AND attribute.attnum = blocks.col + 1
+    WHERE TRIM(perm.name) = %s
+    GROUP BY 1, 2
+"""
+
+
+def cluster_compression(cur, comprows=None):
+    '''Source of compression estimates running ANALYZE COMPRESSION on the cluster.
+
+    ANALYZE COMPRESSION locks the table while sampling, so run it after a load rather than during one.
+
+    Parameters
+    ----------
+    cur (psycopg2.cursor) : cursor connected to Redshift with autocommit, as ANALYZE COMPRESSION can't run in a transaction
+    comprows (int) : rows sampled for each table
+
+    Returns
+    -------
+    analyze (function) : called with a table name, returning a list of dict of column, encoding, est_reduction_pct
+        and blocks for each column
+    '''
+
+    def analyze(table):
+        cur.execute(f'ANALYZE COMPRESSION {table}' + (f' COMPROWS {int(comprows)}' if comprows else ''))
+        columns = [
+            {'column': column, 'encoding': encoding, 'est_reduction_pct': float(reduction)}
+            for _, column, encoding, reduction in cur.fetchall()
+        ]
+        cur.execute(column_blocks_query, (table,))
+        blocks = {column: count for _, column, count in cur.fetchall()}
+        for column in columns:
+            column['blocks'] = blocks.get(column['column'], 0)
+
+        return columns
+
+    return analyze
+
+
+def recorded_compression(path):
+    '''Source of compression estimates reading output saved by --record, standing in for the cluster.
+
+    Parameters
+    ----------
+    path (str) : JSON file with keys = table name, values = list of dict of column, encoding, est_reduction_pct and blocks
+
+    Returns
+    -------
+    analyze (function) : called with a table name, returning the recorded columns of the table
+    '''
+
+    with open(path, encoding='utf-8') as fh:
+        recorded = json.load(fh)
+
+    def analyze(table):
+        if table not in recorded:
+            raise LookupError(f'No ANALYZE COMPRESSION output recorded for table {table} in file {path}.')
+        return recorded[table]
+
+    return analyze
+
+
+def dashboard_scans(queries):
+    '''Count the dashboard queries reading each column, matching table and column names in the query text.
+
+    Parameters
+    ----------
+    queries (dict) : keys = query name, values = query syntax from explain_advisor.dashboard_queries
+
+    Returns
+    -------
+    scans (function) : called with a table and column name, returning the number of queries reading the column
+    '''
+
+    words = [set(re.findall(r'\w+', query.lower())) for query in queries.values()]
+
+    def scans(table, column):
+        return sum(1 for found in words if table.lower() in found and column.lower() in found)
+
+    return scans
+
+
+def project_savings(table, columns, scans):
+    '''Projected storage and scan savings of each column with its recommended encoding.
+
+    Parameters
+    ----------
+    table (str) : table name
+    columns (list) : dict of column, encoding, est_reduction_pct and blocks from an analyze function
+    scans (function) : number of dashboard queries reading a column from dashboard_scans
+
+    Returns
+    -------
+    savings (list) : dict of table, column, encoding, est_reduction_pct, size_mb, saved_mb, dashboard_scans and
+        scan_saved_mb for each column, the MB not read by one refresh of the dashboard
+    '''
+
+    savings = []
+    for column in columns:
+        size = column['blocks'] * BLOCK_MB
+        saved = size * column['est_reduction_pct'] / 100
+        savings.append({
+            'table': table,
+            'column': column['column'],
+            'encoding': column['encoding'],
+            'est_reduction_pct': column['est_reduction_pct'],
+            'size_mb': size,
+            'saved_mb': round(saved, 2),
+            'dashboard_scans': scans(table, column['column']),
+            'scan_saved_mb': round(saved * scans(table, column['column']), 2),
+        })
+
+    return savings
+
+
+def advise(tables, analyze, scans):
+    '''Analyze each table and project the savings of encoding its columns.
+
+    Parameters
+    ----------
+    tables (list) : table names
+    analyze (function) : source of compression estimates from cluster_compression or recorded_compression
+    scans (function) : number of dashboard queries reading a column from dashboard_scans
+
+    Returns
+    -------
+    recorded (dict) : keys = table name, values = output of analyze, for --record
+    encodings (dict) : keys = table name, values = dict of column name and encoding, for create_syntax
+    savings (list) : projected savings of each column from project_savings
+    '''
+
+    recorded = {}
+    encodings = {}
+    savings = []
+    for table in tables:
+        # a table missing from recorded output or failing to analyze on the cluster is skipped
+        try:
+            recorded[table] = analyze(table)
+        except (psycopg2.Error, LookupError) as error:
+            print(f'Could not analyze compression of table {table}: {error}')
+            continue
+        encodings[table] = {column['column']: column['encoding'] for column in recorded[table]}
+        savings += project_savings(table, recorded[table], scans)
+
+    return recorded, encodings, savings
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--comprows', type=int, default=None, help='rows sampled for each table')
+    parser.add_argument('--recorded', type=str, default=None, help='JSON file of recorded output to read instead of the cluster')
+    parser.add_argument('--record', type=str, default=None, help='JSON file to save the output read from the cluster')
+    parser.add_argument('--output', type=str, default='column_encodings.json', help='JSON file to save the encodings')
+    args = parser.parse_args()
+
+    tables = list(create_syntax().keys())
+    scans = dashboard_scans(dashboard_queries())
+
+    if args.recorded:
+        recorded, encodings, savings = advise(tables, recorded_compression(args.recorded), scans)
+    else:
+        config = configparser.ConfigParser()
+        config.optionxform = str
+        config.read('dwh.cfg')
+        config = dict(config.items('CLUSTER'))
+
+        conn = psycopg2.connect(f"""
+            host={config['HOST']} dbname={config['DB_NAME']}
+            user={config['DB_USER']} password={config['DB_PASSWORD']}
+            port={config['DB_PORT']}"""
+        )
+        conn.autocommit = True
+        try:
+            recorded, encodings, savings = advise(tables, cluster_compression(conn.cursor(), args.comprows), scans)
+        finally:
+            conn.close()
+
+    print('{:<16}{:<18}{:<10}{:>12}{:>10}{:>10}{:>8}{:>14}'.format(
+        'table', 'column', 'encoding', 'reduction_%', 'size_mb', 'saved_mb', 'scans', 'scan_saved_mb'))
+    for column in sorted(savings, key=lambda column: -column['scan_saved_mb']):
+        print('{table:<16}{column:<18}{encoding:<10}{est_reduction_pct:>12.1f}{size_mb:>10}{saved_mb:>10}'
+            '{dashboard_scans:>8}{scan_saved_mb:>14}'.format(**column))
+    print(f"Projected {sum(column['saved_mb'] for column in savings):.2f} MB saved on disk and "
+        f"{sum(column['scan_saved_mb'] for column in savings):.2f} MB less read by each dashboard refresh.")
+
+    with open(args.output, 'w', encoding='utf-8') as fh:
+        json.dump(encodings, fh, indent=4)
+    print(f'Saved column encodings into file {args.output}, use create_tables.py --encodings {args.output} to apply them.')
+
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as fh:
+            json.dump(recorded, fh, indent=4)
+        print(f'Saved ANALYZE COMPRESSION output into file {args.record}.')
+
+
+if __name__ == "__main__":
+    main()
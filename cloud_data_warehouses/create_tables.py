@@ -1,6 +1,10 @@
+import json
+import argparse
 import configparser
 import psycopg2
-from sql_queries import create_syntax, drop_syntax
+import metrics
+from sql_queries import create_syntax, drop_syntax, LAYOUTS
+from local_postgres import connection
 
 
 def drop_tables(cur, conn):
@@ -8,36 +12,53 @@ def drop_tables(cur, conn):
     print('Dropping tables if they exist:\n{tables}.'.format(tables=list(drop.keys())))
     for table, query in drop.items():
         query = query.format(table=table)
-        cur.execute(query)
-        conn.commit()
+        with metrics.stage('drop', table):
+            cur.execute(query)
+            conn.commit()
 
-def create_tables(cur, conn):
-    create = create_syntax()
+def create_tables(cur, conn, layout='collocated', encodings=None):
+    create = create_syntax(layout, encodings)
     print('Creating tables:\n{tables}.'.format(tables=list(create.keys())))
     for table, query in create.items():
         query = query.format(table=table)
-        cur.execute(query)
-        conn.commit()
+        with metrics.stage('create', table):
+            cur.execute(query)
+            conn.commit()
 
 
-def main():
+def main(metrics_dir=None, layout='collocated', encodings=None):
+    run = metrics.start('redshift_create_tables')
+
+    # column encodings saved by compression_advisor.py
+    if encodings:
+        with open(encodings, encoding='utf-8') as fh:
+            encodings = json.load(fh)
+
     config = configparser.ConfigParser()
     config.optionxform = str
     config.read('dwh.cfg')
-    config = dict(config.items('CLUSTER'))
+    config, connect = connection(config)
 
-    conn = psycopg2.connect(f"""
-        host={config['HOST']} dbname={config['DB_NAME']} 
-        user={config['DB_USER']} password={config['DB_PASSWORD']} 
-        port={config['DB_PORT']}"""
-    )
+    conn = psycopg2.connect(**connect)
     cur = conn.cursor()
 
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    try:
+        drop_tables(cur, conn)
+        create_tables(cur, conn, layout, encodings)
+    finally:
+        conn.close()
 
-    conn.close()
+        print(run.summary())
+        if metrics_dir:
+            run.write(metrics_dir)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--metrics-dir', type=str, default=None, help='directory to write the run report and Prometheus textfile')
+    parser.add_argument('--layout', choices=list(LAYOUTS), default='collocated', help='distribution style and sort keys')
+    parser.add_argument('--encodings', type=str, default=None, help='JSON file of column encodings from compression_advisor.py')
+    args = parser.parse_args()
+
+    main(metrics_dir=args.metrics_dir, layout=args.layout, encodings=args.encodings)
\ No newline at end of file
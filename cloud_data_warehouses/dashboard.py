@@ -5,6 +5,7 @@ import psycopg2
 import pandas as pd
 import altair as alt
 from vega_datasets import data as vega_data
+from local_postgres import connection
 
 def dashboard_title():
     '''Create empty graph to use as the overall dashboard title.'''
@@ -157,8 +158,8 @@ def play_trend(conn):
         color=alt.value('black')
     )
 
-    # classify weekend as starting on saturday
-    weekend = source[source['weekday']==6].copy()
+    # classify weekend as starting on saturday (weekday counts from monday as 0)
+    weekend = source[source['weekday']==5].copy()
     weekend['Time of Week']='Weekend'
     weekend['stop'] = weekend['day']+2
     rect = alt.Chart(weekend).mark_rect().encode(
@@ -387,17 +388,13 @@ def main():
     config = configparser.ConfigParser()
     config.optionxform = str
     config.read('dwh.cfg')
-    config = dict(config.items('CLUSTER'))
+    config, connect = connection(config)
 
     # Postgres
     # conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
 
-    # Redshift
-    conn = psycopg2.connect(f"""
-        host={config['HOST']} dbname={config['DB_NAME']} 
-        user={config['DB_USER']} password={config['DB_PASSWORD']} 
-        port={config['DB_PORT']}"""
-    )
+    # Redshift, or a local Postgres through the Redshift dialect shim of a [POSTGRES] section of dwh.cfg
+    conn = psycopg2.connect(**connect)
 
     # perform external complicated user level query
     user_levels = level_query(conn)
@@ -1,149 +1,408 @@
+import argparse
 import configparser
-from collections import defaultdict
+from functools import partial
+from itertools import groupby
 import json
 import time
 import psycopg2
-from sql_queries import copy_syntax, insert_syntax
+from psycopg2.pool import ThreadedConnectionPool
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from sql_queries import copy_syntax, key_syntax, insert_syntax, merge_syntax, insert_dependencies
+from scheduler import run_dag
+from s3_manifest import manifest_urls
+from local_postgres import connection
 
+# files loaded into each staging table by the last run, with their rows, bytes and rejected rows
+LOAD_REPORT = 'load_report.json'
 
-def load_staging_tables(cur, conn):
+# files committed by COPY commands with their bytes read and rejected rows, one row per rejected row or file
+copy_file_report_query = """
+    WITH _commits AS (
+        SELECT query, TRIM(filename) AS filename, SUM(lines_scanned) AS lines_scanned
+        FROM stl_load_commits
+        WHERE query IN %(queries)s
+        GROUP BY query, TRIM(filename)
+    ),
+    _scans AS (
+        SELECT query, TRIM(name) AS filename, SUM(bytes) AS bytes, SUM(loadtime) AS loadtime
+        FROM stl_file_scan
+        WHERE query IN %(queries)s
+        GROUP BY query, TRIM(name)
+    ),
+    _errors AS (
+        SELECT query, TRIM(filename) AS filename, TRIM(colname) AS colname, err_code, TRIM(err_reason) AS err_reason, line_number
+        FROM stl_load_errors
+        WHERE query IN %(queries)s
+    )
+    SELECT
+        COALESCE(_commits.query, _errors.query),
+        COALESCE(_commits.filename, _errors.filename),
+        COALESCE(_commits.lines_scanned, 0),
+        COALESCE(_scans.bytes, 0),
+        COALESCE(_scans.loadtime, 0),
+        _errors.colname,
+        _errors.err_code,
+        _errors.err_reason,
+        _errors.line_number
+    FROM _commits
+    FULL JOIN _errors
+        ON _errors.query = _commits.query
+        AND _errors.filename = _commits.filename
+    LEFT JOIN _scans
+        ON _scans.query = COALESCE(_commits.query, _errors.query)
+        AND _scans.filename = COALESCE(_commits.filename, _errors.filename)
+"""
 
-    copy = copy_syntax()
-    for table_s3, query in copy.items():
 
-        table = table_s3[0]
-        bucket = table_s3[1]
-        print(f'Beginning copy from S3 bucket {bucket} into table {table}.')
+def load_staging_tables(cur, conn, manifests=None, pool=None, truncate=False):
+    '''Copy S3 files into each staging table, then save the rows, bytes and errors of each file loaded into
+    LOAD_REPORT. Prints the wall clock time of loading all tables and the time summed over tables, which are close
+    unless tables are loaded concurrently.
+
+    Parameters
+    ----------
+    cur (psycopg2.connect.cursor) : cursor for execute SQL statements
+    conn (psycopg2.connect) : connection to Redshift
+    manifests (dict) : keys = staging table name, values = list of S3 urls of COPY manifests from s3_manifest.py to copy
+        instead of every file in the S3 bucket of the table
+    pool (psycopg2.pool.ThreadedConnectionPool) : load each table concurrently on its own connection from the pool
+        instead of one table after another using cur
+    truncate (bool) : empty each staging table first so it only holds the files of this load
+
+    Returns
+    -------
+    seconds (dict) : keys = staging table name, values = seconds taken to load the table
+    '''
+
+    copy = copy_syntax(manifests)
+    tables = [(table, list(copies)) for table, copies in groupby(copy.items(), key=lambda item: item[0][0])]
+
+    time_start = time.time()
+    if pool is None:
+        loaded = {table: load_staging_table(cur, conn, copies, truncate) for table, copies in tables}
+    else:
+        # at most one thread per pooled connection as the pool raises an error when all connections are in use
+        with ThreadPoolExecutor(max_workers=max(1, min(len(tables), pool.maxconn))) as executor:
+            futures = {
+                table: executor.submit(load_staging_table_pooled, pool, copies, truncate) for table, copies in tables
+            }
+            loaded = {table: future.result() for table, future in futures.items()}
+    seconds = {table: table_seconds for table, (table_seconds, _) in loaded.items()}
+
+    print(f'Saving the files loaded into each staging table into file {LOAD_REPORT}.')
+    with open(LOAD_REPORT, 'w', encoding='utf-8') as fh:
+        json.dump({table: files for table, (_, files) in loaded.items()}, fh, ensure_ascii=False, indent=4)
+
+    print(f'Loaded {len(tables)} staging tables in {time.time()-time_start:.2f} seconds wall clock, '
+        f'{sum(seconds.values()):.2f} seconds summed over tables.')
+
+    return seconds
+
+
+def load_staging_table_pooled(pool, copies, truncate=False):
+    '''Copy S3 files into a staging table using a connection from a pool, see load_staging_table.
+
+    Parameters
+    ----------
+    pool (psycopg2.pool.ThreadedConnectionPool) : connections to Redshift
+    copies (list) : tuples of ((table_name, bucket_url), copy syntax) from copy_syntax for a single table
+    truncate (bool) : empty the staging table first
+
+    Returns
+    -------
+    seconds (float) : seconds taken to load the table
+    files (list) : rows, bytes and errors of each file loaded from copy_file_report
+    '''
+
+    conn = pool.getconn()
+    try:
+        return load_staging_table(conn.cursor(), conn, copies, truncate)
+    finally:
+        conn.rollback()
+        pool.putconn(conn)
+
 
-        load_start = stl_load_starttime(cur, bucket)
+def load_staging_table(cur, conn, copies, truncate=False):
+    '''Copy S3 files into a staging table, then collect the rows, bytes and errors of each file of the COPY commands.
+
+    Parameters
+    ----------
+    cur (psycopg2.connect.cursor) : cursor for execute SQL statements
+    conn (psycopg2.connect) : connection to Redshift
+    copies (list) : tuples of ((table_name, bucket_url), copy syntax) from copy_syntax for a single table
+    truncate (bool) : empty the staging table first
+
+    Returns
+    -------
+    seconds (float) : seconds taken to load the table
+    files (list) : rows, bytes and errors of each file loaded from copy_file_report
+    '''
+
+    table_start = time.time()
+    table = copies[0][0][0]
+
+    if truncate:
+        # COPY appends, so remove the files staged by a previous load
+        cur.execute(f'TRUNCATE {table}')
+        conn.commit()
+
+    queries = []
+    for (table, bucket), query in copies:
+        print(f'Beginning copy from S3 bucket {bucket} into table {table}.')
 
         query = query(table=table, bucket=bucket)
         time_start = time.time()
-        cur.execute(query)
-        conn.commit()
+        with metrics.stage('copy', table) as record:
+            cur.execute(query)
+            conn.commit()
+            copy_rows, copy_query = copy_stats(cur)
+            record['rows_out'] += copy_rows
+        queries.append(copy_query)
         print(f'Completed copy from S3 bucket {bucket} into table {table} in {time.time()-time_start:.2f} seconds.')
 
-        stl_load_errors(cur, bucket, table, load_start)
+    # lines scanned, bytes and rejected rows of the files are read from the system tables once all copies complete
+    with metrics.stage('report', table) as record:
+        files = copy_file_report(cur, queries)
+        conn.commit()
+        errors = sum(file['errors'] for file in files)
+        record['rows_in'] += sum(file['lines_scanned'] for file in files)
+        record['bytes_read'] += sum(file['bytes'] for file in files)
+        record['errors'] += errors
+    if errors:
+        print(f'{errors} rows of {sum(1 for file in files if file["errors"])} files were not loaded into table {table}.')
+    else:
+        print(f'No errors occured loading into table {table}.')
 
+    return time.time() - table_start, files
 
-def insert_tables(cur, conn):
-    insert = insert_syntax()
-    for table, query in insert.items():
-        query = query.format(table=table)
-        print(f'Inserting data into table {table}.')
-        cur.execute(query)
-        conn.commit()
 
-def stl_load_starttime(cur, bucket):
-    '''Determine timestamp of previous load error from a S3 bucket. Used to determine any new errors that occur.
-    
+def key_staging_tables(cur, conn):
+    '''Fill the staging tables keyed by song_key, distributed so song plays are joined to songs on the same node.
+
     Parameters
     ----------
     cur (psycopg2.connect.cursor) : cursor for execute SQL statements
-    bucket (str) : url path to S3 bucket such as 's3://udacity-dend/song-data/A'
+    conn (psycopg2.connect) : connection to Redshift
 
     Returns
     -------
-    previous_error_ts (str) : starttime of previous load errors in 'YYYY-MM-DD hh:mm:ss.fff' format
+    None
+    '''
+
+    for table, queries in key_syntax().items():
+        print(f'Adding song_key into table {table}.')
+        with metrics.stage('key', table) as record:
+            for query in queries:
+                cur.execute(query.format(table=table))
+            record['rows_out'] += cur.rowcount
+            conn.commit()
+
+def insert_tables(cur, conn, pool=None, incremental=False):
+    '''Insert from the staging tables into each analytic table once the tables it depends on are inserted. A failed
+    insert only stops the inserts depending on it, then an error is raised after the other inserts complete.
+
+    Parameters
+    ----------
+    cur (psycopg2.connect.cursor) : cursor for execute SQL statements
+    conn (psycopg2.connect) : connection to Redshift
+    pool (psycopg2.pool.ThreadedConnectionPool) : insert independent tables concurrently on connections from the pool
+        instead of one table after another using cur
+    incremental (bool) : merge only events after the high-water mark of each table using merge_syntax, instead of
+        inserting everything staged using insert_syntax
 
+    Returns
+    -------
+    results (dict) : keys = table name, values = dict of status, seconds and error from scheduler.run_dag
     '''
 
-    # use wildcard search in case nested folders are loaded
-    bucket = bucket[0:-1]+"%"+bucket[-1]
-
-    # find last load time for a bucket
-    query = f"""
-    SELECT 
-        MAX(starttime)
-    FROM
-        stl_load_errors 
-    WHERE filename LIKE {bucket}
-    """
-    cur.execute(query)
-    previous_error_ts = cur.fetchone()
-    previous_error_ts = previous_error_ts[0]
-    if previous_error_ts is not None:
-        previous_error_ts = str(previous_error_ts)
-
-    return previous_error_ts
-
-def stl_load_errors(cur, bucket, table, previous_error_ts):
-    ''' Determine S3 files that were not loaded into a staging table during a COPY
-    command due to the COPY MAXERROR parameter. If errors are encountered, they
-    are written to a file named 'stl_load_errors_{table}.json'.
+    if incremental:
+        insert = merge_syntax()
+    else:
+        insert = {table: [query] for table, query in insert_syntax().items()}
+    if pool is None:
+        steps = {table: partial(insert_table, cur, conn, table, queries) for table, queries in insert.items()}
+        workers = 1
+    else:
+        steps = {table: partial(insert_table_pooled, pool, table, queries) for table, queries in insert.items()}
+        workers = pool.maxconn
+
+    time_start = time.time()
+    results = run_dag(steps, insert_dependencies(incremental), workers)
+
+    for table, result in results.items():
+        error = f" ({result['error']})" if result['error'] else ''
+        print(f"Insert into table {table} {result['status']} in {result['seconds']:.2f} seconds{error}.")
+    print(f'Inserted {len(results)} tables in {time.time()-time_start:.2f} seconds wall clock, '
+        f"{sum(result['seconds'] for result in results.values()):.2f} seconds summed over tables.")
+
+    stopped = [table for table, result in results.items() if result['status'] != 'done']
+    if stopped:
+        raise RuntimeError(f'Tables {stopped} were not inserted.')
+
+    return results
+
+
+def insert_table_pooled(pool, table, queries):
+    '''Insert into an analytic table using a connection from a pool, see insert_table.'''
+
+    conn = pool.getconn()
+    try:
+        insert_table(conn.cursor(), conn, table, queries)
+    finally:
+        pool.putconn(conn)
+
+
+def insert_table(cur, conn, table, queries):
+    '''Insert into an analytic table from the staging tables in one transaction, rolling back if the insert fails.
 
     Parameters
     ----------
-    cur (psycopg2.connect.cursor) : cursor for executing SQL statements
-    bucket (str) : url path to S3 bucket such as 's3://udacity-dend/song-data/A'
-    table (str) : name of Redshift database table
-    previous_error_ts (str) : starttime of previous load errors in 'YYYY-MM-DD hh:mm:ss.fff' format
+    cur (psycopg2.connect.cursor) : cursor for execute SQL statements
+    conn (psycopg2.connect) : connection to Redshift
+    table (str) : name of the analytic table
+    queries (list) : syntax from insert_syntax or merge_syntax run in order
 
     Returns
     -------
     None
+    '''
 
-    The file named 'stl_load_errors_{table}.json' contains error reasons and source S3 file names for
-    each column that resulted in an error in the following format.
+    print(f'Inserting data into table {table}.')
+    try:
+        with metrics.stage('insert', table) as record:
+            for query in queries:
+                query = query.format(table=table)
+                cur.execute(query)
+                if query.split()[:3] == ['INSERT', 'INTO', table]:
+                    record['rows_out'] += cur.rowcount
+            conn.commit()
+    except Exception:
+        # leave the connection usable for inserts that do not depend on this table
+        conn.rollback()
+        raise
 
-    {
-        columnA: {'err_reason': ['SomeErrorReason'], 'filename': ['s3://Bucket1']},
-        columnB: {'err_reason': ['SomeErrorReason'], 'filename': ['s3://Bucket2']}
-    }
+def copy_stats(cur):
+    '''Determine the rows loaded and the query id of the last COPY command of the session.
 
+    Parameters
+    ----------
+    cur (psycopg2.connect.cursor) : cursor for execute SQL statements
+
+    Returns
+    -------
+    rows (int) : number of rows loaded
+    query (int) : query id of the COPY, used to find its files in the system tables
     '''
 
-    # use wildcard search in case nested folders are loaded
-    bucket = bucket[0:-1]+"%"+bucket[-1]
+    cur.execute("SELECT pg_last_copy_count(), pg_last_copy_id()")
+    rows, query = cur.fetchone()
 
-    # get new errors since last load
-    if previous_error_ts is None:
-        starttime = ""
-    else:
-        starttime = f"AND starttime > '{previous_error_ts}'"
-    cur.execute(f"""
-        SELECT filename, colname, err_reason
-        FROM stl_load_errors
-        WHERE filename LIKE {bucket}
-        {starttime}
-    """)
-    error = cur.fetchall()
-
-    # list error reasons and source file names for columns causing errors
-    load_errors = defaultdict(list)
-    for err in error:
-        filename = err[0].strip()
-        colname = err[1].strip()
-        err_reason = err[2].strip()
-        load_errors[colname].append({'err_reason': err_reason, 'filename': filename})
-    load_errors = dict(load_errors)
-
-    if load_errors:
-        error_file = f'stl_load_errors_{table}.json'
-        print(f'Saving table {table} load errors into file {error_file}.')
-        with open(error_file, 'w', encoding='utf-8') as fh:
-            json.dump(load_errors, fh, ensure_ascii=False, indent=4)
-    else:
-        print(f'No errors occured loading into table {table}.')
+    return rows, query
+
+def copy_file_report(cur, queries):
+    '''Collect the lines, bytes and rejected rows of each file loaded by COPY commands in one query.
+
+    Parameters
+    ----------
+    cur (psycopg2.connect.cursor) : cursor for execute SQL statements
+    queries (list) : query ids of the COPY commands from copy_stats
+
+    Returns
+    -------
+    files (list) : dict for each file of the following, in file name order
+
+        filename (str) : S3 url of the file
+        query (int) : query id of the COPY
+        lines_scanned (int) : lines read from the file
+        rows_loaded (int) : lines_scanned less the rejected rows, the rows loaded for files of one row per line
+        bytes (int) : bytes read from the file, 0 if not visible to the user
+        load_seconds (float) : seconds taken reading the file summed over slices
+        errors (int) : number of rejected rows
+        rejected (list) : dict of colname, err_code, err_reason and line_number of each rejected row, as read by
+            reload_errors.py
+    '''
+
+    queries = tuple(query for query in queries if query is not None and query >= 0)
+    if not queries:
+        return []
+
+    cur.execute(copy_file_report_query, {'queries': queries})
+
+    files = {}
+    for query, filename, lines_scanned, bytes_read, loadtime, colname, err_code, err_reason, line_number in cur.fetchall():
+        # sums may be returned as NUMERIC
+        file = files.setdefault((query, filename), {
+            'filename': filename,
+            'query': query,
+            'lines_scanned': int(lines_scanned),
+            'rows_loaded': int(lines_scanned),
+            'bytes': int(bytes_read),
+            'load_seconds': float(loadtime) / 1e6,
+            'errors': 0,
+            'rejected': [],
+        })
+        if line_number is not None:
+            file['errors'] += 1
+            file['rows_loaded'] = max(file['lines_scanned'] - file['errors'], 0)
+            file['rejected'].append({'colname': colname, 'err_code': err_code, 'err_reason': err_reason, 'line_number': line_number})
+
+    return sorted(files.values(), key=lambda file: file['filename'])
+
+def main(metrics_dir=None, manifests=None, connections=0, incremental=False):
+    '''Copy S3 files into the staging tables then insert into the analytic tables, reporting the duration,
+    rows, bytes and errors of each COPY and INSERT.
+
+    Parameters
+    ----------
+    metrics_dir (str) : directory to write the run report redshift_etl.json and Prometheus textfile
+        redshift_etl.prom, only printed if not given
+    manifests (str) : path of the manifest index saved by s3_manifest.py, to copy only the files in the manifests
+    connections (int) : size of a connection pool to copy staging tables and insert independent tables concurrently,
+        0 loads one table at a time
+    incremental (bool) : stage only the files of this load and merge events after each table high-water mark, instead
+        of inserting everything staged into tables just created by create_tables.py
+
+    Returns
+    -------
+    None
+    '''
+
+    run = metrics.start('redshift_etl')
 
-def main():
     config = configparser.ConfigParser()
     config.optionxform = str
     config.read('dwh.cfg')
-    config = dict(config.items('CLUSTER'))
-
-    conn = psycopg2.connect(f"""
-        host={config['HOST']} dbname={config['DB_NAME']} 
-        user={config['DB_USER']} password={config['DB_PASSWORD']} 
-        port={config['DB_PORT']}"""
-    )
+    # the cluster, or a local Postgres through the Redshift dialect shim
+    _, connect = connection(config)
+    conn = psycopg2.connect(**connect)
     cur = conn.cursor()
+
+    # independent tables can be loaded at the same time on separate connections
+    pool = ThreadedConnectionPool(1, connections, **connect) if connections else None
     
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    try:
+        load_staging_tables(cur, conn, manifest_urls(manifests) if manifests else None, pool, truncate=incremental)
+        key_staging_tables(cur, conn)
+        insert_tables(cur, conn, pool, incremental)
+    finally:
+        conn.close()
+        if pool is not None:
+            pool.closeall()
 
-    conn.close()
+        # report the stages that ran even if the run failed
+        print(run.summary())
+        if metrics_dir:
+            run.write(metrics_dir)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--metrics-dir', type=str, default=None, help='directory to write the run report and Prometheus textfile')
+    parser.add_argument('--manifests', type=str, default=None, help='manifest index saved by s3_manifest.py to copy from')
+    parser.add_argument('--connections', type=int, default=0, help='connections to load independent tables concurrently')
+    parser.add_argument('--incremental', action='store_true', help='merge only new events into existing tables')
+    args = parser.parse_args()
+
+    main(metrics_dir=args.metrics_dir, manifests=args.manifests, connections=args.connections, incremental=args.incremental)
\ No newline at end of file
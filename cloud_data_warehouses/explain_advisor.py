@@ -0,0 +1,248 @@
+''' Flag the joins of the dashboard and insert queries that move data between Redshift nodes.
+
+Runs EXPLAIN on every query of dashboard.py, user_levels.pgsql and insert_syntax(), then reports each join step
+whose plan redistributes both tables (DS_DIST_BOTH) or broadcasts the inner table to every node (DS_BCAST_INNER),
+with the join condition, the tables it reads and how to change the distribution so the join is collocated.
+
+Plans are read from the cluster, or from a JSON file of plans recorded with --record so the advisor can be run and
+changed without a cluster.
+
+Parameters
+----------
+--plans (str) : JSON file of recorded plans to read instead of running EXPLAIN on the cluster
+--record (str) : JSON file to save the plans read from the cluster
+
+Returns
+-------
+None
+
+See Also
+--------
+sql_queries.LAYOUTS
+
+Example
+-------
+explain_advisor.py --record explain_plans.json
+explain_advisor.py --plans explain_plans.json
+
+'''
+
+import ast
+import re
+import json
+import argparse
+import configparser
+import psycopg2
+from sql_queries import insert_syntax
+
+# distribution steps of a join that move data between nodes, with how to avoid them
+FLAGGED = {
+    'DS_BCAST_INNER': 'inner table is broadcast to every node, use DISTSTYLE ALL for it or a DISTKEY on the join column of both tables',
+    'DS_DIST_BOTH': 'both tables are redistributed, use a DISTKEY on the join column of both tables',
+}
+
+STEP = re.compile(r'XN (?P<operation>[\w ]+?) (?P<attribute>DS_\w+)\s+\(cost=[\d.]+\.\.(?P<cost>[\d.]+) rows=(?P<rows>\d+)')
+CONDITION = re.compile(r'^(Hash Cond|Merge Cond|Join Filter): (?P<condition>.+)$')
+SCAN = re.compile(r'Scan on "?(?P<table>\w+)"?')
+
+
+def dashboard_queries(dashboard='dashboard.py', levels='user_levels.pgsql'):
+    '''Read the queries of the dashboard without importing dashboard.py and its charting requirements.
+
+    Parameters
+    ----------
+    dashboard (str) : path of dashboard.py, where each chart function assigns its SQL to a variable named query
+    levels (str) : path of the user level query read by dashboard.py
+
+    Returns
+    -------
+    queries (dict) : keys = query name such as 'dashboard.play_hour', values = query syntax
+    '''
+
+    with open(dashboard, encoding='utf-8') as fh:
+        tree = ast.parse(fh.read())
+
+    queries = {}
+    for function in tree.body:
+        if not isinstance(function, ast.FunctionDef):
+            continue
+        for node in ast.walk(function):
+            if (
+                isinstance(node, ast.Assign) and isinstance(node.value, ast.Constant)
+                and any(isinstance(target, ast.Name) and target.id == 'query' for target in node.targets)
+            ):
+                queries[f'dashboard.{function.name}'] = node.value.value
+
+    with open(levels, encoding='utf-8') as fh:
+        queries[levels] = fh.read()
+
+    return queries
+
+
+def insert_queries():
+    '''Insert syntax of each fact and dimension table.
+
+    Returns
+    -------
+    queries (dict) : keys = query name such as 'insert.songplay', values = query syntax
+    '''
+
+    return {f'insert.{table}': query.format(table=table) for table, query in insert_syntax().items()}
+
+
+def cluster_plans(cur):
+    '''Plan source running EXPLAIN on the cluster.
+
+    Parameters
+    ----------
+    cur (psycopg2.cursor) : cursor connected to Redshift
+
+    Returns
+    -------
+    explain (function) : called with a query name and syntax, returning the lines of the query plan
+    '''
+
+    def explain(name, query):
+        cur.execute('EXPLAIN ' + query)
+        return [row[0] for row in cur.fetchall()]
+
+    return explain
+
+
+def recorded_plans(path):
+    '''Plan source reading plans saved by --record, standing in for the cluster.
+
+    Parameters
+    ----------
+    path (str) : JSON file with keys = query name, values = list of plan lines
+
+    Returns
+    -------
+    explain (function) : called with a query name and syntax, returning the lines of the query plan
+    '''
+
+    with open(path, encoding='utf-8') as fh:
+        plans = json.load(fh)
+
+    def explain(name, query):
+        if name not in plans:
+            raise LookupError(f'No plan recorded for query {name} in file {path}.')
+        return plans[name]
+
+    return explain
+
+
+def flagged_steps(plan):
+    '''Find the join steps of a plan that move data between nodes.
+
+    Parameters
+    ----------
+    plan (list) : lines of an EXPLAIN plan
+
+    Returns
+    -------
+    steps (list) : dict of operation, attribute, cost, rows, condition, tables read below the step and advice
+    '''
+
+    steps = []
+    for number, line in enumerate(plan):
+        match = STEP.search(line)
+        if not match or match['attribute'] not in FLAGGED:
+            continue
+
+        # lines indented below the step belong to it
+        indent = len(line) - len(line.lstrip(' ->'))
+        below = []
+        for child in plan[number + 1:]:
+            if len(child) - len(child.lstrip(' ->')) <= indent:
+                break
+            below.append(child.strip(' ->'))
+
+        conditions = [CONDITION.match(child) for child in below]
+        steps.append({
+            'operation': match['operation'],
+            'attribute': match['attribute'],
+            'cost': float(match['cost']),
+            'rows': int(match['rows']),
+            'condition': next((condition['condition'] for condition in conditions if condition), None),
+            'tables': [scan['table'] for scan in map(SCAN.search, below) if scan],
+            'advice': FLAGGED[match['attribute']],
+        })
+
+    return steps
+
+
+def advise(queries, explain):
+    '''Explain each query and find its flagged join steps. Queries the cluster cannot explain or without a recorded plan
+    are skipped, other errors are raised.
+
+    Parameters
+    ----------
+    queries (dict) : keys = query name, values = query syntax
+    explain (function) : plan source from cluster_plans or recorded_plans
+
+    Returns
+    -------
+    plans (dict) : keys = query name, values = list of plan lines, None if the query could not be explained
+    report (dict) : keys = query name, values = list of flagged steps from flagged_steps
+    '''
+
+    plans = {}
+    report = {}
+    for name, query in queries.items():
+        try:
+            plans[name] = explain(name, query)
+        except (psycopg2.Error, LookupError) as error:
+            print(f'Could not explain query {name}: {error}')
+            plans[name] = None
+            continue
+        report[name] = flagged_steps(plans[name])
+
+    return plans, report
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--plans', type=str, default=None, help='JSON file of recorded plans to read instead of the cluster')
+    parser.add_argument('--record', type=str, default=None, help='JSON file to save the plans read from the cluster')
+    args = parser.parse_args()
+
+    queries = {**dashboard_queries(), **insert_queries()}
+
+    if args.plans:
+        plans, report = advise(queries, recorded_plans(args.plans))
+    else:
+        config = configparser.ConfigParser()
+        config.optionxform = str
+        config.read('dwh.cfg')
+        config = dict(config.items('CLUSTER'))
+
+        conn = psycopg2.connect(f"""
+            host={config['HOST']} dbname={config['DB_NAME']}
+            user={config['DB_USER']} password={config['DB_PASSWORD']}
+            port={config['DB_PORT']}"""
+        )
+        # EXPLAIN does not run the query, autocommit lets the next query be explained after one fails
+        conn.autocommit = True
+        try:
+            plans, report = advise(queries, cluster_plans(conn.cursor()))
+        finally:
+            conn.close()
+
+    for name, steps in report.items():
+        print(f'Query {name} has {len(steps)} join steps moving data between nodes.')
+        for step in steps:
+            print(f"    {step['operation']} {step['attribute']} on {step['condition']} reading {', '.join(step['tables'])} "
+                f"with cost {step['cost']:.2f} for {step['rows']} rows: {step['advice']}.")
+    flagged = sum(1 for steps in report.values() if steps)
+    print(f'{flagged} of {len(report)} queries explained have join steps moving data between nodes.')
+
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as fh:
+            json.dump({name: plan for name, plan in plans.items() if plan is not None}, fh, indent=4)
+        print(f'Saved query plans into file {args.record}.')
+
+
+if __name__ == "__main__":
+    main()
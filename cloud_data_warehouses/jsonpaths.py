@@ -0,0 +1,122 @@
+''' Write the JSONPaths file of the staging_events columns read by the insert queries.
+
+log_json_path.json maps all 18 fields of the log files, while the insert, merge and key syntax read 13 of them.
+The JSONPaths file and the staging_events create syntax are both generated from staging_events_columns(), so COPY
+only parses and stores the fields that are used. The file is written to a local path or uploaded to S3, then
+[S3] STAGING_JSONPATH in dwh.cfg makes create_tables.py and etl.py use the pruned columns.
+
+Parameters
+----------
+output (str) : S3 url such as 's3://my-bucket/staging_events_jsonpath.json' or local path to write the file to
+--sample (str) : local log file to report the share of bytes of the fields that are no longer parsed
+
+Returns
+-------
+None
+
+See Also
+--------
+sql_queries.STAGING_EVENTS_COLUMNS
+
+Example
+-------
+jsonpaths.py s3://my-bucket/staging_events_jsonpath.json --sample aws_s3_sample_files/2018-11-01-events.json
+
+'''
+
+import json
+import argparse
+import configparser
+from sql_queries import STAGING_EVENTS_COLUMNS, staging_events_columns
+from s3_manifest import parse_s3_url
+
+
+def jsonpaths(columns):
+    '''Create a JSONPaths file mapping each log field to the staging column of the same name.
+
+    Parameters
+    ----------
+    columns (list) : staging_events column names in table order
+
+    Returns
+    -------
+    jsonpaths (dict) : JSONPaths in the format expected by COPY ... FORMAT AS JSON
+    '''
+
+    return {'jsonpaths': [f"$['{column}']" for column in columns]}
+
+
+def pruned_bytes(sample, columns):
+    '''Bytes of the records of a log file taken by fields not in columns.
+
+    Parameters
+    ----------
+    sample (str) : path of a log file of JSON records, which like the log files may span several lines
+    columns (list) : log fields that are kept
+
+    Returns
+    -------
+    total (int) : bytes of all field names and values
+    pruned (int) : bytes of the field names and values no longer parsed
+    '''
+
+    with open(sample, encoding='utf-8') as fh:
+        text = fh.read()
+
+    total = 0
+    pruned = 0
+    decoder = json.JSONDecoder()
+    position = 0
+    while text[position:].strip():
+        record, position = decoder.raw_decode(text, len(text) - len(text[position:].lstrip()))
+        for field, value in record.items():
+            size = len(json.dumps({field: value})) - 2
+            total += size
+            if field not in columns:
+                pruned += size
+
+    return total, pruned
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', type=str, help='S3 url or local path to write the JSONPaths file to')
+    parser.add_argument('--sample', type=str, default=None, help='local log file to measure the bytes no longer parsed')
+    args = parser.parse_args()
+
+    columns = list(staging_events_columns(prune=True))
+    dropped = [column for column in STAGING_EVENTS_COLUMNS if column not in columns]
+    body = json.dumps(jsonpaths(columns), indent=4)
+
+    if args.output.startswith('s3://'):
+        # optional dependency only needed to upload the file
+        import boto3
+
+        config = configparser.ConfigParser()
+        config.optionxform = str
+        config.read('dwh.cfg')
+
+        s3 = boto3.client(
+            's3',
+            aws_access_key_id=config['INFRASTRUCTURE']['KEY'],
+            aws_secret_access_key=config['INFRASTRUCTURE']['SECRET'],
+            region_name=config['INFRASTRUCTURE']['REGION']
+        )
+        bucket, key = parse_s3_url(args.output)
+        s3.put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+    else:
+        with open(args.output, 'w', encoding='utf-8') as fh:
+            fh.write(body)
+
+    print(f'Saved JSONPaths of {len(columns)} of {len(STAGING_EVENTS_COLUMNS)} log fields into {args.output}, '
+        f'leaving out {dropped}.')
+    if args.sample:
+        total, pruned = pruned_bytes(args.sample, columns)
+        print(f'Fields left out are {pruned} of {total} bytes ({pruned / total:.1%}) of the fields in {args.sample}.')
+    print(f"Set STAGING_JSONPATH = '{args.output}' in the [S3] section of dwh.cfg, then run create_tables.py to "
+        "create the pruned staging_events table.")
+
+
+if __name__ == "__main__":
+    main()
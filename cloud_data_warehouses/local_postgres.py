@@ -0,0 +1,732 @@
+''' Run the Redshift pipeline against a local Postgres through a dialect shim.
+
+create_tables.py, etl.py, test_etl.py and dashboard.py connect to the local Postgres of a [POSTGRES] section of
+dwh.cfg instead of the cluster, so query changes can be timed and checked on a laptop. Queries are rewritten for the
+Redshift-only syntax they use:
+
+- DISTSTYLE, DISTKEY and ENCODE are dropped, and SORTKEY columns become an index of the table
+- IDENTITY(seed, step) becomes a Postgres identity column
+- PRIMARY KEY and FOREIGN KEY constraints are dropped, as Redshift does not enforce them
+- EXTRACT(WEEKDAY ...) becomes EXTRACT(DOW ...)
+- COPY ... FORMAT AS JSON reads the JSON files, JSONPaths files and manifests from a local directory mirroring the S3
+  buckets, S3_ROOT/bucket/key, honouring MAXERROR, TRUNCATECOLUMNS, ACCEPTINVCHARS, MANIFEST, GZIP and ZSTD
+
+The redshift schema, searched after public, holds stand-ins of SVV_COLUMNS, SVV_TABLE_INFO, STV_TBL_PERM, the
+stl_load_errors, stl_load_commits and stl_file_scan system tables written by COPY, and of the functions LEN, GETDATE,
+DATEDIFF, ROUND(DOUBLE PRECISION, INT), FNV_HASH, pg_last_copy_id and pg_last_copy_count. FNV_HASH is a 64-bit hash of
+md5, so song_key values differ from the cluster but match the same songs. Postgres 16 or later is needed for the subqueries
+without an alias of the insert syntax.
+
+Run this script to copy files such as aws_s3_sample_files into the S3 layout of the [S3] section of dwh.cfg under
+S3_ROOT. Generated data, or the chunks of compact_songs.py, can be placed under S3_ROOT the same way.
+
+Parameters
+----------
+--sample (str) : directory of log files such as 2018-11-01-events.json, song files and log_json_path.json to copy
+    into S3_ROOT
+
+Returns
+-------
+None
+
+See Also
+--------
+dwh.cfg
+
+Example
+-------
+local_postgres.py --sample aws_s3_sample_files
+
+'''
+
+import io
+import os
+import re
+import bz2
+import gzip
+import json
+import time
+import shutil
+import argparse
+import configparser
+import psycopg2
+import psycopg2.extensions
+
+# schema of the Redshift stand-ins, searched after the tables of the pipeline in public
+SCHEMA = 'redshift'
+
+# stand-ins of the Redshift system tables, views and functions used by the pipeline
+setup_syntax = """
+    CREATE SCHEMA IF NOT EXISTS redshift;
+    CREATE SEQUENCE IF NOT EXISTS redshift.copy_query_id;
+
+    CREATE TABLE IF NOT EXISTS redshift.stl_load_commits (
+        query INTEGER,
+        slice INTEGER,
+        filename TEXT,
+        lines_scanned INTEGER,
+        errors INTEGER,
+        curtime TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS redshift.stl_file_scan (
+        query INTEGER,
+        slice INTEGER,
+        name TEXT,
+        lines BIGINT,
+        bytes BIGINT,
+        loadtime BIGINT,
+        curtime TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS redshift.stl_load_errors (
+        query INTEGER,
+        slice INTEGER,
+        tbl INTEGER,
+        starttime TIMESTAMP,
+        filename TEXT,
+        line_number BIGINT,
+        colname TEXT,
+        type TEXT,
+        col_length TEXT,
+        raw_line TEXT,
+        raw_field_value TEXT,
+        err_code INTEGER,
+        err_reason TEXT
+    );
+
+    CREATE OR REPLACE VIEW redshift.stv_tbl_perm AS
+    SELECT oid::INTEGER AS id, relname::TEXT AS name
+    FROM pg_class
+    WHERE relkind = 'r' AND relnamespace = current_schema()::REGNAMESPACE;
+
+    CREATE OR REPLACE VIEW redshift.svv_table_info AS
+    SELECT class.oid::INTEGER AS table_id, namespace.nspname::TEXT AS "schema", class.relname::TEXT AS "table"
+    FROM pg_class AS class
+    JOIN pg_namespace AS namespace ON namespace.oid = class.relnamespace
+    WHERE class.relkind = 'r';
+
+    CREATE OR REPLACE VIEW redshift.svv_columns AS
+    SELECT
+        columns.table_catalog::TEXT AS table_catalog,
+        columns.table_schema::TEXT AS table_schema,
+        columns.table_name::TEXT AS table_name,
+        columns.column_name::TEXT AS column_name,
+        columns.ordinal_position::INTEGER AS ordinal_position,
+        columns.data_type::TEXT AS data_type,
+        columns.character_maximum_length::INTEGER AS character_maximum_length,
+        col_description(attribute.attrelid, attribute.attnum) AS remarks
+    FROM information_schema.columns AS columns
+    JOIN pg_attribute AS attribute
+        ON attribute.attrelid = format('%I.%I', columns.table_schema, columns.table_name)::REGCLASS
+        AND attribute.attname = columns.column_name;
+
+    CREATE OR REPLACE FUNCTION redshift.len(TEXT) RETURNS INTEGER
+    AS 'SELECT LENGTH($1)' LANGUAGE SQL IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION redshift.getdate() RETURNS TIMESTAMP
+    AS 'SELECT LOCALTIMESTAMP(0)' LANGUAGE SQL STABLE;
+
+    CREATE OR REPLACE FUNCTION redshift.datediff(TEXT, TIMESTAMP, TIMESTAMP) RETURNS BIGINT
+    AS $$
+        SELECT (
+            EXTRACT(EPOCH FROM DATE_TRUNC($1, $3) - DATE_TRUNC($1, $2))
+            / CASE LOWER($1) WHEN 'day' THEN 86400 WHEN 'hour' THEN 3600 WHEN 'minute' THEN 60 ELSE 1 END
+        )::BIGINT
+    $$ LANGUAGE SQL IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION redshift.round(DOUBLE PRECISION, INTEGER) RETURNS NUMERIC
+    AS 'SELECT ROUND($1::NUMERIC, $2)' LANGUAGE SQL IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION redshift.fnv_hash(TEXT) RETURNS BIGINT
+    AS $$SELECT ('x' || SUBSTR(MD5($1), 1, 16))::BIT(64)::BIGINT$$ LANGUAGE SQL IMMUTABLE STRICT;
+
+    CREATE OR REPLACE FUNCTION redshift.pg_last_copy_id() RETURNS INTEGER
+    AS $$SELECT COALESCE(NULLIF(current_setting('redshift.last_copy_id', true), ''), '-1')::INTEGER$$ LANGUAGE SQL STABLE;
+
+    CREATE OR REPLACE FUNCTION redshift.pg_last_copy_count() RETURNS BIGINT
+    AS $$SELECT COALESCE(NULLIF(current_setting('redshift.last_copy_count', true), ''), '0')::BIGINT$$ LANGUAGE SQL STABLE;
+"""
+
+# Redshift create table syntax without a Postgres equivalent
+CREATE_TABLE = re.compile(r'\s*CREATE\s+(?:TEMP(?:ORARY)?\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(?P<table>\w+)', re.I)
+DISTRIBUTION = re.compile(r'\s*\b(?:DISTSTYLE\s+\w+|DISTKEY\s*\(\s*\w+\s*\))', re.I)
+SORTKEY = re.compile(r'\s*\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*(?:\((?P<columns>[^)]*)\)|AUTO\b)', re.I)
+ENCODE = re.compile(r'\s+ENCODE\s+\w+', re.I)
+IDENTITY = re.compile(r'\bIDENTITY\s*\(\s*(?P<seed>-?\d+)\s*,\s*(?P<step>-?\d+)\s*\)', re.I)
+CONSTRAINT = re.compile(
+    r',\s*(?:PRIMARY\s+KEY\s*\([^)]*\)|FOREIGN\s+KEY\s*\([^)]*\)\s*REFERENCES\s+\w+\s*\([^)]*\))', re.I
+)
+WEEKDAY = re.compile(r'\bEXTRACT\s*\(\s*WEEKDAY\b', re.I)
+
+# Redshift COPY from S3, with the options read by the local load
+COPY = re.compile(r"\s*COPY\s+(?P<table>\w+)\s+FROM\s+'(?P<source>[^']*)'", re.I)
+COPY_JSON = re.compile(r"\bFORMAT\s+(?:AS\s+)?JSON\s+'(?P<mapping>[^']*)'", re.I)
+COPY_MAXERROR = re.compile(r'\bMAXERROR\s+(?:AS\s+)?(?P<maxerror>\d+)', re.I)
+COPY_FLAGS = ('TRUNCATECOLUMNS', 'ACCEPTINVCHARS', 'MANIFEST', 'GZIP', 'ZSTD', 'BZIP2')
+
+# tokens of a JSONPaths expression such as $['artist'] or $.song.title[0]
+JSONPATH = re.compile(r"""\['(?P<quoted>[^']*)'\]|\["(?P<double>[^"]*)"\]|\.(?P<name>\w+)|\[(?P<index>\d+)\]""")
+
+# err_code and err_reason of stl_load_errors for the rows rejected by the local load
+INVALID_INPUT = 1216
+STRING_LENGTH_EXCEEDED = 1204
+INVALID_DIGIT = 1207
+INVALID_FLOAT = 1208
+INVALID_UTF8 = 1220
+
+INTEGER_RANGES = {
+    'smallint': 2**15,
+    'integer': 2**31,
+    'bigint': 2**63,
+}
+FLOAT_TYPES = ('double precision', 'real', 'numeric')
+STRING_TYPES = ('character varying', 'character', 'text')
+
+
+def rewrite(query):
+    '''Rewrite the Redshift-only syntax of a query for Postgres.
+
+    Parameters
+    ----------
+    query (str) : Redshift syntax
+
+    Returns
+    -------
+    query (str) : Postgres syntax
+    '''
+
+    query = WEEKDAY.sub('EXTRACT(DOW', query)
+
+    create = CREATE_TABLE.match(query)
+    if create is None:
+        return query
+
+    # a sort key orders the blocks scanned by range restricted queries, the nearest Postgres equivalent is an index
+    sortkey = SORTKEY.search(query)
+    query = SORTKEY.sub('', DISTRIBUTION.sub('', ENCODE.sub('', query)))
+    query = IDENTITY.sub(
+        lambda match: f"GENERATED BY DEFAULT AS IDENTITY (START WITH {match['seed']} MINVALUE {min(int(match['seed']), 0)} "
+            f"INCREMENT BY {match['step']})",
+        query
+    )
+    query = CONSTRAINT.sub('', query)
+    if sortkey is not None and sortkey['columns']:
+        query = query.rstrip().rstrip(';') + (
+            f";\nCREATE INDEX {create['table']}_sortkey ON {create['table']} ({sortkey['columns']})"
+        )
+
+    return query
+
+
+def copy_options(query):
+    '''Parse the Redshift COPY syntax of copy_syntax.
+
+    Parameters
+    ----------
+    query (str) : COPY syntax
+
+    Returns
+    -------
+    options (dict) : table, source url, mapping of 'auto', 'auto ignorecase' or a JSONPaths url, maxerror and the
+        flags TRUNCATECOLUMNS, ACCEPTINVCHARS, MANIFEST, GZIP, ZSTD and BZIP2 in lower case. None if not a COPY from S3.
+    '''
+
+    copy = COPY.match(query)
+    if copy is None:
+        return None
+
+    mapping = COPY_JSON.search(query)
+    maxerror = COPY_MAXERROR.search(query)
+    # flags after the quoted source and credentials, so a url naming a flag is not taken for it
+    words = set(re.findall(r'\w+', re.sub(r"'[^']*'", '', query).upper()))
+
+    options = {
+        'table': copy['table'],
+        'source': copy['source'],
+        'mapping': mapping['mapping'] if mapping else 'auto',
+        'maxerror': int(maxerror['maxerror']) if maxerror else 0,
+    }
+    options.update({flag.lower(): flag in words for flag in COPY_FLAGS})
+
+    return options
+
+
+def local_path(url, s3_root):
+    '''Local path of an S3 url in the directory mirroring the S3 buckets.
+
+    Parameters
+    ----------
+    url (str) : S3 url such as 's3://udacity-dend/log_data', or a local path returned as is
+    s3_root (str) : directory holding a directory for each bucket
+
+    Returns
+    -------
+    path (str) : local path
+    '''
+
+    if not url.startswith('s3://'):
+        return url
+
+    return os.path.join(s3_root, *url[len('s3://'):].split('/'))
+
+
+def source_files(options, s3_root):
+    '''Find the files copied by a COPY, every file starting with the source prefix or the files of a manifest.
+
+    Parameters
+    ----------
+    options (dict) : COPY options from copy_options
+    s3_root (str) : directory mirroring the S3 buckets
+
+    Returns
+    -------
+    files (list) : tuples of (url, local path) in key order, url as recorded in the system tables
+    '''
+
+    if options['manifest']:
+        with open(local_path(options['source'], s3_root), encoding='utf-8') as fh:
+            entries = json.load(fh)['entries']
+        files = [(entry['url'], local_path(entry['url'], s3_root)) for entry in entries]
+        missing = [url for (url, path), entry in zip(files, entries) if entry.get('mandatory') and not os.path.isfile(path)]
+        if missing:
+            raise psycopg2.DataError(f'Manifest file is not in correct json format or mandatory files are missing: {missing}')
+        return [(url, path) for url, path in files if os.path.isfile(path)]
+
+    # S3 keys are matched on their prefix, not only on whole directories, so song_data also copies song_data_old
+    prefix = local_path(options['source'], s3_root)
+    directory = os.path.dirname(prefix)
+    files = []
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            if path.startswith(prefix):
+                url = path
+                if options['source'].startswith('s3://'):
+                    url = 's3://' + os.path.relpath(path, s3_root).replace(os.sep, '/')
+                files.append((url, path))
+
+    return sorted(files)
+
+
+def jsonpath_keys(path):
+    '''Split a JSONPaths expression into the keys and array indexes of its value.
+
+    Parameters
+    ----------
+    path (str) : expression such as "$['artist']" or '$.song.title[0]'
+
+    Returns
+    -------
+    keys (list) : str key or int index of each step
+    '''
+
+    keys = []
+    for token in JSONPATH.finditer(path[1:]):
+        if token['index'] is not None:
+            keys.append(int(token['index']))
+        else:
+            keys.append(token['quoted'] if token['quoted'] is not None else token['double'] or token['name'])
+
+    return keys
+
+
+def json_value(record, keys):
+    '''Value of a record at the keys of jsonpath_keys, None if missing.'''
+
+    value = record
+    for key in keys:
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+
+    return value
+
+
+def read_records(data):
+    '''Read the JSON records of a file with the line number each ends on, as stl_load_errors reports for JSON.
+
+    Parameters
+    ----------
+    data (bytes) : uncompressed file contents, records one per line or spanning several lines
+
+    Returns
+    -------
+    records (generator) : tuples of (line_number, record), ending with (line_number, json.JSONDecodeError) if the rest
+        of the file is not valid JSON
+    '''
+
+    # keep invalid UTF-8 bytes so ACCEPTINVCHARS can replace them
+    text = data.decode('utf-8', errors='surrogateescape')
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'\s*')
+
+    position = 0
+    line = 1
+    while True:
+        start = whitespace.match(text, position).end()
+        if start == len(text):
+            return
+        line += text.count('\n', position, start)
+        try:
+            record, end = decoder.raw_decode(text, start)
+        except json.JSONDecodeError as error:
+            yield error.lineno, error
+            return
+        line += text.count('\n', start, end)
+        yield line, record
+        position = end
+
+
+def convert(value, column, truncate=False, accept_invchars=False):
+    '''Convert a JSON value to the type of a column like COPY, or reject it.
+
+    Parameters
+    ----------
+    value : JSON value
+    column (dict) : column_name, data_type and character_maximum_length from information_schema.columns
+    truncate (bool) : TRUNCATECOLUMNS, cut strings longer than the column instead of rejecting them
+    accept_invchars (bool) : ACCEPTINVCHARS, replace invalid UTF-8 characters with '?' instead of rejecting them
+
+    Returns
+    -------
+    value : value loaded into the column
+
+    Raises
+    ------
+    ValueError : args of err_code and err_reason of stl_load_errors for a rejected value
+    '''
+
+    if value is None:
+        return None
+
+    data_type = column['data_type']
+    if data_type in STRING_TYPES:
+        text = value if isinstance(value, str) else json.dumps(value)
+        if re.search('[\udc80-\udcff]', text):
+            if not accept_invchars:
+                raise ValueError(INVALID_UTF8, 'String contains invalid or unsupported UTF8 codepoints')
+            text = re.sub('[\udc80-\udcff]', '?', text)
+        # VARCHAR lengths are in bytes
+        length = column['character_maximum_length']
+        encoded = text.encode('utf-8')
+        if length is not None and len(encoded) > length:
+            if not truncate:
+                raise ValueError(STRING_LENGTH_EXCEEDED, 'String length exceeds DDL length')
+            text = encoded[:length].decode('utf-8', errors='ignore')
+        return text
+
+    if data_type in INTEGER_RANGES:
+        if isinstance(value, str):
+            value = value.strip()
+            if value == '':
+                return None
+        # whole JSON numbers such as 1540919166796.0 are loaded
+        try:
+            number = int(value) if isinstance(value, int) or re.fullmatch(r'[-+]?\d+', str(value)) else float(value)
+        except (TypeError, ValueError):
+            number = None
+        if isinstance(value, bool) or number is None or (isinstance(number, float) and not number.is_integer()):
+            raise ValueError(INVALID_DIGIT, f"Invalid digit, Value '{value}', Type: {data_type.title()}")
+        number = int(number)
+        if not -INTEGER_RANGES[data_type] <= number < INTEGER_RANGES[data_type]:
+            raise ValueError(INVALID_INPUT, f"Overflow, Value '{value}' out of range for type {data_type.title()}")
+        return number
+
+    if data_type in FLOAT_TYPES:
+        if isinstance(value, str):
+            value = value.strip()
+            if value == '':
+                return None
+        if isinstance(value, bool):
+            raise ValueError(INVALID_FLOAT, f"Invalid float, Value '{value}'")
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ValueError(INVALID_FLOAT, f"Invalid float, Value '{value}'")
+
+    # other types such as TIMESTAMP are parsed by Postgres
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def copy_text(value):
+    '''Format a value for COPY FROM STDIN in the Postgres text format.'''
+
+    if value is None:
+        return '\\N'
+
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def decompress(data, options):
+    '''Uncompress the bytes of a file copied with GZIP, ZSTD or BZIP2.'''
+
+    if options['gzip']:
+        return gzip.decompress(data)
+    if options['zstd']:
+        # optional dependency only needed for zstd files
+        import zstandard
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if options['bzip2']:
+        return bz2.decompress(data)
+
+    return data
+
+
+class LocalCursor(psycopg2.extensions.cursor):
+    '''Cursor rewriting Redshift syntax for Postgres and running COPY from the local mirror of S3.'''
+
+    def execute(self, query, vars=None):
+        if isinstance(query, str):
+            options = copy_options(query)
+            if options is not None:
+                return self.copy_local(options)
+            query = rewrite(query)
+
+        return super().execute(query, vars)
+
+    def copy_local(self, options):
+        '''Load the JSON files of a COPY into its table, recording the files and rejected rows like Redshift.
+
+        Parameters
+        ----------
+        options (dict) : COPY options from copy_options
+
+        Returns
+        -------
+        None
+        '''
+
+        table = options['table']
+        super().execute(
+            """
+            SELECT column_name, data_type, character_maximum_length
+            FROM information_schema.columns
+            WHERE table_schema = current_schema()
+            AND table_name = %s
+            ORDER BY ordinal_position
+            """,
+            (table.lower(),)
+        )
+        columns = [
+            {'column_name': name, 'data_type': data_type, 'character_maximum_length': length}
+            for name, data_type, length in self.fetchall()
+        ]
+        # table id of stl_load_errors, as in stv_tbl_perm
+        super().execute('SELECT %s::REGCLASS::OID::INTEGER', (table,))
+        tbl = self.fetchone()[0]
+
+        if options['mapping'].lower().startswith('auto'):
+            ignorecase = 'ignorecase' in options['mapping'].lower()
+            paths = [[column['column_name']] for column in columns]
+        else:
+            ignorecase = False
+            with open(local_path(options['mapping'], self.connection.s3_root), encoding='utf-8') as fh:
+                paths = [jsonpath_keys(path) for path in json.load(fh)['jsonpaths']]
+            if len(paths) != len(columns):
+                raise psycopg2.DataError('Number of jsonpaths and the number of columns should match. '
+                    f'JSONPath size: {len(paths)}, Number of columns in table or column list: {len(columns)}')
+
+        log = self.connection.system_log()
+        with log.cursor() as cur:
+            cur.execute("SELECT nextval('redshift.copy_query_id'), LOCALTIMESTAMP")
+            query, starttime = cur.fetchone()
+
+        rows = io.StringIO()
+        loaded = 0
+        commits = []
+        scans = []
+        errors = []
+        for url, path in source_files(options, self.connection.s3_root):
+            file_start = time.time()
+            with open(path, 'rb') as fh:
+                data = fh.read()
+            lines = 0
+            file_errors = len(errors)
+            for line_number, record in read_records(decompress(data, options)):
+                if isinstance(record, json.JSONDecodeError):
+                    errors.append((url, line_number, '', INVALID_INPUT, f'Invalid JSON: {record.msg}', ''))
+                    break
+                lines += 1
+                if ignorecase and isinstance(record, dict):
+                    record = {key.lower(): value for key, value in record.items()}
+                row = []
+                try:
+                    for column, keys in zip(columns, paths):
+                        value = json_value(record, keys)
+                        try:
+                            row.append(convert(value, column, options['truncatecolumns'], options['acceptinvchars']))
+                        except ValueError as error:
+                            # invalid UTF-8 bytes can't be stored, as in raw_field_value of Redshift
+                            raw = str(value).encode('utf-8', errors='surrogateescape').decode('utf-8', errors='replace')
+                            errors.append((url, line_number, column['column_name'], *error.args, raw))
+                            raise
+                except ValueError:
+                    continue
+                rows.write('\t'.join(copy_text(value) for value in row) + '\n')
+                loaded += 1
+            commits.append((query, url, lines, len(errors) - file_errors))
+            scans.append((query, url, lines, len(data), int((time.time() - file_start) * 1e6)))
+
+        with log.cursor() as cur:
+            cur.executemany(
+                """
+                INSERT INTO redshift.stl_load_errors
+                    (query, slice, tbl, starttime, filename, line_number, colname, type, raw_field_value, err_code, err_reason)
+                VALUES (%s, 0, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                """,
+                [
+                    (query, tbl, starttime, url, line_number, colname,
+                        next((column['data_type'] for column in columns if column['column_name'] == colname), ''),
+                        raw[:1024], err_code, err_reason)
+                    for url, line_number, colname, err_code, err_reason, raw in errors
+                ]
+            )
+            if len(errors) > options['maxerror']:
+                raise psycopg2.InternalError(
+                    f"Load into table '{table}' failed.  Check 'stl_load_errors' system table for details."
+                )
+            cur.executemany(
+                """
+                INSERT INTO redshift.stl_load_commits (query, slice, filename, lines_scanned, errors, curtime)
+                VALUES (%s, 0, %s, %s, %s, LOCALTIMESTAMP)
+                """,
+                commits
+            )
+            cur.executemany(
+                """
+                INSERT INTO redshift.stl_file_scan (query, slice, name, lines, bytes, loadtime, curtime)
+                VALUES (%s, 0, %s, %s, %s, %s, LOCALTIMESTAMP)
+                """,
+                scans
+            )
+
+        rows.seek(0)
+        self.copy_expert(
+            f"COPY {table} ({', '.join(column['column_name'] for column in columns)}) FROM STDIN", rows
+        )
+        super().execute(
+            "SELECT set_config('redshift.last_copy_id', %s, false), set_config('redshift.last_copy_count', %s, false)",
+            (str(query), str(loaded))
+        )
+
+
+class LocalConnection(psycopg2.extensions.connection):
+    '''Postgres connection running Redshift syntax through LocalCursor, reading COPY files from s3_root.'''
+
+    # directory mirroring the S3 buckets, set by connection()
+    s3_root = '.'
+
+    def __init__(self, dsn, *args, **kwargs):
+        super().__init__(dsn, *args, **kwargs)
+        self.cursor_factory = LocalCursor
+        self.log_dsn = dsn
+        self.log = None
+
+    def system_log(self):
+        '''Connection writing the system tables outside the transaction of the COPY, which keeps the rejected rows
+        of a failed COPY like Redshift.'''
+
+        if self.log is None:
+            self.log = psycopg2.connect(self.log_dsn)
+            self.log.autocommit = True
+
+        return self.log
+
+    def close(self):
+        if self.log is not None:
+            self.log.close()
+        super().close()
+
+
+def connection(config):
+    '''Connection settings of the cluster, or of a local Postgres through the dialect shim when dwh.cfg has a
+    [POSTGRES] section. The shim objects are created in the local database before the first connection.
+
+    Parameters
+    ----------
+    config (configparser.ConfigParser) : dwh.cfg read with optionxform = str
+
+    Returns
+    -------
+    settings (dict) : options of the [CLUSTER] or [POSTGRES] section such as DB_NAME
+    connect (dict) : keyword arguments of psycopg2.connect and ThreadedConnectionPool
+    '''
+
+    local = config.has_section('POSTGRES')
+    settings = dict(config.items('POSTGRES' if local else 'CLUSTER'))
+    connect = {'dsn': f"""
+        host={settings['HOST']} dbname={settings['DB_NAME']}
+        user={settings['DB_USER']} password={settings['DB_PASSWORD']}
+        port={settings['DB_PORT']}"""
+    }
+    if not local:
+        return settings, connect
+
+    s3_root = settings.get('S3_ROOT', 'local_s3')
+    print(f"Running on local Postgres {settings['HOST']}:{settings['DB_PORT']} through the Redshift dialect shim, "
+        f"copying from {s3_root}.")
+
+    conn = psycopg2.connect(connect['dsn'])
+    try:
+        conn.cursor().execute(setup_syntax)
+        conn.commit()
+    finally:
+        conn.close()
+
+    connect['options'] = f'-c search_path=public,{SCHEMA}'
+    connect['connection_factory'] = type('LocalConnection', (LocalConnection,), {'s3_root': s3_root})
+
+    return settings, connect
+
+
+def sample_key(name, config):
+    '''S3 url of a sample file in the layout of the [S3] section of dwh.cfg.
+
+    Parameters
+    ----------
+    name (str) : file name, a log file such as 2018-11-01-events.json, the JSONPaths file, or a song file such as
+        TRAYFUW128F428F618.json
+    config (configparser.ConfigParser) : dwh.cfg
+
+    Returns
+    -------
+    url (str) : S3 url such as 's3://udacity-dend/song_data/A/Y/F/TRAYFUW128F428F618.json'
+    '''
+
+    s3 = {option: value.strip("'") for option, value in config.items('S3')}
+    if name == s3['LOG_JSONPATH'].rsplit('/', 1)[-1]:
+        return s3['LOG_JSONPATH']
+
+    # log files are stored by year and month, song files by the 3rd to 5th letters of the track id
+    log = re.fullmatch(r'(?P<year>\d{4})-(?P<month>\d{2})-\d{2}-events\.json', name)
+    if log:
+        return f"{s3['LOG_DATA'].rstrip('/')}/{log['year']}/{log['month']}/{name}"
+
+    return f"{s3['SONG_DATA'].rstrip('/')}/{'/'.join(name[2:5])}/{name}"
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sample', type=str, default='aws_s3_sample_files', help='directory of files to copy into S3_ROOT')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read('dwh.cfg')
+    s3_root = config['POSTGRES'].get('S3_ROOT', 'local_s3') if config.has_section('POSTGRES') else 'local_s3'
+
+    for name in sorted(os.listdir(args.sample)):
+        url = sample_key(name, config)
+        path = local_path(url, s3_root)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(os.path.join(args.sample, name), path)
+        print(f'Copied {name} to {url} in {s3_root}.')
+
+    if not config.has_section('POSTGRES'):
+        print("Add a [POSTGRES] section to dwh.cfg with the HOST, DB_NAME, DB_USER, DB_PASSWORD and DB_PORT of a local "
+            "Postgres, and S3_ROOT = local_s3, to run create_tables.py, etl.py, test_etl.py and dashboard.py locally.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,262 @@
+""" Records the duration, rows in/out, bytes read and errors of each stage of an ETL run.
+
+Stages are timed with the stage context manager, which can be used anywhere in a run without passing a recorder
+around. At the end of a run the stages are written as a Prometheus textfile, for the node_exporter textfile
+collector, and as a JSON run report.
+
+Stages may run at the same time in several threads. Each use of a stage counts into its own record, which is added to
+the run under a lock when the stage ends.
+
+The same file is kept in data_modeling/postgres and cloud_data_warehouses, as both project folders are standalone
+scripts without a common package to share it from.
+
+Example
+-------
+with metrics.stage('copy', table='songs') as record:
+    record['rows_in'] += len(df)
+"""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+COUNTERS = ['calls', 'seconds', 'rows_in', 'rows_out', 'bytes_read', 'errors']
+
+
+class Metrics:
+    """ Stages of a single ETL run.
+
+    Attributes
+    ----------
+    job : str
+        name of the ETL script, used as the Prometheus job label
+    started : float
+        seconds since the epoch when the run started
+    stages : dict
+        keys = tuple of (stage name, table name or None), values = dict of COUNTERS in the order stages first ran
+    """
+
+    def __init__(self, job='etl'):
+        self.job = job
+        self.started = time.time()
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, table=None, **counters):
+        """ Adds to the counters of a stage, created the first time the stage is used.
+
+        Parameters
+        ----------
+        name : str
+            stage such as 'discover', 'parse', 'transform', 'copy' or 'insert'
+        table : str, optional
+            SQL table or data set the stage works on
+        counters : int or float
+            keys = one of COUNTERS, values = amount to add
+
+        Returns
+        -------
+        None
+        """
+
+        with self._lock:
+            record = self.stages.setdefault((name, table), dict.fromkeys(COUNTERS, 0))
+            for counter, value in counters.items():
+                record[counter] += value
+
+    @contextmanager
+    def stage(self, name, table=None):
+        """ Times a stage, counting an error if it raises an exception.
+
+        Parameters
+        ----------
+        name : str
+            stage such as 'discover', 'parse', 'transform', 'copy' or 'insert'
+        table : str, optional
+            SQL table or data set the stage works on
+
+        Returns
+        -------
+        record : dict
+            counters of this use of the stage for the caller to add rows_in, rows_out and bytes_read to, added to the
+            run when the stage ends
+        """
+
+        record = dict.fromkeys(COUNTERS, 0)
+        time_start = time.perf_counter()
+        try:
+            yield record
+        except Exception:
+            record['errors'] += 1
+            raise
+        finally:
+            record['calls'] += 1
+            record['seconds'] += time.perf_counter() - time_start
+            self.add(name, table, **record)
+
+    def merge(self, stages):
+        """ Adds stages recorded elsewhere, such as by a worker process.
+
+        Parameters
+        ----------
+        stages : dict
+            Metrics.stages of another run
+
+        Returns
+        -------
+        None
+        """
+
+        for (name, table), counters in stages.items():
+            self.add(name, table, **counters)
+
+    def snapshot(self):
+        """ Copy of the stages, consistent while other threads keep recording.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        stages : dict
+            same as Metrics.stages
+        """
+
+        with self._lock:
+            return {key: dict(counters) for key, counters in self.stages.items()}
+
+    def report(self):
+        """ Summary of the run with the counters of each stage.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        report : dict
+            job, start and end times, elapsed seconds and a list of stages with rows_out per second
+        """
+
+        finished = time.time()
+        recorded = self.snapshot()
+        stages = []
+        for (name, table), counters in recorded.items():
+            seconds = counters['seconds']
+            stages.append({'stage': name, 'table': table, **counters,
+                'rows_out_per_sec': counters['rows_out'] / seconds if seconds else None})
+
+        report = {
+            'job': self.job,
+            'started': self.started,
+            'finished': finished,
+            'elapsed_sec': finished - self.started,
+            'errors': sum(counters['errors'] for counters in recorded.values()),
+            'stages': stages,
+        }
+
+        return report
+
+    def prometheus(self, report=None):
+        """ Prometheus text exposition format of a run report.
+
+        Parameters
+        ----------
+        report : dict, optional
+            result of report, a new report if not given
+
+        Returns
+        -------
+        text : str
+            one gauge per counter of each stage labelled by job, stage and table
+        """
+
+        report = report or self.report()
+        lines = []
+        for counter in COUNTERS:
+            metric = 'etl_stage_{}'.format('duration_seconds' if counter == 'seconds' else counter)
+            description = 'duration in seconds' if counter == 'seconds' else counter.replace('_', ' ')
+            lines += ['# HELP {} {} of each ETL stage in the last run.'.format(metric, description),
+                '# TYPE {} gauge'.format(metric)]
+            for stage in report['stages']:
+                labels = 'job="{}",stage="{}",table="{}"'.format(report['job'], stage['stage'], stage['table'] or '')
+                lines.append('{}{{{}}} {}'.format(metric, labels, stage[counter]))
+
+        for metric, value in [('etl_run_duration_seconds', report['elapsed_sec']), ('etl_run_errors', report['errors']),
+                ('etl_run_finished_timestamp_seconds', report['finished'])]:
+            lines += ['# TYPE {} gauge'.format(metric), '{}{{job="{}"}} {}'.format(metric, report['job'], value)]
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory):
+        """ Writes the run report to {job}.json and the Prometheus textfile to {job}.prom in a directory.
+
+        The textfile is written to a temporary file then renamed, so the textfile collector never reads a partial file.
+
+        Parameters
+        ----------
+        directory : str
+            directory read by the node_exporter textfile collector
+
+        Returns
+        -------
+        report : dict
+            result of report
+        """
+
+        report = self.report()
+        os.makedirs(directory, exist_ok=True)
+
+        with open(os.path.join(directory, self.job + '.json'), 'w', encoding='utf-8') as fh:
+            json.dump(report, fh, indent=4)
+
+        textfile = os.path.join(directory, self.job + '.prom')
+        with open(textfile + '.tmp', 'w', encoding='utf-8') as fh:
+            fh.write(self.prometheus(report))
+        os.replace(textfile + '.tmp', textfile)
+
+        return report
+
+    def summary(self):
+        """ Table of the stages ordered by time taken, to see which stage dominates a run."""
+
+        lines = ['{:<12}{:<20}{:>10}{:>12}{:>12}{:>14}{:>8}'.format(
+            'stage', 'table', 'seconds', 'rows_in', 'rows_out', 'bytes_read', 'errors')]
+        for (name, table), counters in sorted(self.snapshot().items(), key=lambda item: -item[1]['seconds']):
+            lines.append('{:<12}{:<20}{:>10.2f}{:>12}{:>12}{:>14}{:>8}'.format(name, table or '', counters['seconds'],
+                counters['rows_in'], counters['rows_out'], counters['bytes_read'], counters['errors']))
+
+        return '\n'.join(lines)
+
+
+# stages of the current run, used through the module functions below
+current = Metrics()
+
+
+def start(job):
+    """ Starts recording a new run, discarding any stages recorded so far.
+
+    Parameters
+    ----------
+    job : str
+        name of the ETL script, used as the Prometheus job label
+
+    Returns
+    -------
+    run : Metrics
+        stages of the new run
+    """
+
+    global current
+    current = Metrics(job)
+
+    return current
+
+
+def stage(name, table=None):
+    """ Times a stage of the current run, see Metrics.stage."""
+
+    return current.stage(name, table)
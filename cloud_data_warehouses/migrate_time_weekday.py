@@ -0,0 +1,85 @@
+''' Update the weekday column of a time table loaded before weekday counted from Monday = 0.
+
+Earlier versions of insert_syntax and merge_syntax stored EXTRACT(WEEKDAY), counting from Sunday = 0, while
+time_columns in sql_queries.py now counts from Monday = 0 like data_modeling/postgres. Loading new plays incrementally
+into an existing time table would mix the two, so run this once before the first `etl.py --incremental` after
+upgrading. Tables created and fully loaded since then need no update.
+
+weekday is recomputed from start_time with the same syntax as the inserts, in a single UPDATE of only the rows that
+differ, so running it again changes nothing.
+
+Parameters
+----------
+--table (str) : time table to update, time by default
+
+Returns
+-------
+None
+
+See Also
+--------
+dwh.cfg
+
+Example
+-------
+migrate_time_weekday.py
+
+'''
+
+import argparse
+import configparser
+import psycopg2
+import metrics
+from sql_queries import time_columns
+from local_postgres import connection
+
+
+def migrate_weekday(cur, table='time'):
+    '''Recompute the weekday of every row of a time table that is not counted from Monday = 0.
+
+    Parameters
+    ----------
+    cur (psycopg2.cursor) : cursor of the cluster
+    table (str) : time table to update
+
+    Returns
+    -------
+    updated (int) : number of rows updated
+    '''
+
+    weekday = time_columns('start_time')['weekday']
+    with metrics.stage('migrate', table) as record:
+        cur.execute(f"UPDATE {table} SET weekday = {weekday} WHERE weekday <> {weekday}")
+        record['rows_out'] += cur.rowcount
+
+    return cur.rowcount
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--table', type=str, default='time', help='time table to update')
+    args = parser.parse_args()
+
+    run = metrics.start('redshift_migrate_time_weekday')
+
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read('dwh.cfg')
+    config, connect = connection(config)
+
+    conn = psycopg2.connect(**connect)
+    cur = conn.cursor()
+
+    try:
+        updated = migrate_weekday(cur, args.table)
+        conn.commit()
+        print(f'Updated the weekday of {updated} rows of {args.table}.')
+    finally:
+        conn.close()
+
+        print(run.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,428 @@
+''' Reload only the rows of the S3 files rejected by a COPY into a staging table.
+
+COPY with MAXERROR skips rejected rows and loads the rest of each file, so rerunning the whole bucket prefix
+duplicates every loaded row and takes as long as the first load. Instead the rejected rows are read from the error
+report saved by etl.py, load_report.json, or from the stl_load_errors system table. The records ending on
+each rejected line are copied out of their files into a repair file, listed in a manifest of only that file, then
+copied into the staging table, retrying with exponential backoff. The time taken depends on the number of rejected
+files, not on the size of the data set.
+
+Files are read and written on S3, or in the local directory mirroring the buckets when dwh.cfg has a [POSTGRES]
+section for local_postgres.py.
+
+Optional fixes are applied first: VARCHAR columns rejected for 'String length exceeds DDL length' are widened to fit
+the rejected values, and ACCEPTINVCHARS replaces invalid UTF-8 characters instead of rejecting the row.
+
+Parameters
+----------
+table (str) : staging table such as staging_songs
+output (str) : S3 url prefix to write the repair file and its manifest to such as 's3://my-bucket/repair/'
+--report (str) : load report to read, load_report.json by default
+--query (bool) : read errors from stl_load_errors instead of the report
+--since (str) : with --query, errors of every COPY after a time such as '2018-11-05 10:00:00' instead of the latest COPY
+--widen (bool) : widen VARCHAR columns to fit rejected values
+--accept-invchars (bool) : add ACCEPTINVCHARS to the COPY
+--attempts (int) : number of times the COPY is tried
+--backoff (float) : seconds waited after the first failed attempt, doubling after each attempt
+
+Returns
+-------
+None
+
+See Also
+--------
+dwh.cfg
+
+Example
+-------
+reload_errors.py staging_songs s3://my-bucket/repair/ --widen
+
+'''
+
+import os
+import re
+import gzip
+import json
+import time
+import argparse
+import configparser
+import psycopg2
+import metrics
+from sql_queries import copy_syntax
+from s3_manifest import parse_s3_url, manifest
+from compact_songs import compress
+from etl import LOAD_REPORT, copy_stats, copy_file_report
+from local_postgres import connection, local_path
+
+# err_code of stl_load_errors for a value longer than its VARCHAR column
+STRING_LENGTH_EXCEEDED = 1204
+
+# ids of the table in the current schema, as tables of the same name in other schemas have their own ids
+table_ids = """SELECT table_id FROM svv_table_info WHERE "schema" = current_schema() AND "table" = %s"""
+
+errors_query = f"""
+    SELECT TRIM(filename), TRIM(colname), TRIM(err_reason), err_code, line_number
+    FROM stl_load_errors
+    WHERE tbl IN ({table_ids})
+    AND starttime > %s
+"""
+
+# errors of the latest COPY that rejected rows of the table
+latest_errors_query = f"""
+    SELECT TRIM(filename), TRIM(colname), TRIM(err_reason), err_code, line_number
+    FROM stl_load_errors
+    WHERE query = (SELECT MAX(query) FROM stl_load_errors WHERE tbl IN ({table_ids}))
+"""
+
+
+def report_errors(path, table):
+    '''Read the rejected rows of a staging table from the load report saved by etl.py.
+
+    Parameters
+    ----------
+    path (str) : path of load_report.json
+    table (str) : staging table name
+
+    Returns
+    -------
+    errors (list) : dict of filename, colname, err_reason, err_code and line_number of each rejected row
+    '''
+
+    with open(path, encoding='utf-8') as fh:
+        report = json.load(fh)
+    if table not in report:
+        raise LookupError(f'No files loaded into table {table} in file {path}.')
+
+    return [
+        {'filename': file['filename'], 'colname': error['colname'], 'err_reason': error['err_reason'],
+            'err_code': error['err_code'], 'line_number': error['line_number']}
+        for file in report[table] for error in file['rejected']
+    ]
+
+
+def query_errors(cur, table, since=None):
+    '''Read the rejected rows of a staging table from stl_load_errors.
+
+    Parameters
+    ----------
+    cur (psycopg2.connect.cursor) : cursor for execute SQL statements
+    table (str) : staging table name
+    since (str) : errors after this time from any COPY, otherwise only the errors of the latest COPY rejecting rows, as
+        rows of earlier COPYs may have been reloaded already
+
+    Returns
+    -------
+    errors (list) : dict of filename, colname, err_reason, err_code and line_number of each rejected row
+    '''
+
+    if since:
+        cur.execute(errors_query, (table, since))
+    else:
+        cur.execute(latest_errors_query, (table,))
+
+    return [
+        {'filename': filename, 'colname': colname, 'err_reason': err_reason, 'err_code': err_code, 'line_number': line_number}
+        for filename, colname, err_reason, err_code, line_number in cur.fetchall()
+    ]
+
+
+def rejected_records(data, lines=None):
+    '''Find the JSON records of a file that end on rejected lines, as line_number of a JSON COPY is the last line of
+    the record.
+
+    Parameters
+    ----------
+    data (bytes) : contents of a file of JSON records, one per line or spanning several lines
+    lines (set) : rejected line numbers counting from 1, None for every record of the file
+
+    Returns
+    -------
+    records (list) : dict of each rejected record
+    raw (list) : each rejected record as a line of JSON, keeping its invalid UTF-8 bytes
+    '''
+
+    # keep invalid UTF-8 bytes so a fix such as ACCEPTINVCHARS sees the original values
+    text = data.decode('utf-8', errors='surrogateescape')
+    decoder = json.JSONDecoder()
+
+    whitespace = re.compile(r'\s*')
+
+    records = []
+    raw = []
+    position = 0
+    line = 1
+    while True:
+        start = whitespace.match(text, position).end()
+        if start == len(text):
+            break
+        line += text.count('\n', position, start)
+        record, end = decoder.raw_decode(text, start)
+        line += text.count('\n', start, end)
+        if lines is None or line in lines:
+            records.append(record)
+            raw.append(json.dumps(record, ensure_ascii=False))
+        position = end
+
+    return records, raw
+
+
+def widen_columns(cur, conn, table, errors, records):
+    '''Widen VARCHAR columns rejected for values longer than the column to the longest rejected value.
+
+    Parameters
+    ----------
+    cur (psycopg2.connect.cursor) : cursor for execute SQL statements
+    conn (psycopg2.connect) : connection to Redshift
+    table (str) : staging table name
+    errors (list) : rejected rows from report_errors or query_errors
+    records (list) : dict of each rejected record
+
+    Returns
+    -------
+    widened (dict) : keys = column name, values = new VARCHAR length
+    '''
+
+    widened = {}
+    for column in {error['colname'] for error in errors if error['err_code'] == STRING_LENGTH_EXCEEDED}:
+        # VARCHAR lengths are in bytes, JSON keys match column names ignoring case
+        lengths = [
+            len(str(value).encode('utf-8', errors='surrogateescape'))
+            for record in records for key, value in record.items() if key.lower() == column.lower() and value is not None
+        ]
+        cur.execute(
+            "SELECT character_maximum_length FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+            (table, column)
+        )
+        current = cur.fetchone()
+        if not lengths or current is None or current[0] is None or max(lengths) <= current[0]:
+            continue
+
+        widened[column] = min(max(lengths), 65535)
+        print(f'Widening column {column} of table {table} from VARCHAR({current[0]}) to VARCHAR({widened[column]}).')
+        # ALTER COLUMN TYPE can't run inside a transaction block
+        conn.commit()
+        conn.autocommit = True
+        try:
+            cur.execute(f'ALTER TABLE {table} ALTER COLUMN {column} TYPE VARCHAR({widened[column]})')
+        finally:
+            conn.autocommit = False
+
+    return widened
+
+
+def write_repair(table, errors, read, write, output, compression=None):
+    '''Copy the rejected records of each failed file into one repair file, then write a manifest of the repair file.
+
+    Parameters
+    ----------
+    table (str) : staging table name
+    errors (list) : rejected rows from report_errors or query_errors
+    read (function) : called with an S3 url, returning the bytes of the file
+    write (function) : called with an S3 url and bytes to write
+    output (str) : S3 url prefix to write the repair file and its manifest to
+    compression (str) : GZIP or ZSTD compression of the files of the table, matching the COPY syntax
+
+    Returns
+    -------
+    manifest_url (str) : S3 url of the manifest, None if no records were found
+    records (list) : dict of each rejected record
+    '''
+
+    # rejected lines of each file, None to reload every record of a file when line numbers were not recorded
+    files = {}
+    for error in errors:
+        lines = files.setdefault(error['filename'], set())
+        if lines is not None:
+            files[error['filename']] = lines | {error['line_number']} if error['line_number'] else None
+
+    records = []
+    raw = []
+    for filename, lines in files.items():
+        data = read(filename)
+        if filename.endswith('.gz'):
+            data = gzip.decompress(data)
+        elif filename.endswith('.zst'):
+            # optional dependency only needed for zstd chunks
+            import zstandard
+            data = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+        found, text = rejected_records(data, lines)
+        records += found
+        raw += text
+    print(f'Found {len(records)} rejected records in {len(files)} files of table {table}.')
+    if not records:
+        return None, records
+
+    body = ('\n'.join(raw) + '\n').encode('utf-8', errors='surrogateescape')
+    if compression:
+        body = compress(body, compression.lower())
+    bucket, prefix = parse_s3_url(output)
+    key = f"{prefix.rstrip('/')}/{table}_repair.json".lstrip('/')
+    write(f's3://{bucket}/{key}', body)
+
+    manifest_url = f's3://{bucket}/{key}.manifest'
+    write(manifest_url, json.dumps(manifest(bucket, [{'key': key, 'size': len(body)}])).encode('utf-8'))
+
+    return manifest_url, records
+
+
+def copy_with_retries(cur, conn, query, attempts=3, backoff=5):
+    '''Run a COPY, retrying with exponential backoff if it fails such as from S3 throttling.
+
+    Parameters
+    ----------
+    cur (psycopg2.connect.cursor) : cursor for execute SQL statements
+    conn (psycopg2.connect) : connection to Redshift
+    query (str) : copy syntax
+    attempts (int) : number of times the COPY is tried
+    backoff (float) : seconds waited after the first failed attempt, doubling after each attempt
+
+    Returns
+    -------
+    rows (int) : number of rows loaded
+    query (int) : query id of the COPY
+    '''
+
+    for attempt in range(attempts):
+        try:
+            cur.execute(query)
+            conn.commit()
+            return copy_stats(cur)
+        except psycopg2.Error as error:
+            conn.rollback()
+            if attempt == attempts - 1:
+                raise
+            delay = backoff * 2**attempt
+            print(f'Copy attempt {attempt + 1} of {attempts} failed, retrying in {delay:.0f} seconds: {error}')
+            time.sleep(delay)
+
+
+def reload(cur, conn, table, errors, read, write, output, compression=None, widen=False, accept_invchars=False, attempts=3,
+        backoff=5):
+    '''Reload the rejected rows of a staging table, applying the optional fixes first.
+
+    Parameters
+    ----------
+    cur (psycopg2.connect.cursor) : cursor for execute SQL statements
+    conn (psycopg2.connect) : connection to Redshift
+    table (str) : staging table name
+    errors (list) : rejected rows from report_errors or query_errors
+    read (function) : called with an S3 url, returning the bytes of the file
+    write (function) : called with an S3 url and bytes to write
+    output (str) : S3 url prefix to write the repair file and its manifest to
+    compression (str) : GZIP or ZSTD compression of the files of the table, matching the COPY syntax
+    widen (bool) : widen VARCHAR columns to fit rejected values
+    accept_invchars (bool) : add ACCEPTINVCHARS to the COPY
+    attempts (int) : number of times the COPY is tried
+    backoff (float) : seconds waited after the first failed attempt, doubling after each attempt
+
+    Returns
+    -------
+    result (dict) : files, records found, columns widened, rows loaded and errors of the reload
+    '''
+
+    manifest_url, records = write_repair(table, errors, read, write, output, compression)
+    result = {'files': len({error['filename'] for error in errors}), 'records': len(records), 'widened': {},
+        'rows': 0, 'errors': 0}
+    if manifest_url is None:
+        return result
+
+    if widen:
+        result['widened'] = widen_columns(cur, conn, table, errors, records)
+
+    (_, bucket), query = next(iter(copy_syntax({table: [manifest_url]}).items()))
+    query = query(table=table, bucket=bucket)
+    if accept_invchars:
+        query += '\nACCEPTINVCHARS'
+
+    print(f'Reloading {len(records)} rejected records into table {table} from manifest {manifest_url}.')
+    with metrics.stage('reload', table) as record:
+        result['rows'], copy_query = copy_with_retries(cur, conn, query, attempts, backoff)
+        files = copy_file_report(cur, [copy_query])
+        conn.commit()
+        result['errors'] = sum(file['errors'] for file in files)
+        record['rows_in'] += len(records)
+        record['rows_out'] += result['rows']
+        record['bytes_read'] += sum(file['bytes'] for file in files)
+        record['errors'] += result['errors']
+
+    return result
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('table', type=str, help='staging table such as staging_songs')
+    parser.add_argument('output', type=str, help='S3 url prefix to write the repair file and its manifest to')
+    parser.add_argument('--report', type=str, default=None, help=f'load report, {LOAD_REPORT} by default')
+    parser.add_argument('--query', action='store_true', help='read errors from stl_load_errors instead of the report')
+    parser.add_argument('--since', type=str, default=None, help='with --query, errors after this time instead of the latest COPY')
+    parser.add_argument('--widen', action='store_true', help='widen VARCHAR columns to fit rejected values')
+    parser.add_argument('--accept-invchars', action='store_true', help='replace invalid UTF-8 characters')
+    parser.add_argument('--attempts', type=int, default=3, help='number of times the COPY is tried')
+    parser.add_argument('--backoff', type=float, default=5, help='seconds waited after the first failed attempt')
+    args = parser.parse_args()
+
+    run = metrics.start('redshift_reload_errors')
+
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read('dwh.cfg')
+    # the cluster, or a local Postgres through the Redshift dialect shim
+    settings, connect = connection(config)
+
+    if config.has_section('POSTGRES'):
+        # the shim copies from a local directory mirroring the S3 buckets
+        s3_root = settings.get('S3_ROOT', 'local_s3')
+
+        def read(url):
+            with open(local_path(url, s3_root), 'rb') as fh:
+                return fh.read()
+
+        def write(url, body):
+            path = local_path(url, s3_root)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as fh:
+                fh.write(body)
+    else:
+        # optional dependency only needed to read and write S3 files
+        import boto3
+
+        s3 = boto3.client(
+            's3',
+            aws_access_key_id=config['INFRASTRUCTURE']['KEY'],
+            aws_secret_access_key=config['INFRASTRUCTURE']['SECRET'],
+            region_name=config['INFRASTRUCTURE']['REGION']
+        )
+
+        def read(url):
+            bucket, key = parse_s3_url(url)
+            return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+
+        def write(url, body):
+            bucket, key = parse_s3_url(url)
+            s3.put_object(Bucket=bucket, Key=key, Body=body)
+
+    conn = psycopg2.connect(**connect)
+    cur = conn.cursor()
+
+    try:
+        if args.query:
+            errors = query_errors(cur, args.table, args.since)
+            conn.commit()
+        else:
+            errors = report_errors(args.report or LOAD_REPORT, args.table)
+
+        # copy_syntax adds SONG_COMPRESSION to the staging_songs COPY only
+        compression = config['S3'].get('SONG_COMPRESSION') if args.table == 'staging_songs' else None
+        result = reload(cur, conn, args.table, errors, read, write, args.output, compression, args.widen,
+            args.accept_invchars, args.attempts, args.backoff)
+    finally:
+        conn.close()
+        print(run.summary())
+
+    print(f"Reloaded {result['rows']} of {result['records']} rejected records from {result['files']} files into table "
+        f"{args.table}, widening {result['widened'] or 'no columns'}, with {result['errors']} rows still rejected.")
+
+
+if __name__ == "__main__":
+    main()
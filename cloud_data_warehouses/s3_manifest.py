@@ -0,0 +1,306 @@
+''' Build Redshift COPY manifests from a single listing of the source S3 files of each staging table.
+
+Copying from a bare prefix makes Redshift list the whole prefix for every COPY and always loads every file. Instead
+the source folder of each table is listed once, files are filtered by prefix, key pattern, modification date and size, then
+written into manifests. Each staging table is split into manifests with close to equal bytes. The number of files
+and bytes of each manifest is reported along with its slice skew, how unevenly the files can spread over the slices
+of the cluster, which is high when a manifest has fewer files than slices or a few very large files. An index of the
+manifests is saved for etl.py --manifests.
+
+Parameters
+----------
+output (str) : S3 url prefix to write manifests to such as 's3://my-bucket/manifests/'
+--groups (int) : number of manifests for each staging table
+--slices (int) : number of slices in the Redshift cluster
+--prefix (str) : only load keys starting with the table source prefix followed by this prefix such as 'A/B'
+--pattern (str) : only load keys matching a glob pattern such as '*2018-11-05*'
+--since (str) : only load files modified at or after a date such as '2018-11-05'
+--until (str) : only load files modified before a date
+--min-size (int) : only load files of at least this many bytes
+--max-size (int) : only load files of at most this many bytes
+--index (str) : local file to save the manifest urls of each table
+
+Returns
+-------
+None
+
+See Also
+--------
+dwh.cfg
+
+Example
+-------
+s3_manifest.py s3://my-bucket/manifests/ --groups 2 --slices 8 --pattern '*2018-11-05*'
+
+'''
+
+import configparser
+import fnmatch
+import heapq
+import json
+import argparse
+from datetime import datetime, timezone
+
+
+def parse_s3_url(url):
+    '''Split an S3 url into its bucket and key.
+
+    Parameters
+    ----------
+    url (str) : S3 url such as 's3://udacity-dend/song_data', optionally quoted like in dwh.cfg
+
+    Returns
+    -------
+    bucket (str) : bucket name such as 'udacity-dend'
+    key (str) : key or key prefix such as 'song_data'
+    '''
+
+    url = url.strip().strip("'\"")
+    bucket, _, key = url[len('s3://'):].partition('/')
+
+    return bucket, key
+
+
+def list_objects(s3, bucket, prefix=''):
+    '''List every object under a prefix of a bucket using one paginated listing.
+
+    Parameters
+    ----------
+    s3 (boto3.client) : S3 client
+    bucket (str) : bucket name
+    prefix (str) : key prefix to list
+
+    Returns
+    -------
+    objects (list) : dict of key, size in bytes and last_modified datetime for each object
+    '''
+
+    objects = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for item in page.get('Contents', []):
+            objects.append({'key': item['Key'], 'size': item['Size'], 'last_modified': item['LastModified']})
+
+    return objects
+
+
+def filter_objects(objects, prefix='', pattern=None, since=None, until=None, min_size=1, max_size=None):
+    '''Keep objects matching every given filter.
+
+    Parameters
+    ----------
+    objects (list) : objects from list_objects
+    prefix (str) : keys must start with this prefix
+    pattern (str) : keys must match this glob pattern such as '*2018-11-05*'
+    since (datetime) : objects must be modified at or after this time
+    until (datetime) : objects must be modified before this time
+    min_size (int) : objects must have at least this many bytes, excluding empty folder markers by default
+    max_size (int) : objects must have at most this many bytes
+
+    Returns
+    -------
+    objects (list) : matching objects
+    '''
+
+    def keep(obj):
+        return (
+            obj['key'].startswith(prefix) and not obj['key'].endswith('/')
+            and (pattern is None or fnmatch.fnmatch(obj['key'], pattern))
+            and (since is None or obj['last_modified'] >= since)
+            and (until is None or obj['last_modified'] < until)
+            and obj['size'] >= min_size
+            and (max_size is None or obj['size'] <= max_size)
+        )
+
+    return [obj for obj in objects if keep(obj)]
+
+
+def balance(objects, groups, key=lambda obj: obj['size']):
+    '''Split objects into groups with close to equal total size, placing the largest objects first.
+
+    Parameters
+    ----------
+    objects (list) : objects from list_objects
+    groups (int) : number of groups
+    key (function) : size of an object
+
+    Returns
+    -------
+    groups (list) : list of objects in each group, largest objects first, without empty groups
+    '''
+
+    heap = [(0, group) for group in range(groups)]
+    assigned = [[] for _ in range(groups)]
+    for obj in sorted(objects, key=key, reverse=True):
+        total, group = heapq.heappop(heap)
+        assigned[group].append(obj)
+        heapq.heappush(heap, (total + key(obj), group))
+
+    return [group for group in assigned if group]
+
+
+def slice_skew(objects, slices):
+    '''Ratio of the bytes loaded by the busiest slice to the average slice, 1.0 when evenly spread.
+
+    Redshift loads the files of a COPY in parallel with one file per slice at a time, so the busiest slice decides
+    how long the COPY takes.
+
+    Parameters
+    ----------
+    objects (list) : objects of a single manifest
+    slices (int) : number of slices in the cluster
+
+    Returns
+    -------
+    skew (float) : busiest slice bytes / average slice bytes
+    '''
+
+    loads = [group_bytes(group) for group in balance(objects, slices)]
+    loads += [0] * (slices - len(loads))
+    average = sum(loads) / slices
+
+    return max(loads) / average if average else 1.0
+
+
+def group_bytes(objects):
+    '''Total bytes of objects.'''
+
+    return sum(obj['size'] for obj in objects)
+
+
+def manifest(bucket, objects):
+    '''Create a COPY manifest of objects. Every entry is mandatory so a missing file fails the COPY.
+
+    Parameters
+    ----------
+    bucket (str) : bucket name
+    objects (list) : objects to load
+
+    Returns
+    -------
+    manifest (dict) : manifest in the format expected by COPY ... MANIFEST
+    '''
+
+    return {'entries': [
+        {'url': f"s3://{bucket}/{obj['key']}", 'mandatory': True, 'meta': {'content_length': obj['size']}}
+        for obj in objects
+    ]}
+
+
+def build_manifests(s3, sources, output, groups=1, slices=1, **filters):
+    '''List the source folder of each staging table once, then write the manifests of each staging table to S3.
+
+    Only the keys under the source folder and the prefix filter are listed, so sources in unrelated folders of a large
+    bucket never list the whole bucket.
+
+    Parameters
+    ----------
+    s3 (boto3.client) : S3 client
+    sources (dict) : keys = staging table name, values = S3 url of the table source files such as 's3://udacity-dend/song_data'
+    output (str) : S3 url prefix to write manifests to such as 's3://my-bucket/manifests/'
+    groups (int) : number of manifests for each staging table
+    slices (int) : number of slices in the Redshift cluster
+    filters : prefix, pattern, since, until, min_size and max_size passed to filter_objects, with prefix relative to each source
+
+    Returns
+    -------
+    report (dict) : keys = staging table name, values = list of dict of url, files, bytes and slice_skew of each manifest
+    '''
+
+    output_bucket, output_prefix = parse_s3_url(output)
+    filters = dict(filters)
+    relative = filters.pop('prefix', '') or ''
+
+    report = {}
+    for table, url in sources.items():
+        bucket, prefix = parse_s3_url(url)
+        # only keys within the source folder, unlike COPY from 's3://udacity-dend/song_data' which also loads song_data_old
+        folder = prefix.rstrip('/') + '/' + relative
+        objects = filter_objects(list_objects(s3, bucket, folder), prefix=folder, **filters)
+
+        report[table] = []
+        for number, group in enumerate(balance(objects, groups)):
+            key = f'{output_prefix.rstrip("/")}/{table}_{number:03d}.manifest'.lstrip('/')
+            s3.put_object(Bucket=output_bucket, Key=key, Body=json.dumps(manifest(bucket, group)).encode('utf-8'))
+            report[table].append({
+                'url': f's3://{output_bucket}/{key}',
+                'files': len(group),
+                'bytes': group_bytes(group),
+                'slice_skew': round(slice_skew(group, slices), 3),
+            })
+
+    return report
+
+
+def manifest_urls(index):
+    '''Read the manifest urls of each table from an index saved by this script.
+
+    Parameters
+    ----------
+    index (str) : path of the JSON index file
+
+    Returns
+    -------
+    manifests (dict) : keys = staging table name, values = list of manifest S3 urls
+    '''
+
+    with open(index, encoding='utf-8') as fh:
+        report = json.load(fh)
+
+    return {table: [entry['url'] for entry in entries] for table, entries in report.items()}
+
+
+def parse_date(value):
+    '''UTC datetime of a date such as '2018-11-05', to compare with S3 LastModified.'''
+
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output', type=str, help="S3 url prefix to write manifests to such as 's3://my-bucket/manifests/'")
+    parser.add_argument('--groups', type=int, default=1, help='number of manifests for each staging table')
+    parser.add_argument('--slices', type=int, default=1, help='number of slices in the Redshift cluster')
+    parser.add_argument('--prefix', type=str, default='', help='key prefix under each table source such as A/B')
+    parser.add_argument('--pattern', type=str, default=None, help="glob pattern of keys to load such as '*2018-11-05*'")
+    parser.add_argument('--since', type=parse_date, default=None, help='load files modified at or after a date')
+    parser.add_argument('--until', type=parse_date, default=None, help='load files modified before a date')
+    parser.add_argument('--min-size', type=int, default=1, help='minimum file size in bytes')
+    parser.add_argument('--max-size', type=int, default=None, help='maximum file size in bytes')
+    parser.add_argument('--index', type=str, default='copy_manifests.json', help='local file to save the manifest urls')
+    args = parser.parse_args()
+
+    # optional dependency only needed to run this script
+    import boto3
+
+    config = configparser.ConfigParser()
+    config.optionxform = str
+    config.read('dwh.cfg')
+
+    s3 = boto3.client(
+        's3',
+        aws_access_key_id=config['INFRASTRUCTURE']['KEY'],
+        aws_secret_access_key=config['INFRASTRUCTURE']['SECRET'],
+        region_name=config['INFRASTRUCTURE']['REGION']
+    )
+    sources = {'staging_events': config['S3']['LOG_DATA'], 'staging_songs': config['S3']['SONG_DATA']}
+
+    report = build_manifests(
+        s3, sources, args.output, groups=args.groups, slices=args.slices, prefix=args.prefix, pattern=args.pattern,
+        since=args.since, until=args.until, min_size=args.min_size, max_size=args.max_size
+    )
+
+    for table, entries in report.items():
+        for entry in entries:
+            print(f"Manifest {entry['url']} for table {table} has {entry['files']} files of {entry['bytes']} bytes "
+                f"with slice skew {entry['slice_skew']}.")
+        if not entries:
+            print(f'No files matched for table {table}.')
+
+    with open(args.index, 'w', encoding='utf-8') as fh:
+        json.dump(report, fh, indent=4)
+    print(f'Saved manifest index into file {args.index}.')
+
+
+if __name__ == "__main__":
+    main()
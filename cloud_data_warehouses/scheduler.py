@@ -0,0 +1,96 @@
+''' Run steps that depend on each other, running steps whose dependencies are done at the same time.
+
+A step only starts once every step it depends on has completed. If a step fails, the steps depending on it, directly
+or through other steps, are skipped while every other step still runs.
+
+Example
+-------
+run_dag({'users': load_users, 'songplay': load_songplay}, {'songplay': ['users']}, max_workers=4)
+
+'''
+
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def topological_order(steps, dependencies):
+    '''Order steps so that each step comes after the steps it depends on, otherwise keeping the given order.
+
+    Parameters
+    ----------
+    steps (list) : step names
+    dependencies (dict) : keys = step name, values = list of step names it depends on
+
+    Returns
+    -------
+    order (list) : step names
+
+    Raises
+    ------
+    ValueError : a step depends on an unknown step or steps depend on each other in a cycle
+    '''
+
+    for step, needs in dependencies.items():
+        unknown = set(needs) - set(steps)
+        if unknown:
+            raise ValueError(f'Step {step} depends on unknown steps {sorted(unknown)}.')
+
+    order = []
+    remaining = list(steps)
+    while remaining:
+        ready = [step for step in remaining if set(dependencies.get(step, [])) <= set(order)]
+        if not ready:
+            raise ValueError(f'Steps {remaining} depend on each other in a cycle.')
+        order += ready
+        remaining = [step for step in remaining if step not in ready]
+
+    return order
+
+
+def run_dag(steps, dependencies, max_workers=1):
+    '''Run each step once the steps it depends on have completed, skipping steps that depend on a failed step.
+
+    Parameters
+    ----------
+    steps (dict) : keys = step name, values = function called without arguments to run the step
+    dependencies (dict) : keys = step name, values = list of step names it depends on
+    max_workers (int) : number of steps run at the same time, 1 runs steps one at a time in topological order
+
+    Returns
+    -------
+    results (dict) : keys = step name in the order steps finished, values = dict of status ('done', 'failed' or
+        'skipped'), seconds taken, and the error raised by a failed step or the failed step a skipped step depends on
+    '''
+
+    order = topological_order(list(steps), dependencies)
+    results = {}
+
+    def timed(step):
+        time_start = time.time()
+        try:
+            steps[step]()
+            return {'status': 'done', 'seconds': time.time() - time_start, 'error': None}
+        except Exception as error:
+            return {'status': 'failed', 'seconds': time.time() - time_start, 'error': error}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        running = {}
+        while len(results) < len(order):
+
+            # start or skip every step whose dependencies have all finished, in topological order
+            for step in order:
+                if step in results or step in running.values():
+                    continue
+                needs = dependencies.get(step, [])
+                blocked = [need for need in needs if need in results and results[need]['status'] != 'done']
+                if blocked:
+                    results[step] = {'status': 'skipped', 'seconds': 0.0, 'error': f'depends on {blocked[0]}'}
+                elif all(need in results for need in needs) and len(running) < max_workers:
+                    running[executor.submit(timed, step)] = step
+
+            if running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    results[running.pop(future)] = future.result()
+
+    return results
@@ -2,6 +2,7 @@
 and insert data into the final analytical fact and dimension tables. Syntax is returned
 in dictionaries to allow steps being performed during ETL to be transparent.'''
 
+import re
 import configparser
 from functools import partial
 from collections import OrderedDict
@@ -10,6 +11,49 @@ from collections import OrderedDict
 config = configparser.ConfigParser()
 config.read('dwh.cfg')
 
+# fields of the log files in the order of log_json_path.json, with the staging_events column type of each
+STAGING_EVENTS_COLUMNS = OrderedDict([
+    ('artist', 'VARCHAR(256)'),
+    ('auth', 'VARCHAR(256)'),
+    ('firstName', 'VARCHAR(256)'),
+    ('gender', 'VARCHAR(1)'),
+    ('itemInSession', 'SMALLINT'),
+    ('lastName', 'VARCHAR(256)'),
+    ('length', 'DOUBLE PRECISION'),
+    ('level', 'VARCHAR(4)'),
+    ('location', 'VARCHAR(256)'),
+    ('method', 'VARCHAR(3)'),
+    ('page', 'VARCHAR(256)'),
+    ('registration', 'BIGINT'),
+    ('sessionId', 'BIGINT'),
+    ('song', 'VARCHAR(256)'),
+    ('status', 'SMALLINT'),
+    ('ts', 'BIGINT'),
+    ('userAgent', 'VARCHAR(256)'),
+    ('userId', 'BIGINT'),
+])
+
+# distribution style and sort keys of each table, selected by name in create_syntax
+LAYOUTS = {
+    # sort keys only, letting Redshift choose how to distribute each table
+    'auto': {
+        'staging_songs_keyed': 'SORTKEY (song_key)',
+        'staging_events_keyed': 'SORTKEY (song_key)',
+        'time': 'SORTKEY (start_time)',
+        'songplay': 'SORTKEY (start_time)',
+    },
+    # joins without moving data: dimensions copied to every node, song plays stored on the node of their user
+    'collocated': {
+        'staging_songs_keyed': 'DISTKEY (song_key) SORTKEY (song_key)',
+        'staging_events_keyed': 'DISTKEY (song_key) SORTKEY (song_key)',
+        'users': 'DISTKEY (user_id) SORTKEY (user_id)',
+        'songs': 'DISTSTYLE ALL SORTKEY (song_id)',
+        'artists': 'DISTSTYLE ALL SORTKEY (artist_id)',
+        'time': 'DISTSTYLE ALL SORTKEY (start_time)',
+        'songplay': 'DISTKEY (user_id) COMPOUND SORTKEY (start_time, user_id)',
+    },
+}
+
 def drop_syntax():
     '''Generage drop table syntax.
     
@@ -24,49 +68,40 @@ def drop_syntax():
     '''
 
     # drop tables using IF EXISTS clause to help facilitate testing
-    tables = ['staging_events','staging_songs','songplay','users','songs','artists','time']
+    tables = ['staging_events','staging_songs','staging_events_keyed','staging_songs_keyed','songplay','users','songs','artists','time','etl_watermarks']
     drop = {t:'DROP TABLE IF EXISTS {table}' for t in tables}
 
     return drop
 
-def create_syntax():
+def create_syntax(layout='collocated', encodings=None):
     ''' Generate syntax to create tables.
 
     Parameters
     ----------
-    None
+    layout (str) : name of the LAYOUTS distribution style and sort keys, with the attributes of a table replaced by a
+        [LAYOUT] section of dwh.cfg such as songplay = DISTKEY (user_id) SORTKEY (start_time)
+    encodings (dict) : keys = table name, values = dict of column name and compression encoding such as 'zstd' from
+        compression_advisor.py, columns left out keep the default encoding
 
     Returns
     -------
     create (OrderedDict) : keys = table name, values = create table syntax
     '''
 
+    attributes = dict(LAYOUTS[layout])
+    if config.has_section('LAYOUT'):
+        attributes.update(config['LAYOUT'])
+
     # use an ordered dictionary as foreign keys require the reference table to be created first
     create = OrderedDict()
 
     # staging tables in a raw format without any validation checks
+    # staging_events has the columns of the JSONPaths file used by COPY, see staging_events_columns
     create['staging_events'] = """
         CREATE TABLE {table} (
-            artist VARCHAR(256),
-            auth VARCHAR(256),
-            firstName VARCHAR(256),
-            gender VARCHAR(1),
-            itemInSession SMALLINT,
-            lastName VARCHAR(256),
-            length DOUBLE PRECISION,
-            level VARCHAR(4),
-            location VARCHAR(256),
-            method VARCHAR(3),
-            page VARCHAR(256),
-            registration BIGINT,
-            sessionId BIGINT,
-            song VARCHAR(256),
-            status SMALLINT,
-            ts BIGINT,
-            userAgent VARCHAR(256),
-            userId BIGINT
+""" + ',\n'.join(f'            {column} {datatype}' for column, datatype in staging_events_columns().items()) + """
         )
-    """
+        """ + attributes.get('staging_events', '')
     create['staging_songs'] = """
         CREATE TABLE {table} (
             song_id VARCHAR(18),
@@ -79,7 +114,38 @@ def create_syntax():
             artist_latitude DOUBLE PRECISION,
             artist_longitude DOUBLE PRECISION
         )
-    """
+        """ + attributes.get('staging_songs', '')
+
+    # staging data matched on song_key, a hash of the song columns, so the join of song plays to songs compares one
+    # integer on the same node instead of three columns moved between nodes
+    create['staging_songs_keyed'] = """
+        CREATE TABLE {table} (
+            song_key BIGINT,
+            song_id VARCHAR(18),
+            artist_id VARCHAR(18),
+            title VARCHAR(256),
+            year SMALLINT,
+            duration DOUBLE PRECISION,
+            artist_name VARCHAR(256),
+            artist_location VARCHAR(256),
+            artist_latitude DOUBLE PRECISION,
+            artist_longitude DOUBLE PRECISION
+        )
+        """ + attributes.get('staging_songs_keyed', '')
+    create['staging_events_keyed'] = """
+        CREATE TABLE {table} (
+            song_key BIGINT,
+            artist VARCHAR(256),
+            song VARCHAR(256),
+            length DOUBLE PRECISION,
+            ts BIGINT,
+            userId BIGINT,
+            level VARCHAR(4),
+            sessionId BIGINT,
+            location VARCHAR(256),
+            userAgent VARCHAR(256)
+        )
+        """ + attributes.get('staging_events_keyed', '')
 
     ## dimension tables, including a remark for primary key using Redshift SVV_COLUMNS system view
     create['users'] = """
@@ -90,7 +156,8 @@ def create_syntax():
             gender VARCHAR(1) NOT NULL,
             level VARCHAR(4) NOT NULL,
             PRIMARY KEY (user_id)
-        );
+        )
+        """ + attributes.get('users', '') + """;
         COMMENT ON COLUMN {table}.user_id is 'PRIMARY KEY';
     """
     create['songs'] = """
@@ -101,7 +168,8 @@ def create_syntax():
             year SMALLINT,
             duration DOUBLE PRECISION NOT NULL,
             PRIMARY KEY (song_id)
-        );
+        )
+        """ + attributes.get('songs', '') + """;
         COMMENT ON COLUMN {table}.song_id is 'PRIMARY KEY';
     """
     create['artists'] = """
@@ -112,12 +180,13 @@ def create_syntax():
             artist_latitude DOUBLE PRECISION,
             artist_longitude DOUBLE PRECISION,
             PRIMARY KEY (artist_id)
-        );
+        )
+        """ + attributes.get('artists', '') + """;
         COMMENT ON COLUMN {table}.artist_id is 'PRIMARY KEY';
     """
     create['time'] = """
         CREATE TABLE {table} (
-            start_time TIMESTAMP NOT NULL SORTKEY,
+            start_time TIMESTAMP NOT NULL,
             hour SMALLINT NOT NULL,
             day SMALLINT NOT NULL,
             week SMALLINT NOT NULL,
@@ -125,7 +194,8 @@ def create_syntax():
             year SMALLINT NOT NULL,
             weekday SMALLINT NOT NULL,
             PRIMARY KEY (start_time)
-        );
+        )
+        """ + attributes.get('time', '') + """;
         COMMENT ON COLUMN {table}.start_time is 'PRIMARY KEY';
     """
 
@@ -135,7 +205,7 @@ def create_syntax():
             songplay_id BIGINT IDENTITY(0,1),
             song_id VARCHAR(18),
             artist_id VARCHAR(18),
-            start_time TIMESTAMP NOT NULL SORTKEY,
+            start_time TIMESTAMP NOT NULL,
             user_id BIGINT NOT NULL,
             session_id BIGINT NOT NULL,
             level VARCHAR(4) NOT NULL,
@@ -146,22 +216,65 @@ def create_syntax():
             FOREIGN KEY (song_id) REFERENCES songs(song_id),
             FOREIGN KEY (artist_id) REFERENCES artists(artist_id),
             FOREIGN KEY (start_time) REFERENCES time(start_time)
-        );
+        )
+        """ + attributes.get('songplay', '') + """;
         COMMENT ON COLUMN {table}.songplay_id is 'PRIMARY KEY';
     """
 
+    ## latest staging_events ts merged into each table by an incremental load
+    create['etl_watermarks'] = """
+        CREATE TABLE {table} (
+            table_name VARCHAR(64) NOT NULL,
+            high_water BIGINT NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            PRIMARY KEY (table_name)
+        );
+        COMMENT ON COLUMN {table}.table_name is 'PRIMARY KEY';
+    """
+
+    for table, columns in (encodings or {}).items():
+        if table in create:
+            create[table] = encode_columns(create[table], columns)
+
     return create
 
-def copy_syntax():
+def encode_columns(query, encodings):
+    '''Add ENCODE column attributes to create table syntax.
+
+    Parameters
+    ----------
+    query (str) : create table syntax with one column definition per line
+    encodings (dict) : keys = column name in any case, values = compression encoding
+
+    Returns
+    -------
+    query (str) : create table syntax with the encoding placed after the column type and before any NOT NULL
+    '''
+
+    encodings = {column.lower(): encoding for column, encoding in encodings.items()}
+
+    def encode(match):
+        encoding = encodings.get(match['column'].lower())
+        if encoding is None:
+            return match[0]
+        return f"{match['definition']} ENCODE {encoding}{match['constraint'] or ''}{match['end']}"
+
+    column = re.compile(r'^(?P<definition>\s+(?P<column>\w+) [A-Z](?:[^,(\n]|\([^)\n]*\))*?)(?P<constraint> NOT NULL)?(?P<end>,?)$', re.MULTILINE)
+
+    return column.sub(encode, query)
+
+def copy_syntax(manifests=None):
     '''Generate syntax for copy data from S3 buckets to Redshift staging tables.
     
     Parameters
     ----------
-    None
+    manifests (dict) : keys = staging table name, values = list of S3 urls of COPY manifests from s3_manifest.py to load
+        instead of every file in the S3 bucket of the table
 
     Returns
     -------
-    copy (dict) : keys = tuple of (table_name, bucket_url), values = copy syntax
+    copy (dict) : keys = tuple of (table_name, bucket_url), values = copy syntax. If manifests are given bucket_url is the
+        url of each manifest, with tables without manifests left out.
     '''
 
     copy = {}
@@ -176,13 +289,13 @@ def copy_syntax():
     "MAXERROR 10",                              # skip errors such as String length exceeds DDL length
     "TRUNCATECOLUMNS"                           # trim long VARCHAR/CHAR columns to fit
     ]
-    query = '\n'.join(query)
     # add parameters except table and bucket that will be added during ETL for tracability
-    copy[(table, bucket)] = partial(
-        query.format,
-        iam_role = config['IAM_ROLE']['ARN'],
-        json_mapping=config['S3']['LOG_JSONPATH']   
-    )
+    for bucket, query in copy_sources(table, bucket, query, manifests):
+        copy[(table, bucket)] = partial(
+            query.format,
+            iam_role = config['IAM_ROLE']['ARN'],
+            json_mapping=config['S3'].get('STAGING_JSONPATH', config['S3']['LOG_JSONPATH'])
+        )
 
     table = 'staging_songs'
     bucket = config['S3']['SONG_DATA']
@@ -194,15 +307,217 @@ def copy_syntax():
     "MAXERROR 10",                              # skip errors such as String length exceeds DDL length
     "TRUNCATECOLUMNS"                           # trim long VARCHAR/CHAR columns to fit
     ]
-    query = '\n'.join(query)
+    # GZIP or ZSTD for the chunks written by compact_songs.py
+    if config['S3'].get('SONG_COMPRESSION'):
+        query.append(config['S3']['SONG_COMPRESSION'])
     # add parameters except table and bucket that will be added during ETL for tracability
-    copy[(table, bucket)] = partial(
-        query.format,
-        iam_role = config['IAM_ROLE']['ARN']
-    )
+    for bucket, query in copy_sources(table, bucket, query, manifests):
+        copy[(table, bucket)] = partial(
+            query.format,
+            iam_role = config['IAM_ROLE']['ARN']
+        )
 
     return copy
 
+def staging_events_columns(prune=None):
+    '''Generate the columns of staging_events, the single spec of both its create syntax and JSONPaths file.
+
+    Parameters
+    ----------
+    prune (bool) : keep only the log fields read by the insert, merge and key syntax, so COPY parses and stores fewer
+        fields, otherwise every field of log_json_path.json. Defaults to pruning when [S3] STAGING_JSONPATH of dwh.cfg
+        points to the JSONPaths file of the pruned columns written by jsonpaths.py.
+
+    Returns
+    -------
+    columns (OrderedDict) : keys = column name, values = column type, in the order of the JSONPaths file
+    '''
+
+    if prune is None:
+        prune = config.has_option('S3', 'STAGING_JSONPATH')
+    if not prune:
+        return OrderedDict(STAGING_EVENTS_COLUMNS)
+
+    # every word of the syntax reading staging_events, which may keep a field used only by another table
+    queries = list(insert_syntax().values()) + [song_key_check_syntax()]
+    queries += [query for queries in (*merge_syntax().values(), *key_syntax().values()) for query in queries]
+    words = set(re.findall(r'\w+', '\n'.join(queries).lower()))
+
+    return OrderedDict(
+        (column, datatype) for column, datatype in STAGING_EVENTS_COLUMNS.items() if column.lower() in words
+    )
+
+def copy_sources(table, bucket, query, manifests=None):
+    '''Pair the copy syntax of a table with the S3 bucket, or each manifest, to copy from.
+
+    Parameters
+    ----------
+    table (str) : staging table name
+    bucket (str) : url path to S3 bucket of the table such as 's3://udacity-dend/song-data'
+    query (list) : lines of the copy syntax
+    manifests (dict) : keys = staging table name, values = list of S3 urls of COPY manifests
+
+    Returns
+    -------
+    sources (list) : tuples of (bucket_url, copy syntax)
+    '''
+
+    if manifests is None:
+        return [(bucket, '\n'.join(query))]
+
+    # a manifest lists the exact files to load so Redshift does not list the bucket
+    query = '\n'.join(query + ["MANIFEST"])
+
+    return [(f"'{url}'", query) for url in manifests.get(table, [])]
+
+def song_key(artist, title, duration):
+    '''Generate syntax of the song match key, a 64-bit hash of the normalized artist name, title and duration.
+
+    Songs that are equal on the three columns always have the same key, so joining on the key as well as the three
+    columns matches the same songs. Different songs rarely share a key and are rejected by the three columns.
+
+    Parameters
+    ----------
+    artist (str) : artist name column
+    title (str) : song title column
+    duration (str) : song duration column in seconds
+
+    Returns
+    -------
+    key (str) : syntax of a BIGINT expression
+    '''
+
+    return (
+        f"FNV_HASH(LOWER(TRIM({artist})) || '|' || LOWER(TRIM({title})) || '|' || CAST(ROUND({duration}, 2) AS VARCHAR))"
+    )
+
+def time_columns(timestamp):
+    '''Generate syntax of each time table column from a song play timestamp.
+
+    The insert and merge of the time table both use these columns so they always agree. week is the week of the year and
+    weekday counts from Monday = 0 to Sunday = 6, the same as time_frame in data_modeling/postgres/time_dimension.py.
+    Time tables loaded before weekday counted from Monday are updated once by migrate_time_weekday.py.
+
+    Parameters
+    ----------
+    timestamp (str) : song play timestamp column
+
+    Returns
+    -------
+    columns (dict) : keys = time table column name, values = syntax of the column in table order
+    '''
+
+    return {
+        'start_time': timestamp,
+        'hour': f"EXTRACT(HOUR FROM {timestamp})",
+        'day': f"EXTRACT(DAY FROM {timestamp})",
+        'week': f"EXTRACT(WEEK FROM {timestamp})",
+        'month': f"EXTRACT(MONTH FROM {timestamp})",
+        'year': f"EXTRACT(YEAR FROM {timestamp})",
+        # DOW counts from Sunday = 0
+        'weekday': f"(EXTRACT(DOW FROM {timestamp}) + 6) % 7",
+    }
+
+def key_syntax():
+    '''Generate syntax to fill the keyed staging tables from the staging tables loaded by COPY.
+
+    COPY can't compute a column, so the key is added after each load by copying into tables distributed on the key.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    key (OrderedDict) : keys = keyed staging table name, values = list of syntax run in order
+    '''
+
+    key = OrderedDict()
+
+    key['staging_songs_keyed'] = ["TRUNCATE {table}", """
+    INSERT INTO {table}
+    SELECT
+        """ + song_key('artist_name', 'title', 'duration') + """ AS song_key,
+        song_id,
+        artist_id,
+        title,
+        year,
+        duration,
+        artist_name,
+        artist_location,
+        artist_latitude,
+        artist_longitude
+    FROM staging_songs
+    """]
+
+    # only song plays can match a song
+    key['staging_events_keyed'] = ["TRUNCATE {table}", """
+    INSERT INTO {table}
+    SELECT
+        """ + song_key('artist', 'song', 'length') + """ AS song_key,
+        artist,
+        song,
+        length,
+        ts,
+        userId,
+        level,
+        sessionId,
+        location,
+        userAgent
+    FROM staging_events
+    WHERE page = 'NextSong'
+    """]
+
+    return key
+
+def song_key_check_syntax():
+    '''Generate syntax comparing the song plays matched to songs using song_key with the three column join.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    check (str) : syntax returning one row of the matches of each join, matches missing from or added by the key join,
+        which should be 0, and key matches rejected by the three columns, such as differences in case
+    '''
+
+    return """
+    WITH _columns AS (
+        SELECT logs.ts, logs.userId, logs.sessionId, songs.song_id
+        FROM staging_events AS logs
+        JOIN staging_songs AS songs
+            ON songs.artist_name = logs.artist
+            AND songs.title = logs.song
+            AND songs.duration = logs.length
+        WHERE logs.page = 'NextSong'
+    ),
+    _keyed AS (
+        SELECT logs.ts, logs.userId, logs.sessionId, songs.song_id
+        FROM staging_events_keyed AS logs
+        JOIN staging_songs_keyed AS songs
+            ON songs.song_key = logs.song_key
+            AND songs.artist_name = logs.artist
+            AND songs.title = logs.song
+            AND songs.duration = logs.length
+    )
+    SELECT
+        (SELECT COUNT(*) FROM _columns) AS column_matches,
+        (SELECT COUNT(*) FROM _keyed) AS key_matches,
+        (SELECT COUNT(*) FROM (SELECT * FROM _columns EXCEPT SELECT * FROM _keyed)) AS missing,
+        (SELECT COUNT(*) FROM (SELECT * FROM _keyed EXCEPT SELECT * FROM _columns)) AS added,
+        (
+            SELECT COUNT(*)
+            FROM staging_events_keyed AS logs
+            JOIN staging_songs_keyed AS songs
+                ON songs.song_key = logs.song_key
+            WHERE songs.artist_name <> logs.artist
+            OR songs.title <> logs.song
+            OR songs.duration <> logs.length
+        ) AS rejected
+    """
+
 def insert_syntax():
     '''Generate syntax for insert data into fact and dimension tables from staging tables.
 
@@ -218,7 +533,8 @@ def insert_syntax():
     insert = {}
 
     # LEFT JOIN may produce NULL song_id and artist_id, but questions on user activity can still be answered
-    # NextSong designates an event associated with a song play
+    # staging_events_keyed only holds NextSong events, those associated with a song play
+    # song_key finds candidate songs on the same node, the original columns reject hash collisions
     insert['songplay'] = ("""
     INSERT INTO {table} (
         start_time, 
@@ -239,12 +555,12 @@ def insert_syntax():
         logs.sessionId AS session_id,
         logs.location,
         logs.userAgent AS user_agent
-    FROM staging_events AS logs
-    LEFT JOIN staging_songs AS songs
-        ON songs.artist_name = logs.artist
+    FROM staging_events_keyed AS logs
+    LEFT JOIN staging_songs_keyed AS songs
+        ON songs.song_key = logs.song_key
+        AND songs.artist_name = logs.artist
         AND songs.title = logs.song
         AND songs.duration = logs.length
-    WHERE logs.page = 'NextSong'
     """)
 
     # unique user data by last played song (ex: level may change from "free" to "paid")
@@ -264,13 +580,13 @@ def insert_syntax():
             gender,
             level,
             RANK() OVER (
-                PARTITION BY user_id
+                PARTITION BY userId
                 ORDER BY ts DESC NULLS LAST
             ) AS _latest        
         FROM
             staging_events
         WHERE
-            user_id IS NOT NULL
+            userId IS NOT NULL
     ) WHERE _latest = 1
     """)
 
@@ -321,9 +637,10 @@ def insert_syntax():
                 PARTITION BY staging_songs.artist_id
                 ORDER BY staging_songs.year DESC, staging_events.ts DESC
             ) AS _latest
-        FROM staging_songs
-        LEFT JOIN staging_events
-            ON staging_songs.artist_name = staging_events.artist
+        FROM staging_songs_keyed AS staging_songs
+        LEFT JOIN staging_events_keyed AS staging_events
+            ON staging_songs.song_key = staging_events.song_key
+            AND staging_songs.artist_name = staging_events.artist
             AND staging_songs.title = staging_events.song
             AND staging_songs.duration = staging_events.length
     )
@@ -343,13 +660,7 @@ def insert_syntax():
         weekday
     )
     SELECT 
-        _timestamp, 
-        EXTRACT(HOUR FROM _timestamp), 
-        EXTRACT(DAY FROM _timestamp), 
-        EXTRACT(WEEK FROM _timestamp), 
-        EXTRACT(MONTH FROM _timestamp), 
-        EXTRACT(YEAR FROM _timestamp), 
-        EXTRACT(WEEKDAY FROM _timestamp)
+        """ + ', \n        '.join(time_columns('_timestamp').values()) + """
     FROM ( 
         SELECT DISTINCT
             (TIMESTAMP 'epoch' + ts/1000 * INTERVAL '1 Second ') as _timestamp
@@ -360,4 +671,204 @@ def insert_syntax():
     )
     """)
 
-    return insert
\ No newline at end of file
+    return insert
+
+def insert_dependencies(incremental=False):
+    '''Generate the tables each insert depends on, so fact tables are inserted after the dimension tables their
+    foreign keys reference.
+
+    The merges of merge_syntax that advance a high-water mark all write etl_watermarks, and Redshift aborts one of two
+    such transactions committing at the same time with a serializable isolation violation (error 1023). With
+    incremental they are chained so that only one of them runs at a time.
+
+    Parameters
+    ----------
+    incremental (bool) : dependencies of merge_syntax instead of insert_syntax
+
+    Returns
+    -------
+    dependencies (dict) : keys = table name from insert_syntax, values = list of table names to insert first
+    '''
+
+    dependencies = {'songplay': ['users', 'songs', 'artists', 'time']}
+    if incremental:
+        # users, then time, then songplay, which already waits for both
+        dependencies['time'] = ['users']
+
+    return dependencies
+
+def merge_syntax():
+    '''Generate syntax to incrementally merge new staging data into fact and dimension tables.
+
+    Each table reading staging_events keeps a high-water mark in etl_watermarks of the latest ts merged, so only later
+    events are read and the work of a daily load does not grow with the tables. Dimension records are merged using
+    delete-then-insert on their primary key, so changes such as a new user level replace the previous record instead of
+    duplicating the key. songs and artists are merged for every staged song, so stage only new song files such as with
+    s3_manifest.py. The statements of a table are run in one transaction, which also advances its high-water mark, so
+    run the merges in the order of insert_dependencies(incremental=True).
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    merge (dict) : keys = table name, values = list of syntax run in order
+    '''
+
+    merge = {}
+
+    # ts of the latest event merged into a table, 0 before the first load
+    watermark = "(SELECT COALESCE(MAX(high_water), 0) FROM etl_watermarks WHERE table_name = '{table}')"
+
+    # record the latest staged event, then remove the previous high-water mark
+    advance = [
+        """
+        INSERT INTO etl_watermarks (table_name, high_water, updated_at)
+        SELECT '{table}', MAX(ts), GETDATE()
+        FROM staging_events
+        HAVING MAX(ts) > """ + watermark,
+        """
+        DELETE FROM etl_watermarks
+        WHERE table_name = '{table}'
+        AND high_water < """ + watermark,
+    ]
+
+    # new song plays only, finding songs in the merged dimension tables rather than only the staged songs
+    merge['songplay'] = ["""
+    INSERT INTO {table} (
+        start_time, 
+        user_id, 
+        level, 
+        song_id, 
+        artist_id, 
+        session_id, 
+        location, 
+        user_agent
+    )
+    SELECT
+        (TIMESTAMP 'epoch' + logs.ts/1000 * INTERVAL '1 Second ') AS start_time,
+        logs.userId AS user_id,
+        logs.level,
+        known.song_id,
+        known.artist_id,
+        logs.sessionId AS session_id,
+        logs.location,
+        logs.userAgent AS user_agent
+    FROM staging_events AS logs
+    LEFT JOIN (
+        SELECT songs.song_id, songs.artist_id, songs.title, songs.duration, artists.artist_name
+        FROM songs
+        JOIN artists ON artists.artist_id = songs.artist_id
+    ) AS known
+        ON known.artist_name = logs.artist
+        AND known.title = logs.song
+        AND known.duration = logs.length
+    WHERE logs.page = 'NextSong'
+    AND logs.ts > """ + watermark] + advance
+
+    # last level of each user with new events replaces their previous record
+    merge['users'] = ["""
+    CREATE TEMP TABLE users_merge AS
+    SELECT
+        user_id,
+        first_name,
+        last_name,
+        gender,
+        level
+    FROM (
+        SELECT
+            userId AS user_id,
+            firstName AS first_name,
+            lastName AS last_name,
+            gender,
+            level,
+            RANK() OVER (
+                PARTITION BY userId
+                ORDER BY ts DESC NULLS LAST
+            ) AS _latest        
+        FROM
+            staging_events
+        WHERE
+            userId IS NOT NULL
+            AND ts > """ + watermark + """
+    ) WHERE _latest = 1
+    """,
+    "DELETE FROM {table} USING users_merge WHERE {table}.user_id = users_merge.user_id",
+    "INSERT INTO {table} SELECT user_id, first_name, last_name, gender, level FROM users_merge",
+    "DROP TABLE users_merge",
+    ] + advance
+
+    # staged songs replace any previous record of the song
+    merge['songs'] = ["""
+    CREATE TEMP TABLE songs_merge AS
+    SELECT
+        song_id,
+        MAX(title) AS title,
+        MAX(artist_id) AS artist_id,
+        MAX(year) AS year,
+        MAX(duration) as duration
+    FROM
+        staging_songs
+    GROUP BY song_id
+    """,
+    "DELETE FROM {table} USING songs_merge WHERE {table}.song_id = songs_merge.song_id",
+    "INSERT INTO {table} SELECT song_id, title, artist_id, year, duration FROM songs_merge",
+    "DROP TABLE songs_merge",
+    ]
+
+    # staged artists replace any previous record of the artist, deduplicated like insert_syntax
+    merge['artists'] = ["""
+    CREATE TEMP TABLE artists_merge AS
+    SELECT
+        artist_id,
+        artist_name,
+        artist_location,
+        artist_latitude,
+        artist_longitude
+    FROM (
+        SELECT
+            staging_songs.artist_id,
+            staging_songs.artist_name,
+            staging_songs.artist_location,
+            staging_songs.artist_latitude,
+            staging_songs.artist_longitude,
+            ROW_NUMBER() OVER (
+                PARTITION BY staging_songs.artist_id
+                ORDER BY staging_songs.year DESC, staging_events.ts DESC
+            ) AS _latest
+        FROM staging_songs_keyed AS staging_songs
+        LEFT JOIN staging_events_keyed AS staging_events
+            ON staging_songs.song_key = staging_events.song_key
+            AND staging_songs.artist_name = staging_events.artist
+            AND staging_songs.title = staging_events.song
+            AND staging_songs.duration = staging_events.length
+    )
+    WHERE _latest = 1
+    """,
+    "DELETE FROM {table} USING artists_merge WHERE {table}.artist_id = artists_merge.artist_id",
+    "INSERT INTO {table} SELECT artist_id, artist_name, artist_location, artist_latitude, artist_longitude FROM artists_merge",
+    "DROP TABLE artists_merge",
+    ]
+
+    # times of new song plays, replacing times already loaded by an earlier event with the same timestamp
+    merge['time'] = ["""
+    CREATE TEMP TABLE time_merge AS
+    SELECT 
+        """ + ', \n        '.join(f'{syntax} AS {column}' for column, syntax in time_columns('_timestamp').items()) + """
+    FROM ( 
+        SELECT DISTINCT
+            (TIMESTAMP 'epoch' + ts/1000 * INTERVAL '1 Second ') as _timestamp
+        FROM 
+            staging_events
+        WHERE 
+            page = 'NextSong'
+            AND ts > """ + watermark + """
+    )
+    """,
+    "DELETE FROM {table} USING time_merge WHERE {table}.start_time = time_merge.start_time",
+    "INSERT INTO {table} (start_time, hour, day, week, month, year, weekday) SELECT * FROM time_merge",
+    "DROP TABLE time_merge",
+    ] + advance
+
+    return merge
@@ -0,0 +1,104 @@
+'''Compact song files from a local directory and check the chunks written.'''
+
+import gzip
+import json
+
+import pytest
+
+import metrics
+from compact_songs import compact, local_objects, json_records, clear_chunks
+
+
+def song(number):
+    return {'num_songs': 1, 'artist_id': f'AR{number:016d}', 'song_id': f'SO{number:016d}', 'title': f'Song {number}',
+        'duration': 100.0 + number, 'year': 2000}
+
+
+def write_songs(directory, songs, invalid=()):
+    for number in songs:
+        folder = directory / 'song_data' / 'A' / str(number % 3)
+        folder.mkdir(parents=True, exist_ok=True)
+        # pretty printed like some of the source files
+        (folder / f'TR{number:04d}.json').write_text(json.dumps(song(number), indent=4))
+    for name in invalid:
+        (directory / 'song_data' / f'{name}.json').write_text('{"song_id": ')
+
+
+def run_compact(directory, **options):
+    metrics.start('test')
+    chunks = {}
+
+    def read(key):
+        with open(key, 'rb') as fh:
+            return fh.read()
+
+    def write(name, body):
+        chunks[name] = body
+
+    report = compact(local_objects(str(directory / 'song_data')), read, write, threads=2, **options)
+    records = {name: [json.loads(line) for line in gzip.decompress(body).decode('utf-8').splitlines()]
+        for name, body in chunks.items()}
+
+    return report, records
+
+
+def test_chunks_are_a_multiple_of_slices(tmp_path):
+    write_songs(tmp_path, range(10))
+
+    report, records = run_compact(tmp_path, slices=4)
+
+    assert sorted(records) == [f'song_data_{number:04d}.json.gz' for number in range(4)]
+    assert report['files_out'] == 4 and report['slice_multiple']
+    assert report['records'] == 10 and report['skipped'] == []
+    assert sorted(record['song_id'] for chunk in records.values() for record in chunk) == [song(n)['song_id'] for n in range(10)]
+    # balanced by bytes, so no chunk has more than one extra file
+    assert {len(chunk) for chunk in records.values()} <= {2, 3}
+
+
+def test_fewer_files_than_slices_is_reported(tmp_path):
+    write_songs(tmp_path, range(3))
+
+    report, records = run_compact(tmp_path, slices=4)
+
+    assert len(records) == 3
+    assert report['files_out'] == 3
+    assert not report['slice_multiple']
+
+
+def test_group_of_invalid_files_writes_no_chunk(tmp_path):
+    write_songs(tmp_path, [1], invalid=['broken'])
+
+    report, records = run_compact(tmp_path, slices=2)
+
+    assert records == {'song_data_0000.json.gz': [song(1)]}
+    assert report['skipped'] == [str(tmp_path / 'song_data' / 'broken.json')]
+    assert report['files_in'] == 2 and report['files_out'] == 1 and report['records'] == 1
+    assert not report['slice_multiple']
+
+
+def test_files_with_several_records_keep_every_record(tmp_path):
+    folder = tmp_path / 'song_data'
+    folder.mkdir()
+    (folder / 'lines.json').write_text(''.join(json.dumps(song(number)) + '\n' for number in range(3)))
+    (folder / 'pretty.json').write_text('\n'.join(json.dumps(song(number), indent=4) for number in range(3, 5)))
+
+    report, records = run_compact(tmp_path, slices=1)
+
+    assert [record['song_id'] for record in records['song_data_0000.json.gz']] == [song(n)['song_id'] for n in range(5)]
+    assert report['records'] == 5 and report['skipped'] == []
+
+
+def test_json_records():
+    assert json_records(b' {"a": 1}{"a": 2}\n\n{\n  "a": 3\n}\n') == [{'a': 1}, {'a': 2}, {'a': 3}]
+    assert json_records(b'\n') == []
+    with pytest.raises(ValueError):
+        json_records(b'{"a": 1}\n{"a": ')
+
+
+def test_clear_chunks_removes_only_chunks():
+    names = ['song_data_0000.json.gz', 'song_data_0007.json.zst', 'song_data_manifest.json', 'readme.txt',
+        'A/song_data_0001.json.gz']
+    removed = []
+
+    assert clear_chunks(names, removed.append) == ['song_data_0000.json.gz', 'song_data_0007.json.zst']
+    assert removed == ['song_data_0000.json.gz', 'song_data_0007.json.zst']
@@ -0,0 +1,87 @@
+'''Run the compression advisor on recorded ANALYZE COMPRESSION output and check the encodings and savings.'''
+
+import os
+
+import psycopg2
+import pytest
+
+from compression_advisor import advise, dashboard_scans, project_savings, recorded_compression
+from sql_queries import create_syntax
+
+RECORDED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_compression.json')
+
+QUERIES = {
+    'play_trend': 'SELECT time.day, MIN(weekday) FROM songplay LEFT JOIN time ON time.start_time = songplay.start_time',
+    'play_level': 'SELECT level, COUNT(*) FROM songplay GROUP BY level',
+}
+
+
+def test_encodings_of_recorded_tables():
+    recorded, encodings, savings = advise(['time', 'songplay', 'users'], recorded_compression(RECORDED), dashboard_scans(QUERIES))
+
+    # users was not recorded so it is skipped
+    assert list(recorded) == ['time', 'songplay']
+    assert encodings == {
+        'time': {'start_time': 'raw', 'hour': 'az64', 'day': 'az64', 'weekday': 'zstd'},
+        'songplay': {'songplay_id': 'az64', 'level': 'bytedict', 'user_agent': 'zstd'},
+    }
+    assert len(savings) == 7
+
+
+def test_encodings_apply_to_create_syntax():
+    _, encodings, _ = advise(['time', 'songplay'], recorded_compression(RECORDED), dashboard_scans(QUERIES))
+
+    create = create_syntax(encodings=encodings)
+
+    assert 'start_time TIMESTAMP ENCODE raw NOT NULL,' in create['time']
+    assert 'hour SMALLINT ENCODE az64 NOT NULL,' in create['time']
+    assert 'weekday SMALLINT ENCODE zstd NOT NULL,' in create['time']
+    assert 'songplay_id BIGINT IDENTITY(0,1) ENCODE az64,' in create['songplay']
+    assert 'level VARCHAR(4) ENCODE bytedict NOT NULL,' in create['songplay']
+    assert 'user_agent VARCHAR(256) ENCODE zstd NOT NULL,' in create['songplay']
+    # columns without a recorded encoding keep the default
+    assert 'month SMALLINT NOT NULL,' in create['time']
+    assert 'ENCODE' not in create['users']
+
+
+def test_project_savings():
+    columns = recorded_compression(RECORDED)('songplay')
+
+    savings = project_savings('songplay', columns, dashboard_scans(QUERIES))
+
+    assert savings == [
+        {'table': 'songplay', 'column': 'songplay_id', 'encoding': 'az64', 'est_reduction_pct': 40.0, 'size_mb': 10,
+            'saved_mb': 4.0, 'dashboard_scans': 0, 'scan_saved_mb': 0.0},
+        {'table': 'songplay', 'column': 'level', 'encoding': 'bytedict', 'est_reduction_pct': 75.0, 'size_mb': 20,
+            'saved_mb': 15.0, 'dashboard_scans': 1, 'scan_saved_mb': 15.0},
+        {'table': 'songplay', 'column': 'user_agent', 'encoding': 'zstd', 'est_reduction_pct': 90.0, 'size_mb': 30,
+            'saved_mb': 27.0, 'dashboard_scans': 0, 'scan_saved_mb': 0.0},
+    ]
+
+
+def test_dashboard_scans_match_table_and_column():
+    scans = dashboard_scans(QUERIES)
+
+    assert scans('time', 'weekday') == 1
+    assert scans('songplay', 'start_time') == 1
+    assert scans('songplay', 'level') == 1
+    assert scans('users', 'level') == 0
+
+
+def test_database_errors_skip_the_table():
+    def analyze(table):
+        if table == 'users':
+            raise psycopg2.ProgrammingError('relation "users" does not exist')
+        return recorded_compression(RECORDED)(table)
+
+    recorded, _, _ = advise(['users', 'time'], analyze, dashboard_scans(QUERIES))
+
+    assert list(recorded) == ['time']
+
+
+def test_other_errors_are_raised():
+    def analyze(table):
+        raise TypeError('unexpected output')
+
+    with pytest.raises(TypeError):
+        advise(['time'], analyze, dashboard_scans(QUERIES))
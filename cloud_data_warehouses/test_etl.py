@@ -7,6 +7,8 @@ from numpy import character
 import psycopg2
 import pandas as pd
 import warnings
+from sql_queries import song_key_check_syntax
+from local_postgres import connection
 
 class PossibleCopyStringTruncation(Warning):
     '''Warn for strings that were possibly truncated during the copy from S3 to Redshift.'''
@@ -16,6 +18,10 @@ class DuplicatedPrimaryKey(Warning):
     '''Warn for Redshift table containing a duplicated primary key value.'''
     pass
 
+class SongKeyMismatch(Warning):
+    '''Warn for song plays matched differently by song_key than by the artist, title and duration join.'''
+    pass
+
 def get_schema(conn, db_name):
     '''Get table schema from Redshift to perform checks against.'''
 
@@ -65,7 +71,7 @@ def check_contents(schema_staging, schema_main, conn):
         SUM(CASE WHEN LEN({column})={len} THEN 1 ELSE 0 END)/CAST(COUNT({column}) AS FLOAT)*100 AS col_percent,
         {len} AS character_maximum_length
     FROM {table}
-    HAVING col_percent>0
+    HAVING SUM(CASE WHEN LEN({column})={len} THEN 1 ELSE 0 END)>0
     '''
     query = []
     for _,row in strings.iterrows():
@@ -108,19 +114,30 @@ def check_contents(schema_staging, schema_main, conn):
         print('Tables contain no duplicated primary key values.')
     print('Record count for each non-staging table: {size}'.format(size=contents['length'].to_dict()))
 
+def check_song_keys(conn):
+    '''Verify song plays match the same songs joining the keyed staging tables on song_key as joining the
+    staging tables on artist, title and duration.'''
+
+    check = pd.read_sql_query(song_key_check_syntax(), conn).iloc[0]
+    if check['missing']>0 or check['added']>0:
+        msg = '''Song plays matched using song_key differ from the artist, title and duration join.
+        '''
+        msg += check.to_string()
+        warnings.warn(msg, SongKeyMismatch)
+    else:
+        print(f"Song plays matched using song_key are identical to the artist, title and duration join "
+            f"({check['key_matches']} matches, {check['rejected']} key matches rejected by the columns).")
+
 if __name__ == "__main__":
     
     # connect to database
     config = configparser.ConfigParser()
     config.optionxform = str
     config.read('dwh.cfg')
-    config = dict(config.items('CLUSTER'))
+    config, connect = connection(config)
 
-    conn = psycopg2.connect(f"""
-        host={config['HOST']} dbname={config['DB_NAME']} 
-        user={config['DB_USER']} password={config['DB_PASSWORD']} 
-        port={config['DB_PORT']}"""
-    )
+    conn = psycopg2.connect(**connect)
 
     schema_staging, schema_main = get_schema(conn, db_name=config['DB_NAME'])
-    check_contents(schema_staging, schema_main, conn)
\ No newline at end of file
+    check_contents(schema_staging, schema_main, conn)
+    check_song_keys(conn)
\ No newline at end of file
@@ -0,0 +1,78 @@
+'''Run the explain advisor on recorded plans and check which queries are flagged.'''
+
+import os
+
+import psycopg2
+import pytest
+
+from explain_advisor import advise, recorded_plans, dashboard_queries, insert_queries
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PLANS = os.path.join(HERE, 'test_explain_plans.json')
+
+
+def test_flags_broadcast_and_redistributed_joins():
+    queries = {name: '' for name in ('dashboard.play_trend', 'dashboard.play_hour', 'dashboard.user_level', 'insert.songplay')}
+
+    plans, report = advise(queries, recorded_plans(PLANS))
+
+    assert {name: [step['attribute'] for step in steps] for name, steps in report.items()} == {
+        'dashboard.play_trend': ['DS_BCAST_INNER'],
+        'dashboard.play_hour': [],
+        'dashboard.user_level': [],
+        'insert.songplay': ['DS_DIST_BOTH'],
+    }
+    assert all(plans[name] for name in queries)
+
+
+def test_flagged_step_details():
+    _, report = advise({'dashboard.play_trend': '', 'insert.songplay': ''}, recorded_plans(PLANS))
+
+    broadcast, = report['dashboard.play_trend']
+    assert broadcast['operation'] == 'Hash Left Join'
+    assert broadcast['cost'] == 3179548.10
+    assert broadcast['rows'] == 8032
+    assert broadcast['condition'] == '("outer".start_time = "inner".start_time)'
+    assert broadcast['tables'] == ['songplay', 'time']
+    assert 'DISTSTYLE ALL' in broadcast['advice']
+
+    redistributed, = report['insert.songplay']
+    assert redistributed['operation'] == 'Hash Right Join'
+    assert redistributed['condition'].startswith('(("outer".song_key = "inner".song_key)')
+    assert redistributed['tables'] == ['staging_songs_keyed', 'staging_events_keyed']
+
+
+def test_query_without_recorded_plan_is_skipped():
+    plans, report = advise({'dashboard.play_location': ''}, recorded_plans(PLANS))
+
+    assert plans == {'dashboard.play_location': None}
+    assert report == {}
+
+
+def test_recorded_plans_name_real_queries():
+    queries = {**dashboard_queries(os.path.join(HERE, 'dashboard.py'), os.path.join(HERE, 'user_levels.pgsql')), **insert_queries()}
+
+    plans, _ = advise(queries, recorded_plans(PLANS))
+
+    assert {name for name, plan in plans.items() if plan} == {
+        'dashboard.play_trend', 'dashboard.play_hour', 'dashboard.user_level', 'insert.songplay'}
+
+
+def test_database_errors_skip_the_query():
+    def explain(name, query):
+        if name == 'dashboard.play_hour':
+            raise psycopg2.ProgrammingError('relation "time" does not exist')
+        return recorded_plans(PLANS)(name, query)
+
+    plans, report = advise({'dashboard.play_hour': '', 'insert.songplay': ''}, explain)
+
+    assert plans['dashboard.play_hour'] is None
+    assert list(report) == ['insert.songplay']
+
+
+def test_other_errors_are_raised():
+    def explain(name, query):
+        raise TypeError('unexpected plan')
+
+    with pytest.raises(TypeError):
+        advise({'insert.songplay': ''}, explain)
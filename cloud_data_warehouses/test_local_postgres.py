@@ -0,0 +1,158 @@
+'''Check the Redshift dialect shim: rewritten syntax, COPY options, value conversion and reading the copied files.'''
+
+import json
+
+import psycopg2
+import pytest
+
+from local_postgres import rewrite, copy_options, convert, read_records, source_files, jsonpath_keys
+
+SONGPLAY = '''
+    CREATE TABLE IF NOT EXISTS songplay (
+        songplay_id BIGINT IDENTITY(0,1) ENCODE az64,
+        start_time TIMESTAMP NOT NULL,
+        user_id SMALLINT ENCODE az64 NOT NULL,
+        level VARCHAR(4) NOT NULL,
+        PRIMARY KEY (songplay_id),
+        FOREIGN KEY (user_id) REFERENCES users(user_id)
+    )
+    DISTSTYLE KEY DISTKEY (user_id) COMPOUND SORTKEY (start_time, user_id);
+'''
+
+
+def test_rewrite_create_table():
+    query = rewrite(SONGPLAY)
+
+    assert 'songplay_id BIGINT GENERATED BY DEFAULT AS IDENTITY (START WITH 0 MINVALUE 0 INCREMENT BY 1),' in query
+    assert query.rstrip().endswith('CREATE INDEX songplay_sortkey ON songplay (start_time, user_id)')
+    for redshift in ('ENCODE', 'DISTKEY', 'DISTSTYLE', 'PRIMARY KEY', 'FOREIGN KEY', 'REFERENCES', 'COMPOUND'):
+        assert redshift not in query
+    assert 'user_id SMALLINT NOT NULL' in query
+
+
+def test_rewrite_weekday_and_other_queries():
+    assert rewrite('SELECT EXTRACT(WEEKDAY FROM start_time) FROM time') == 'SELECT EXTRACT(DOW FROM start_time) FROM time'
+    assert rewrite('SELECT COUNT(*) FROM songplay') == 'SELECT COUNT(*) FROM songplay'
+    # SORTKEY AUTO leaves no index
+    assert 'INDEX' not in rewrite('CREATE TABLE users (user_id INTEGER) DISTSTYLE ALL SORTKEY AUTO')
+
+
+def test_copy_options():
+    options = copy_options('''COPY staging_songs FROM 's3://bucket/manifests/gzip_songs.manifest'
+        CREDENTIALS 'aws_iam_role=arn:aws:iam::1:role/TRUNCATECOLUMNS'
+        COMPUPDATE OFF
+        FORMAT AS JSON 's3://bucket/log_json_path.json'
+        MAXERROR AS 10
+        ACCEPTINVCHARS
+        MANIFEST''')
+
+    assert options == {
+        'table': 'staging_songs', 'source': 's3://bucket/manifests/gzip_songs.manifest',
+        'mapping': 's3://bucket/log_json_path.json', 'maxerror': 10,
+        # flags named in the quoted source or credentials are not set
+        'truncatecolumns': False, 'acceptinvchars': True, 'manifest': True, 'gzip': False, 'zstd': False, 'bzip2': False,
+    }
+
+
+def test_copy_options_defaults():
+    options = copy_options("COPY staging_songs FROM 's3://bucket/song_data' FORMAT JSON 'auto ignorecase' TRUNCATECOLUMNS GZIP")
+
+    assert options['mapping'] == 'auto ignorecase' and options['maxerror'] == 0
+    assert options['truncatecolumns'] and options['gzip'] and not options['manifest']
+    assert copy_options("COPY staging_songs FROM 's3://bucket/song_data'")['mapping'] == 'auto'
+    assert copy_options('SELECT 1') is None
+
+
+VARCHAR = {'column_name': 'title', 'data_type': 'character varying', 'character_maximum_length': 4}
+SMALLINT = {'column_name': 'year', 'data_type': 'smallint', 'character_maximum_length': None}
+DOUBLE = {'column_name': 'duration', 'data_type': 'double precision', 'character_maximum_length': None}
+
+
+@pytest.mark.parametrize('value, column, err_code', [
+    ('title', VARCHAR, 1204),
+    # lengths are in bytes
+    ('café', VARCHAR, 1204),
+    ('20x0', SMALLINT, 1207),
+    (1.5, SMALLINT, 1207),
+    (True, SMALLINT, 1207),
+    (2**15, SMALLINT, 1216),
+    ('caf\udce9', VARCHAR, 1220),
+    ('long', DOUBLE, 1208),
+])
+def test_convert_rejects(value, column, err_code):
+    with pytest.raises(ValueError) as error:
+        convert(value, column)
+
+    assert error.value.args[0] == err_code
+
+
+def test_convert_loads():
+    assert convert('title', VARCHAR, truncate=True) == 'titl'
+    assert convert('café', VARCHAR, truncate=True) == 'caf'
+    assert convert('caf\udce9', VARCHAR, accept_invchars=True) == 'caf?'
+    assert convert(1540919166796.0, {**SMALLINT, 'data_type': 'bigint'}) == 1540919166796
+    assert convert(' 2018 ', SMALLINT) == 2018
+    assert convert('', SMALLINT) is None
+    assert convert('218.93', DOUBLE) == 218.93
+    assert convert(None, VARCHAR) is None
+    assert convert({'a': 1}, {**VARCHAR, 'character_maximum_length': None}) == '{"a": 1}'
+
+
+def test_read_records_line_numbers():
+    data = (json.dumps({'n': 1}) + '\n\n' + json.dumps({'n': 2}, indent=1) + '\n' + json.dumps({'n': 3})).encode('utf-8')
+
+    assert list(read_records(data)) == [(1, {'n': 1}), (5, {'n': 2}), (6, {'n': 3})]
+
+
+def test_read_records_stop_at_invalid_json():
+    records = list(read_records(b'{"n": 1}\n{"n": x}\n{"n": 3}\n'))
+
+    assert records[0] == (1, {'n': 1})
+    line, error = records[1]
+    assert line == 2 and isinstance(error, json.JSONDecodeError)
+    assert len(records) == 2
+    assert list(read_records(b' \n')) == []
+
+
+@pytest.fixture
+def s3_root(tmp_path):
+    for key in ('bucket/song_data/A/a.json', 'bucket/song_data/B/b.json', 'bucket/song_data_old/c.json',
+            'bucket/log_data/2018-11-01-events.json', 'bucket/log_data/2018-11-02-events.json'):
+        path = tmp_path / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text('{}')
+
+    return str(tmp_path)
+
+
+def test_source_files_by_prefix(s3_root):
+    files = source_files(copy_options("COPY staging_songs FROM 's3://bucket/song_data'"), s3_root)
+
+    # keys are matched on their prefix like S3, so song_data_old is copied too
+    assert [url for url, _ in files] == [
+        's3://bucket/song_data/A/a.json', 's3://bucket/song_data/B/b.json', 's3://bucket/song_data_old/c.json']
+    assert [url for url, _ in source_files(copy_options("COPY staging_events FROM 's3://bucket/log_data/2018-11-02'"),
+        s3_root)] == ['s3://bucket/log_data/2018-11-02-events.json']
+
+
+def test_source_files_of_manifest(s3_root, tmp_path):
+    entries = [
+        {'url': 's3://bucket/song_data/B/b.json', 'mandatory': True},
+        {'url': 's3://bucket/song_data/C/missing.json', 'mandatory': False},
+    ]
+    (tmp_path / 'bucket' / 'songs.manifest').write_text(json.dumps({'entries': entries}))
+    options = copy_options("COPY staging_songs FROM 's3://bucket/songs.manifest' MANIFEST")
+
+    assert source_files(options, s3_root) == [('s3://bucket/song_data/B/b.json', str(tmp_path / 'bucket/song_data/B/b.json'))]
+
+    entries[1]['mandatory'] = True
+    (tmp_path / 'bucket' / 'songs.manifest').write_text(json.dumps({'entries': entries}))
+    with pytest.raises(psycopg2.DataError):
+        source_files(options, s3_root)
+
+
+def test_jsonpath_keys():
+    assert jsonpath_keys("$['artist']") == ['artist']
+    assert jsonpath_keys('$["first name"]') == ['first name']
+    assert jsonpath_keys('$.song.title[0]') == ['song', 'title', 0]
+    assert jsonpath_keys("$['tags'][2]['name']") == ['tags', 2, 'name']
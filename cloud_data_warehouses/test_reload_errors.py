@@ -0,0 +1,90 @@
+'''Find rejected records and write a repair file and manifest against an in-memory stand-in for S3.'''
+
+import gzip
+import json
+
+from reload_errors import rejected_records, write_repair, query_errors
+
+SONGS = [{'song_id': f'SO{number}', 'title': f'Song {number}'} for number in range(4)]
+
+
+def test_rejected_records_by_last_line_of_record():
+    # one record per line, then records spanning 4 lines each
+    data = '\n'.join(json.dumps(song) for song in SONGS[:2]) + '\n' + '\n'.join(json.dumps(song, indent=1) for song in SONGS[2:])
+
+    records, raw = rejected_records(data.encode('utf-8'), {2, 10})
+
+    assert records == [SONGS[1], SONGS[3]]
+    assert [json.loads(line) for line in raw] == records
+    assert rejected_records(data.encode('utf-8'))[0] == SONGS
+
+
+def test_rejected_records_keep_invalid_utf8():
+    records, raw = rejected_records(b'{"title": "caf\xe9"}\n', {1})
+
+    assert records == [{'title': 'caf\udce9'}]
+    assert raw[0].encode('utf-8', errors='surrogateescape') == b'{"title": "caf\xe9"}'
+
+
+def test_write_repair_copies_rejected_records_into_one_file():
+    files = {
+        's3://source/song_data/A.json': '\n'.join(json.dumps(song) for song in SONGS[:2]).encode('utf-8'),
+        's3://source/song_data/B.json.gz': gzip.compress('\n'.join(json.dumps(song) for song in SONGS[2:]).encode('utf-8')),
+    }
+    written = {}
+    errors = [
+        {'filename': 's3://source/song_data/A.json', 'colname': 'title', 'err_code': 1204, 'line_number': 2},
+        # line numbers not recorded, so every record of the file is reloaded
+        {'filename': 's3://source/song_data/B.json.gz', 'colname': 'title', 'err_code': 1204, 'line_number': None},
+    ]
+
+    manifest_url, records = write_repair('staging_songs', errors, files.__getitem__, written.__setitem__, 's3://repair/fix/')
+
+    assert manifest_url == 's3://repair/fix/staging_songs_repair.json.manifest'
+    assert records == SONGS[1:]
+    body = written['s3://repair/fix/staging_songs_repair.json']
+    assert [json.loads(line) for line in body.decode('utf-8').splitlines()] == SONGS[1:]
+    assert json.loads(written[manifest_url]) == {'entries': [{
+        'url': 's3://repair/fix/staging_songs_repair.json', 'mandatory': True, 'meta': {'content_length': len(body)}}]}
+
+
+def test_write_repair_compresses_like_the_table_copy():
+    files = {'s3://source/song_data/A.json': json.dumps(SONGS[0]).encode('utf-8')}
+    written = {}
+    errors = [{'filename': 's3://source/song_data/A.json', 'colname': 'title', 'err_code': 1204, 'line_number': 1}]
+
+    write_repair('staging_songs', errors, files.__getitem__, written.__setitem__, 's3://repair/', compression='GZIP')
+
+    assert json.loads(gzip.decompress(written['s3://repair/staging_songs_repair.json'])) == SONGS[0]
+
+
+def test_write_repair_without_records_writes_nothing():
+    files = {'s3://source/song_data/A.json': json.dumps(SONGS[0]).encode('utf-8')}
+    written = {}
+    errors = [{'filename': 's3://source/song_data/A.json', 'colname': 'title', 'err_code': 1204, 'line_number': 5}]
+
+    assert write_repair('staging_songs', errors, files.__getitem__, written.__setitem__, 's3://repair/') == (None, [])
+    assert written == {}
+
+
+class ErrorsCursor:
+    '''Cursor recording the executed query and returning one stl_load_errors row.'''
+
+    def execute(self, query, params):
+        self.query, self.params = query, params
+
+    def fetchall(self):
+        return [('s3://source/song_data/A.json', 'year', 'Invalid digit', 1207, 3)]
+
+
+def test_query_errors_of_the_latest_copy_or_since():
+    cur = ErrorsCursor()
+
+    assert query_errors(cur, 'staging_songs') == [{'filename': 's3://source/song_data/A.json', 'colname': 'year',
+        'err_reason': 'Invalid digit', 'err_code': 1207, 'line_number': 3}]
+    assert 'MAX(query)' in cur.query and cur.params == ('staging_songs',)
+
+    query_errors(cur, 'staging_songs', since='2018-11-05 10:00:00')
+    assert 'starttime > %s' in cur.query and cur.params == ('staging_songs', '2018-11-05 10:00:00')
+    # tables of the same name in other schemas are left out
+    assert 'tbl IN (' in cur.query and '"schema" = current_schema()' in cur.query
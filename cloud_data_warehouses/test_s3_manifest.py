@@ -0,0 +1,130 @@
+'''Build manifests from a moto S3 bucket and check the filters, manifest contents and byte balanced groups.'''
+
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+import s3_manifest
+from s3_manifest import build_manifests, balance, slice_skew
+
+SIZES = {
+    'song_data/A/A/TRAAA1.json': 900,
+    'song_data/A/A/TRAAA2.json': 500,
+    'song_data/A/B/TRABA1.json': 400,
+    'song_data/A/B/TRABA2.json': 300,
+    'song_data/B/A/TRBAA1.json': 100,
+    'song_data/A/A/': 0,
+    'song_data_old/A/A/TROLD1.json': 700,
+    'log_data/2018/11/2018-11-05-events.json': 800,
+    'log_data/2018/11/2018-11-06-events.json': 600,
+}
+
+
+@pytest.fixture
+def s3():
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket='source')
+        client.create_bucket(Bucket='output')
+        for key, size in SIZES.items():
+            client.put_object(Bucket='source', Key=key, Body=b'x' * size)
+        yield client
+
+
+SOURCES = {'staging_events': 's3://source/log_data', 'staging_songs': 's3://source/song_data'}
+
+
+def read_manifest(s3, url):
+    bucket, key = url[len('s3://'):].split('/', 1)
+    return json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read())
+
+
+def manifest_keys(s3, url):
+    return sorted(entry['url'][len('s3://source/'):] for entry in read_manifest(s3, url)['entries'])
+
+
+def test_excludes_sibling_prefix_and_folder_markers(s3):
+    report = build_manifests(s3, SOURCES, 's3://output/manifests/')
+
+    songs = manifest_keys(s3, report['staging_songs'][0]['url'])
+    assert songs == sorted(key for key in SIZES if key.startswith('song_data/') and not key.endswith('/'))
+    assert report['staging_songs'][0] == {
+        'url': 's3://output/manifests/staging_songs_000.manifest', 'files': 5, 'bytes': 2200, 'slice_skew': 1.0}
+    assert manifest_keys(s3, report['staging_events'][0]['url']) == [
+        'log_data/2018/11/2018-11-05-events.json', 'log_data/2018/11/2018-11-06-events.json']
+
+
+def test_lists_only_the_source_folders(s3, monkeypatch):
+    listed = []
+    list_all = s3_manifest.list_objects
+
+    def list_objects(s3, bucket, prefix=''):
+        listed.append((bucket, prefix))
+        return list_all(s3, bucket, prefix)
+
+    monkeypatch.setattr(s3_manifest, 'list_objects', list_objects)
+
+    build_manifests(s3, SOURCES, 's3://output/manifests/')
+    build_manifests(s3, SOURCES, 's3://output/manifests/', prefix='A/B')
+
+    # the sources share no prefix, so a common listing would list the whole bucket
+    assert listed == [('source', 'log_data/'), ('source', 'song_data/'), ('source', 'log_data/A/B'), ('source', 'song_data/A/B')]
+
+
+def test_manifest_entries_are_mandatory_with_content_length(s3):
+    report = build_manifests(s3, SOURCES, 's3://output/manifests/', pattern='*2018-11-05*')
+
+    assert read_manifest(s3, report['staging_events'][0]['url']) == {'entries': [{
+        'url': 's3://source/log_data/2018/11/2018-11-05-events.json', 'mandatory': True, 'meta': {'content_length': 800}}]}
+    assert report['staging_songs'] == []
+
+
+def test_prefix_filter_is_relative_to_each_source(s3):
+    report = build_manifests(s3, SOURCES, 's3://output/manifests/', prefix='A/B')
+
+    assert manifest_keys(s3, report['staging_songs'][0]['url']) == ['song_data/A/B/TRABA1.json', 'song_data/A/B/TRABA2.json']
+    assert report['staging_events'] == []
+
+
+def test_size_filters(s3):
+    report = build_manifests(s3, SOURCES, 's3://output/manifests/', min_size=300, max_size=700)
+
+    assert manifest_keys(s3, report['staging_songs'][0]['url']) == [
+        'song_data/A/A/TRAAA2.json', 'song_data/A/B/TRABA1.json', 'song_data/A/B/TRABA2.json']
+    assert manifest_keys(s3, report['staging_events'][0]['url']) == ['log_data/2018/11/2018-11-06-events.json']
+
+
+def test_modification_date_filters(s3):
+    now = datetime.now(timezone.utc)
+
+    assert build_manifests(s3, SOURCES, 's3://output/manifests/', since=now + timedelta(days=1)) == {
+        'staging_events': [], 'staging_songs': []}
+    report = build_manifests(s3, SOURCES, 's3://output/manifests/', since=now - timedelta(days=1), until=now + timedelta(days=1))
+    assert report['staging_songs'][0]['files'] == 5
+
+
+def test_groups_are_byte_balanced(s3):
+    report = build_manifests(s3, SOURCES, 's3://output/manifests/', groups=2, slices=2)
+
+    songs = report['staging_songs']
+    assert [entry['url'] for entry in songs] == [
+        's3://output/manifests/staging_songs_000.manifest', 's3://output/manifests/staging_songs_001.manifest']
+    # largest first: 900 + 300 and 500 + 400 + 100
+    assert sorted(entry['bytes'] for entry in songs) == [1000, 1200]
+    assert sum(entry['files'] for entry in songs) == 5
+    for entry in songs:
+        assert sum(item['meta']['content_length'] for item in read_manifest(s3, entry['url'])['entries']) == entry['bytes']
+
+
+def test_balance_and_slice_skew():
+    objects = [{'key': str(size), 'size': size} for size in (900, 500, 400, 300, 100)]
+
+    assert [[obj['size'] for obj in group] for group in balance(objects, 2)] == [[900, 300], [500, 400, 100]]
+    assert balance(objects[:1], 3) == [objects[:1]]
+    # one file can only load on one of four slices
+    assert slice_skew(objects[:1], 4) == 4.0
+    assert slice_skew([], 4) == 1.0
@@ -0,0 +1,44 @@
+'''Run the merge DAG with several workers and check the merges writing etl_watermarks never overlap.'''
+
+import threading
+import time
+
+from scheduler import run_dag
+from sql_queries import insert_dependencies, insert_syntax, merge_syntax
+
+
+def run_steps(queries, dependencies):
+    lock = threading.Lock()
+    running, overlaps = set(), []
+
+    def step(table):
+        writes = any('etl_watermarks' in query for query in queries[table])
+        with lock:
+            if writes:
+                overlaps.extend(other for other in running if other != table)
+                running.add(table)
+        time.sleep(0.05)
+        with lock:
+            running.discard(table)
+
+    results = run_dag({table: lambda table=table: step(table) for table in queries}, dependencies, max_workers=4)
+
+    return results, overlaps
+
+
+def test_watermark_merges_run_one_at_a_time():
+    merge = merge_syntax()
+
+    results, overlaps = run_steps(merge, insert_dependencies(incremental=True))
+
+    assert {table for table, queries in merge.items() if any('etl_watermarks' in query for query in queries)} == {
+        'songplay', 'users', 'time'}
+    assert all(result['status'] == 'done' for result in results.values())
+    assert overlaps == []
+
+
+def test_full_inserts_of_dimensions_run_together():
+    dependencies = insert_dependencies()
+
+    assert dependencies == {'songplay': ['users', 'songs', 'artists', 'time']}
+    assert set(insert_syntax()) >= set(dependencies['songplay'])
@@ -0,0 +1,380 @@
+""" Loads song and log files like etl.py --bulk, overlapping file reads and parsing with writes over several connections.
+
+Each connection loads one file at a time in its own transaction. Files write to each table, and commit, in the same
+order that etl.py processes them, so the conflict rules (the first record of a song or artist, the last level of a
+user) and songplay_id order give the same table contents. Different files write to different tables at the same
+time, so round trips to a distant database overlap instead of adding up.
+
+psycopg2 calls block, so they run in a thread per connection while files are parsed in a pool of processes.
+
+Example
+-------
+async_etl.py --concurrency 4 --workers 4
+"""
+
+import os
+import asyncio
+import argparse
+import psycopg2
+from collections import deque, defaultdict
+from itertools import islice
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import metrics
+from sql_queries import *
+from etl import find_files, copy_dataframe, merge_staged, parse_song_file, parse_log_file, parse_recorded
+from song_index import SongIndex
+from time_dimension import TimeDimension
+from ingest_manifest import unprocessed_files, record_file
+from partitions import SongplayPartitions
+
+# database every connection of AsyncLoader loads into
+DSN = "host=127.0.0.1 dbname=sparkifydb user=student password=student"
+
+
+class TableTurns:
+    """ Lets files write to each table in file order, while files write to different tables at the same time.
+
+    Attributes
+    ----------
+    next : collections.defaultdict
+        keys = table name, values = number of the next file allowed to write to the table
+    """
+
+    def __init__(self):
+        self.next = defaultdict(int)
+        self._condition = asyncio.Condition()
+
+    async def wait(self, table, number):
+        """ Waits until every earlier file has written to the table.
+
+        Parameters
+        ----------
+        table : str
+            name of the SQL table, or 'commit'
+        number : int
+            position of the file in load order
+
+        Returns
+        -------
+        None
+        """
+
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.next[table] == number)
+
+    async def done(self, table):
+        """ Lets the next file write to the table.
+
+        Parameters
+        ----------
+        table : str
+            name of the SQL table, or 'commit'
+
+        Returns
+        -------
+        None
+        """
+
+        async with self._condition:
+            self.next[table] += 1
+            self._condition.notify_all()
+
+
+def start_batch(cur):
+    """ Creates the staging tables of the connection if needed and empties them."""
+
+    for query in staging_table_queries:
+        cur.execute(query)
+    cur.execute(staging_table_truncate)
+
+
+def load_songs(cur, batch):
+    """ Stages then merges song records from parse_song_file, returning the number of records."""
+
+    copy_dataframe(cur, batch['songs'], 'songs_staging')
+    merge_staged(cur, song_table_merge, 'songs', len(batch['songs']))
+
+    return len(batch['songs'])
+
+
+def load_artists(cur, batch, song_index):
+    """ Stages then merges artist records from parse_song_file and adds the songs and artists to song_index, returning
+    the number of records."""
+
+    copy_dataframe(cur, batch['artists'], 'artists_staging')
+    merge_staged(cur, artist_table_merge, 'artists', len(batch['artists']))
+    song_index.add(batch['songs'], batch['artists'])
+
+    return len(batch['artists'])
+
+
+def load_time(cur, batch, time_dimension):
+    """ Stages then merges time records from parse_log_file not already known, returning the number of records."""
+
+    time_df = time_dimension.new_rows(batch['time'])
+    copy_dataframe(cur, time_df, 'time_staging')
+    merge_staged(cur, time_table_merge, 'time', len(time_df))
+
+    return len(time_df)
+
+
+def load_users(cur, batch):
+    """ Stages then merges user records from parse_log_file, returning the number of records."""
+
+    copy_dataframe(cur, batch['users'], 'users_staging')
+    merge_staged(cur, user_table_merge, 'users', len(batch['users']))
+
+    return len(batch['users'])
+
+
+def load_songplays(cur, batch, song_index, partitions=None):
+    """ Copies song plays from parse_log_file with song_id & artist_id found in song_index, returning the number of
+    records."""
+
+    songplay_df = batch['songplays']
+
+    if partitions is not None:
+        partitions.ensure(cur, songplay_df['start_time'])
+
+    found = song_index.match(songplay_df)
+    songplay_df = songplay_df.drop(columns=['song','artist','length'])
+    songplay_df.insert(3, 'song_id', found['song_id'])
+    songplay_df.insert(4, 'artist_id', found['artist_id'])
+    copy_dataframe(cur, songplay_df, 'songplays')
+
+    return len(songplay_df)
+
+
+def commit_file(conn, info, row_counts):
+    """ Records a loaded file in the etl_manifest table and commits its transaction."""
+
+    record_file(conn.cursor(), info, row_counts)
+    conn.commit()
+
+
+class AsyncLoader:
+    """ Loads files over a pool of connections, parsing files ahead in a pool of processes.
+
+    Attributes
+    ----------
+    connections : list
+        psycopg2.connection to sparkifydb for each file loaded at the same time
+    """
+
+    def __init__(self, concurrency=4, workers=None):
+        self.connections = [psycopg2.connect(DSN) for _ in range(concurrency)]
+        self._threads = ThreadPoolExecutor(max_workers=concurrency)
+        self._parsers = ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+
+    async def _run(self, func, *args):
+        """ Runs a blocking function in a thread."""
+
+        return await asyncio.get_running_loop().run_in_executor(self._threads, func, *args)
+
+    async def _load_file(self, conn, number, info, parsed, steps, turns, idle):
+        """ Loads one parsed file in a transaction, taking the turn of the file for each table and for committing.
+
+        Parameters
+        ----------
+        conn : psycopg2.connection
+            connection taken from idle, returned once the file is committed or fails
+        number : int
+            position of the file in load order
+        info : dict
+            fingerprint of the file
+        parsed : asyncio.Future
+            records returned by the parse function and the stages recorded while parsing
+        steps : list
+            tuples of (table name, function called with cur and the records returning the number of records loaded)
+        turns : TableTurns
+            order of writes to each table
+        idle : asyncio.Queue
+            connections not loading a file
+
+        Returns
+        -------
+        None
+        """
+
+        try:
+            batch, stages = await parsed
+            metrics.current.merge(stages)
+            cur = conn.cursor()
+            await self._run(start_batch, cur)
+
+            row_counts = {}
+            for table, step in steps:
+                await turns.wait(table, number)
+                row_counts[table] = await self._run(step, cur, batch)
+                await turns.done(table)
+
+            await turns.wait('commit', number)
+            await self._run(commit_file, conn, info, row_counts)
+            await turns.done('commit')
+        except Exception:
+            # release the locks held by the file so files waiting on them can finish
+            await self._run(conn.rollback)
+            raise
+        finally:
+            idle.put_nowait(conn)
+
+    async def load_files(self, files, parse, steps, queue_depth=None):
+        """ Parses and loads files, with one file per connection loading at a time.
+
+        Connections are given to files in load order so an earlier file never waits for a connection held by a later file.
+
+        Parameters
+        ----------
+        files : list
+            fingerprint of each file to load, in load order
+        parse : function
+            parse_song_file or parse_log_file, called with each file path in a separate process using etl.parse_recorded
+        steps : list
+            tuples of (table name, function called with cur and the records returning the number of records loaded)
+        queue_depth : int, optional
+            maximum number of files parsed ahead of loading, defaults to twice the number of connections
+
+        Returns
+        -------
+        None
+        """
+
+        loop = asyncio.get_running_loop()
+        parse = partial(parse_recorded, parse)
+        turns = TableTurns()
+        idle = asyncio.Queue()
+        for conn in self.connections:
+            idle.put_nowait(conn)
+        queue_depth = queue_depth or 2*len(self.connections)
+
+        # start parsing the first files then parse another file each time one starts loading
+        remaining = iter(enumerate(files))
+        parsing = deque(
+            (number, info, loop.run_in_executor(self._parsers, parse, info['filepath']))
+            for number, info in islice(remaining, queue_depth)
+        )
+
+        tasks = set()
+        try:
+            while parsing:
+                number, info, parsed = parsing.popleft()
+                conn = await idle.get()
+                for following, following_info in islice(remaining, 1):
+                    parsing.append((following, following_info, loop.run_in_executor(self._parsers, parse, following_info['filepath'])))
+                tasks.add(asyncio.create_task(self._load_file(conn, number, info, parsed, steps, turns, idle)))
+
+                # stop at the first file that fails
+                finished = {task for task in tasks if task.done()}
+                for task in finished:
+                    task.result()
+                    print('{}/{} files processed.'.format(turns.next['commit'], len(files)))
+                tasks -= finished
+
+            await asyncio.gather(*tasks)
+            print('{}/{} files processed.'.format(turns.next['commit'], len(files)))
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # stop statements still running in threads, such as waits on locks held by cancelled files
+            for conn in self.connections:
+                conn.cancel()
+            raise
+
+    def close(self):
+        """ Waits for running statements then closes the connections and pools, rolling back uncommitted files."""
+
+        self._threads.shutdown()
+        self._parsers.shutdown()
+        for conn in self.connections:
+            conn.close()
+
+
+def main(concurrency=4, workers=None, queue_depth=None, data_dir='data', metrics_dir=None):
+    """ Loads new or changed song files then log files, giving the same table contents as etl.py.
+
+    Parameters
+    ----------
+    concurrency : int, default 4
+        number of connections, each loading one file at a time
+    workers : int, optional
+        number of processes parsing files, defaults to the number of CPUs
+    queue_depth : int, optional
+        maximum number of files parsed ahead of loading, defaults to twice concurrency
+    data_dir : str, default 'data'
+        directory containing the song_data and log_data directories
+    metrics_dir : str, optional
+        directory to write the run report postgres_async_etl.json and Prometheus textfile postgres_async_etl.prom, only
+        printed if not given
+
+    Returns
+    -------
+    timings : dict
+        keys = stage name, values = seconds taken by the stage
+    """
+
+    run = metrics.start('postgres_async_etl')
+    loader = AsyncLoader(concurrency, workers)
+    conn = loader.connections[0]
+    cur = conn.cursor()
+
+    try:
+        with metrics.stage('setup'):
+            song_index = SongIndex()
+            song_index.load(cur)
+            time_dimension = TimeDimension()
+            time_dimension.load(cur)
+            partitions = SongplayPartitions()
+            if not partitions.load(cur):
+                partitions = None
+            conn.rollback()
+
+        stages = [
+            ('song_data', parse_song_file, [('songs', load_songs), ('artists', partial(load_artists, song_index=song_index))]),
+            ('log_data', parse_log_file, [
+                ('time', partial(load_time, time_dimension=time_dimension)),
+                ('users', load_users),
+                ('songplays', partial(load_songplays, song_index=song_index, partitions=partitions)),
+            ]),
+        ]
+
+        # songs are all committed before log files are loaded, so every song play can find its song
+        for stage, parse, steps in stages:
+            with metrics.stage('load', stage):
+                filepath = os.path.join(data_dir, stage)
+                all_files = find_files(filepath)
+                print('{} files found in {}'.format(len(all_files), filepath))
+                files = unprocessed_files(cur, all_files, reload_changed=(stage == 'song_data'))
+                conn.rollback()
+                print('{} files are new or changed since the previous run.'.format(len(files)))
+
+                asyncio.run(loader.load_files(files, parse, steps, queue_depth))
+    finally:
+        loader.close()
+
+        # report the stages that ran even if the run failed
+        print(run.summary())
+        if metrics_dir:
+            run.write(metrics_dir)
+            print('Saved run report and Prometheus metrics into directory {}.'.format(metrics_dir))
+
+    timings = {stage: run.stages[key]['seconds'] for stage, key in
+        [('setup', ('setup', None)), ('song_data', ('load', 'song_data')), ('log_data', ('load', 'log_data'))]}
+
+    return timings
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=4, help='connections each loading one file at a time')
+    parser.add_argument('--workers', type=int, default=None, help='processes parsing files')
+    parser.add_argument('--queue-depth', type=int, default=None, help='maximum parsed files waiting to be loaded')
+    parser.add_argument('--data-dir', type=str, default='data', help='directory containing song_data and log_data')
+    parser.add_argument('--metrics-dir', type=str, default=None, help='directory to write the run report and Prometheus textfile')
+
+    args = parser.parse_args()
+
+    main(concurrency=args.concurrency, workers=args.workers, queue_depth=args.queue_depth, data_dir=args.data_dir,
+        metrics_dir=args.metrics_dir)
@@ -0,0 +1,356 @@
+""" Measures the throughput of create_tables.py and etl.py against the local PostgreSQL database using generated data.
+
+Song and log files are generated deterministically from a seed with the same schema as the Sparkify files, so runs
+at the same scale can be compared across commits. Each run appends a JSON record to the results file with the files
+and rows per second, the time of each stage and the peak memory.
+
+Example
+-------
+benchmark.py --events 100000 --bulk --workers 4
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import subprocess
+from datetime import datetime, timedelta
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+import psycopg2
+import etl
+import post_load
+import create_tables
+
+TABLES = ['songplays', 'users', 'songs', 'artists', 'time']
+PAGES = ['Home', 'Settings', 'Logout', 'Login', 'About', 'Help', 'Upgrade', 'Downgrade', 'Error']
+USER_AGENTS = [
+    '"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+    '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2 (KHTML, like Gecko) Version/7.0.6 Safari/537.78.2"',
+    'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0',
+]
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Chicago-Naperville-Elgin, IL-IN-WI', 'New York-Newark-Jersey City, NY-NJ-PA']
+# user_id and session_id are SMALLINT columns in sql_queries.py
+SMALLINT_MAX = 32767
+
+
+def random_id(rng, prefix, length=18):
+    """ Identifier such as a song_id or artist_id with uppercase letters and digits after a prefix."""
+
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(length - len(prefix)))
+
+
+def random_words(rng, count):
+    """ Title or name of count capitalized words."""
+
+    return ' '.join(''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 9))).title() for _ in range(count))
+
+
+def generate_songs(data_dir, num_songs, rng):
+    """ Writes one song file per song in the song_data directory layout.
+
+    Parameters
+    ----------
+    data_dir : str
+        directory to write song_data into
+    num_songs : int
+        number of song files to write
+    rng : random.Random
+        seeded random number generator
+
+    Returns
+    -------
+    songs : list
+        tuple of (title, artist name, duration) for each song, used to generate matching song plays
+    """
+
+    artists = []
+    for _ in range(max(1, num_songs // 3)):
+        latitude = round(rng.uniform(-60, 70), 5) if rng.random() < 0.4 else None
+        artists.append({
+            'artist_id': random_id(rng, 'AR'),
+            'artist_latitude': latitude,
+            'artist_longitude': round(rng.uniform(-150, 150), 5) if latitude is not None else None,
+            'artist_location': rng.choice(LOCATIONS + ['']),
+            'artist_name': random_words(rng, rng.randint(1, 3)),
+        })
+
+    songs = []
+    for _ in range(num_songs):
+        artist = rng.choice(artists)
+        track = random_id(rng, 'TR')
+        record = {'num_songs': 1, **artist, 'song_id': random_id(rng, 'SO'), 'title': random_words(rng, rng.randint(1, 5)),
+            'duration': round(rng.uniform(60, 600), 5), 'year': rng.choice([0] + list(range(1960, 2019)))}
+
+        # nested by the 3rd to 5th characters of the track like TRAAAAW128F429D538.json in song_data/A/A/A
+        folder = os.path.join(data_dir, 'song_data', track[2], track[3], track[4])
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, track + '.json'), 'w', encoding='utf-8') as fh:
+            json.dump(record, fh)
+        songs.append((record['title'], record['artist_name'], record['duration']))
+
+    return songs
+
+
+def next_session_id(session_id):
+    """ Session id following session_id, wrapping back to 1 after SMALLINT_MAX so any number of events can be loaded."""
+
+    return session_id % SMALLINT_MAX + 1
+
+
+def scale_counts(num_events, num_songs=None, num_users=None):
+    """ Number of song files and users generated for a number of log events.
+
+    Parameters
+    ----------
+    num_events : int
+        total number of log events
+    num_songs : int, optional
+        number of song files, defaults to a tenth of num_events
+    num_users : int, optional
+        number of distinct users, defaults to a hundredth of num_events up to SMALLINT_MAX
+
+    Returns
+    -------
+    num_songs : int
+        number of song files
+    num_users : int
+        number of distinct users, numbered from 1
+    """
+
+    num_songs = num_songs or max(100, num_events // 10)
+    num_users = num_users or min(SMALLINT_MAX, max(10, num_events // 100))
+    if num_users > SMALLINT_MAX:
+        raise ValueError('At most {} users fit the SMALLINT user_id column, got {}.'.format(SMALLINT_MAX, num_users))
+
+    return num_songs, num_users
+
+
+def generate_logs(data_dir, num_events, events_per_file, num_users, songs, rng):
+    """ Writes newline delimited log files of one day each in the log_data directory layout.
+
+    Session ids start a new session every 50 events and wrap within the SMALLINT session_id column.
+
+    Parameters
+    ----------
+    data_dir : str
+        directory to write log_data into
+    num_events : int
+        total number of events to write
+    events_per_file : int
+        number of events in each daily file
+    num_users : int
+        number of distinct users
+    songs : list
+        tuple of (title, artist name, duration) from generate_songs
+    rng : random.Random
+        seeded random number generator
+
+    Returns
+    -------
+    None
+    """
+
+    users = [{
+        'userId': str(user_id),
+        'firstName': random_words(rng, 1),
+        'lastName': random_words(rng, 1),
+        'gender': rng.choice('MF'),
+        'level': rng.choice(['free', 'paid']),
+        'location': rng.choice(LOCATIONS),
+        'userAgent': rng.choice(USER_AGENTS),
+        'registration': float(1540000000000 + rng.randint(0, 10**9)),
+    } for user_id in range(1, num_users + 1)]
+
+    day = datetime(2018, 11, 1)
+    session_id = 0
+    written = 0
+    while written < num_events:
+        count = min(events_per_file, num_events - written)
+        folder = os.path.join(data_dir, 'log_data', day.strftime('%Y'), day.strftime('%m'))
+        os.makedirs(folder, exist_ok=True)
+        day_start = int((day - datetime(1970, 1, 1)).total_seconds() * 1000)
+        offsets = sorted(rng.randint(0, 86399999) for _ in range(count))
+
+        with open(os.path.join(folder, day.strftime('%Y-%m-%d') + '-events.json'), 'w', encoding='utf-8') as fh:
+            for item, offset in enumerate(offsets):
+                user = rng.choice(users)
+                # users occasionally change level
+                if rng.random() < 0.001:
+                    user['level'] = 'paid' if user['level'] == 'free' else 'free'
+                if item % 50 == 0:
+                    session_id = next_session_id(session_id)
+
+                event = {'artist': None, 'auth': 'Logged In', 'firstName': user['firstName'], 'gender': user['gender'],
+                    'itemInSession': item % 50, 'lastName': user['lastName'], 'length': None, 'level': user['level'],
+                    'location': user['location'], 'method': 'GET', 'page': rng.choice(PAGES),
+                    'registration': user['registration'], 'sessionId': session_id, 'song': None, 'status': 200,
+                    'ts': day_start + offset, 'userAgent': user['userAgent'], 'userId': user['userId']}
+
+                # most events are song plays, a few of songs not in song_data
+                if rng.random() < 0.8:
+                    title, artist, duration = rng.choice(songs)
+                    if rng.random() < 0.1:
+                        title = random_words(rng, 2)
+                    event.update({'artist': artist, 'song': title, 'length': duration, 'method': 'PUT', 'page': 'NextSong'})
+
+                fh.write(json.dumps(event) + '\n')
+
+        written += count
+        day += timedelta(days=1)
+
+
+def generate_data(data_dir, num_events, events_per_file=10000, num_songs=None, num_users=None, seed=0):
+    """ Writes song_data and log_data files with the same schema as the Sparkify files.
+
+    Parameters
+    ----------
+    data_dir : str
+        directory to write song_data and log_data into
+    num_events : int
+        total number of log events
+    events_per_file : int, default 10000
+        number of events in each daily log file
+    num_songs : int, optional
+        number of song files, defaults to a tenth of num_events
+    num_users : int, optional
+        number of distinct users, defaults to a hundredth of num_events up to SMALLINT_MAX
+    seed : int, default 0
+        seed so the same arguments always generate the same files
+
+    Returns
+    -------
+    None
+    """
+
+    rng = random.Random(seed)
+    num_songs, num_users = scale_counts(num_events, num_songs, num_users)
+
+    print('Generating {} song files and {} log events in {}.'.format(num_songs, num_events, data_dir))
+    songs = generate_songs(data_dir, num_songs, rng)
+    generate_logs(data_dir, num_events, events_per_file, num_users, songs, rng)
+
+
+def peak_memory():
+    """ Peak resident memory in MB of this process and its child processes, None if not available on this platform."""
+
+    if resource is None:
+        return None
+
+    peak = [resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    # kilobytes on Linux and bytes on macOS
+    scale = 1e6 if sys.platform == 'darwin' else 1e3
+
+    return {'self': peak[0] / scale, 'children': peak[1] / scale}
+
+
+def git_commit():
+    """ Short hash of the current git commit, None outside a git repository."""
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def table_counts():
+    """ Number of records in each table."""
+
+    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    cur = conn.cursor()
+    counts = {}
+    for table in TABLES:
+        cur.execute(f'SELECT COUNT(*) FROM {table}')
+        counts[table] = cur.fetchone()[0]
+    conn.close()
+
+    return counts
+
+
+def run(args):
+    """ Creates the tables, runs the ETL on the generated data and appends the measurements to the results file.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        parsed command line arguments
+
+    Returns
+    -------
+    result : dict
+        measurements of the run
+    """
+
+    if not args.skip_generate:
+        generate_data(args.data_dir, args.events, args.events_per_file, args.songs, args.users, args.seed)
+
+    num_files = {name: len(etl.find_files(os.path.join(args.data_dir, name))) for name in ('song_data', 'log_data')}
+
+    stages = {}
+    time_start = time.time()
+    create_tables.main(load_optimized=args.load_optimized, partitioned=args.partitioned)
+    stages['create_tables'] = time.time() - time_start
+
+    time_start = time.time()
+    stages.update(etl.main(bulk=args.bulk or args.workers > 0, workers=args.workers, chunksize=args.chunksize, data_dir=args.data_dir))
+    stages['etl'] = time.time() - time_start
+
+    if args.load_optimized:
+        time_start = time.time()
+        post_load.main()
+        stages['post_load'] = time.time() - time_start
+
+    counts = table_counts()
+    elapsed = sum(seconds for stage, seconds in stages.items() if stage in ('create_tables', 'etl', 'post_load'))
+
+    result = {
+        'commit': git_commit(),
+        'run_at': datetime.now().isoformat(timespec='seconds'),
+        'events': args.events,
+        'seed': args.seed,
+        'options': {'bulk': args.bulk, 'workers': args.workers, 'chunksize': args.chunksize,
+            'load_optimized': args.load_optimized, 'partitioned': args.partitioned},
+        'files': num_files,
+        'rows': counts,
+        'stages_sec': {stage: round(seconds, 3) for stage, seconds in stages.items()},
+        'files_per_sec': round(sum(num_files.values()) / stages['etl'], 1),
+        'rows_per_sec': round(sum(counts.values()) / stages['etl'], 1),
+        'events_per_sec': round(args.events / stages['log_data'], 1),
+        'elapsed_sec': round(elapsed, 3),
+        'peak_memory_mb': peak_memory(),
+    }
+
+    with open(args.results, 'a', encoding='utf-8') as fh:
+        fh.write(json.dumps(result) + '\n')
+    print('Saved benchmark results into file {}:\n{}'.format(args.results, json.dumps(result, indent=4)))
+
+    return result
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=10000, help='number of log events to generate')
+    parser.add_argument('--events-per-file', type=int, default=10000, help='log events in each daily file')
+    parser.add_argument('--songs', type=int, default=None, help='number of song files, a tenth of events by default')
+    parser.add_argument('--users', type=int, default=None, help='number of users, a hundredth of events up to 32767 by default')
+    parser.add_argument('--seed', type=int, default=0, help='seed for generating the same data')
+    parser.add_argument('--data-dir', type=str, default='benchmark_data', help='directory for the generated files')
+    parser.add_argument('--skip-generate', action='store_true', help='reuse files already in data-dir')
+    parser.add_argument('--results', type=str, default='benchmark_results.jsonl', help='file to append results to')
+    parser.add_argument('--bulk', action='store_true', help='load files using COPY and set-based merges')
+    parser.add_argument('--workers', type=int, default=0, help='processes parsing files for a bulk load')
+    parser.add_argument('--chunksize', type=int, default=None, help='log file lines read at a time for a bulk load')
+    parser.add_argument('--load-optimized', action='store_true', help='add keys and indexes after loading')
+    parser.add_argument('--partitioned', action='store_true', help='partition songplays by month')
+
+    args = parser.parse_args()
+
+    run(args)
@@ -0,0 +1,177 @@
+""" Profiles the columns of each table using SQL aggregates so rows do not need to be read into Python.
+
+Each table is scanned once to compute row and null counts, min/max values and the maximum string length of every
+column. Distinct counts are estimated from the statistics PostgreSQL keeps for the query planner, analyzing a table first
+if it has none. A sample of each table can be profiled instead using TABLESAMPLE.
+
+Example
+-------
+column_profile.py --sample 10 --output profile.json
+"""
+
+import json
+import argparse
+import psycopg2
+from sql_queries import column_select, column_stats_select, table_analyze
+
+# types without a min/max aggregate
+UNORDERED_TYPES = {'boolean', 'json', 'jsonb', 'bytea', 'ARRAY', 'USER-DEFINED'}
+CHARACTER_TYPES = {'character varying', 'character', 'text'}
+
+
+def profile_query(table, columns, sample_percent=None):
+    """ Builds a single query computing the profile of every column of a table.
+
+    Parameters
+    ----------
+    table : str
+        name of the SQL table
+    columns : list
+        tuples of (column name, data type) from information_schema.columns
+    sample_percent : float, optional
+        percent of the table blocks to sample, the whole table if not given
+
+    Returns
+    -------
+    query : str
+        SELECT statement returning one row of aggregates, with names given by profile_aliases
+    """
+
+    aggregates = ['COUNT(*)']
+    for name, data_type in columns:
+        aggregates.append('COUNT(*) - COUNT("{0}")'.format(name))
+        if data_type not in UNORDERED_TYPES:
+            aggregates += ['MIN("{0}")'.format(name), 'MAX("{0}")'.format(name)]
+        if data_type in CHARACTER_TYPES:
+            aggregates.append('MAX(LENGTH("{0}"))'.format(name))
+
+    sample = ' TABLESAMPLE SYSTEM ({})'.format(float(sample_percent)) if sample_percent else ''
+    query = 'SELECT {} FROM "{}"{}'.format(', '.join(aggregates), table, sample)
+
+    return query
+
+
+def profile_aliases(columns):
+    """ Names each value returned by profile_query for the same columns.
+
+    Parameters
+    ----------
+    columns : list
+        tuples of (column name, data type) from information_schema.columns
+
+    Returns
+    -------
+    aliases : list
+        tuple of (column name, statistic) for each value after the row count
+    """
+
+    aliases = []
+    for name, data_type in columns:
+        aliases.append((name, 'nulls'))
+        if data_type not in UNORDERED_TYPES:
+            aliases += [(name, 'min'), (name, 'max')]
+        if data_type in CHARACTER_TYPES:
+            aliases.append((name, 'max_length'))
+
+    return aliases
+
+
+def profile_table(cur, table, sample_percent=None):
+    """ Profiles each column of a table.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    table : str
+        name of the SQL table
+    sample_percent : float, optional
+        percent of the table blocks to sample, the whole table if not given
+
+    Returns
+    -------
+    profile : dict
+        rows profiled, whether sampled, whether the table was analyzed to estimate distinct counts, and for each column
+        the data type, null count, whether nulls were found, estimated distinct count, min, max and max string length.
+        A sample may not find all nulls. The distinct estimate is None if PostgreSQL has no statistics for the column,
+        such as for an empty table.
+    """
+
+    cur.execute(column_select, (table,))
+    columns = cur.fetchall()
+
+    # planner statistics, negative values are a fraction of the number of rows
+    cur.execute(column_stats_select, (table,))
+    stats = dict(cur.fetchall())
+
+    # tables not yet analyzed, such as just after loading, have no statistics to estimate distinct counts from
+    analyzed = not stats
+    if analyzed:
+        cur.execute(table_analyze.format(table=table))
+        cur.execute(column_stats_select, (table,))
+        stats = dict(cur.fetchall())
+
+    cur.execute(profile_query(table, columns, sample_percent))
+    values = cur.fetchone()
+    rows = values[0]
+
+    # scale a sample up to the size of the table for distinct fractions
+    table_rows = rows * 100 / sample_percent if sample_percent else rows
+
+    profile = {'rows': rows, 'sampled': bool(sample_percent), 'analyzed': analyzed, 'columns': {}}
+    for name, data_type in columns:
+        n_distinct = stats.get(name)
+        if n_distinct is not None and n_distinct < 0:
+            n_distinct = round(-n_distinct * table_rows)
+        profile['columns'][name] = {'data_type': data_type, 'distinct_estimate': n_distinct}
+    for (name, statistic), value in zip(profile_aliases(columns), values[1:]):
+        profile['columns'][name][statistic] = value
+    for column in profile['columns'].values():
+        column['nullable'] = column['nulls'] > 0
+
+    return profile
+
+
+def profile_tables(cur, tables, sample_percent=None):
+    """ Profiles each column of several tables.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    tables : list
+        name of each SQL table
+    sample_percent : float, optional
+        percent of the table blocks to sample, the whole table if not given
+
+    Returns
+    -------
+    profiles : dict
+        keys = table name, values = result of profile_table
+    """
+
+    return {table: profile_table(cur, table, sample_percent) for table in tables}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sample', type=float, default=None, help='percent of each table to sample')
+    parser.add_argument('--output', type=str, default='profile.json', help='file to write the JSON profile')
+
+    args = parser.parse_args()
+
+    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    cur = conn.cursor()
+
+    profiles = profile_tables(cur, ['artists','songplays','songs','time','users'], args.sample)
+    conn.commit()
+    for table, profile in profiles.items():
+        missing = [name for name, column in profile['columns'].items() if column['distinct_estimate'] is None]
+        if missing:
+            print('No planner statistics to estimate distinct values of {} columns {}.'.format(table, missing))
+    with open(args.output, 'w', encoding='utf-8') as fh:
+        json.dump(profiles, fh, ensure_ascii=False, indent=4, default=str)
+    print('Saved column profiles into file {}.'.format(args.output))
+
+    conn.close()
@@ -0,0 +1,113 @@
+""" Fixtures for the tests that load data into a local sparkify database.
+
+The tests connect as the student user like create_tables.py and etl.py, creating a separate sparkifydb_test database so
+a loaded sparkifydb is left alone. They are skipped when no PostgreSQL server is running.
+"""
+
+import json
+import psycopg2
+import pytest
+from sql_queries import create_table_queries
+
+ADMIN_DSN = "host=127.0.0.1 dbname=studentdb user=student password=student"
+TEST_DSN = "host=127.0.0.1 dbname=sparkifydb_test user=student password=student"
+
+
+def create_test_database():
+    """ Drops then creates the sparkifydb_test database, skipping the test if PostgreSQL is not available."""
+
+    try:
+        conn = psycopg2.connect(ADMIN_DSN)
+    except psycopg2.OperationalError as error:
+        pytest.skip('PostgreSQL is not available: {}'.format(error))
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    cur.execute("DROP DATABASE IF EXISTS sparkifydb_test")
+    cur.execute("CREATE DATABASE sparkifydb_test WITH ENCODING 'utf8' TEMPLATE template0")
+    conn.close()
+
+
+@pytest.fixture
+def sparkifydb():
+    """ Connection to an empty sparkifydb_test database with the tables of create_tables.py.
+
+    Returns
+    -------
+    cur : psycopg2.cursor
+        cursor for sparkifydb_test
+    conn : psycopg2.connection
+        connection to sparkifydb_test
+    """
+
+    create_test_database()
+    conn = psycopg2.connect(TEST_DSN)
+    cur = conn.cursor()
+    for query in create_table_queries:
+        cur.execute(query)
+    conn.commit()
+
+    yield cur, conn
+
+    conn.close()
+
+
+def song(song_id, title, artist_id, artist_name, duration, year=2000, location='London'):
+    """ Record of a song file."""
+
+    return {'num_songs': 1, 'song_id': song_id, 'title': title, 'artist_id': artist_id, 'artist_name': artist_name,
+        'artist_location': location, 'artist_latitude': 51.5, 'artist_longitude': -0.1, 'duration': duration, 'year': year}
+
+
+def event(ts, user_id, level, song_title, artist_name, length, first_name='Ann', page='NextSong'):
+    """ Record of a log file."""
+
+    return {'artist': artist_name, 'auth': 'Logged In', 'firstName': first_name, 'gender': 'F', 'itemInSession': 0,
+        'lastName': 'Lee', 'length': length, 'level': level, 'location': 'Tulsa, OK', 'method': 'PUT', 'page': page,
+        'registration': 1540000000000.0, 'sessionId': 7, 'song': song_title, 'status': 200, 'ts': ts,
+        'userAgent': 'Mozilla/5.0', 'userId': str(user_id)}
+
+
+def write_records(filepath, records):
+    """ Writes records one JSON object per line like the song and log files."""
+
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    filepath.write_text(''.join(json.dumps(record) + '\n' for record in records))
+
+
+@pytest.fixture
+def sample_data(tmp_path):
+    """ Song and log files that exercise the conflict rules of each table.
+
+    Song SOA is repeated with another title within and across files and artist ARA with another location, where the first
+    record is kept. User 1 changes level within and across log files, where the last level is kept. Plays share
+    timestamps, one play is of an unknown song and one event is not a NextSong action.
+
+    Returns
+    -------
+    data_dir : str
+        directory containing the song_data and log_data directories
+    """
+
+    songs = tmp_path / 'song_data'
+    write_records(songs / 'A' / 'TRA.json', [
+        song('SOA', 'Alpha', 'ARA', 'Artist A', 200.5),
+        song('SOA', 'Alpha again', 'ARA', 'Artist A', 200.5, location='Paris'),
+    ])
+    write_records(songs / 'B' / 'TRB.json', [
+        song('SOA', 'Alpha renamed', 'ARA', 'Artist A', 200.5, location='Berlin'),
+        song('SOB', 'Beta', 'ARB', 'Artist B', 150.25, year=0),
+    ])
+
+    logs = tmp_path / 'log_data'
+    write_records(logs / '2018-11-01-events.json', [
+        event(1541030400000, 1, 'free', 'Alpha', 'Artist A', 200.5),
+        event(1541030400000, 2, 'free', 'Beta', 'Artist B', 150.25, first_name='Bob'),
+        event(1541034000000, 1, 'paid', 'Unknown', 'Nobody', 99.0),
+        event(1541034500000, 1, 'paid', None, None, None, page='Home'),
+    ])
+    write_records(logs / '2018-11-02-events.json', [
+        event(1541116800000, 1, 'free', 'Beta', 'Artist B', 150.25),
+        event(1541116800000, 2, 'paid', 'Alpha', 'Artist A', 200.5, first_name='Bob'),
+    ])
+
+    return str(tmp_path)
@@ -1,5 +1,11 @@
+import argparse
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import metrics
+from sql_queries import (
+    create_table_queries, create_table_queries_load_optimized, drop_table_queries,
+    songplay_table_create, songplay_table_create_unconstrained,
+    songplay_table_create_partitioned, songplay_table_create_partitioned_unconstrained
+)
 
 
 def create_database():
@@ -52,12 +58,14 @@ def drop_tables(cur, conn):
     -------
     None
     """
-    for query in drop_table_queries:
-        cur.execute(query)
-        conn.commit()
+    with metrics.stage('drop') as record:
+        for query in drop_table_queries:
+            cur.execute(query)
+            conn.commit()
+        record['rows_out'] += len(drop_table_queries)
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, load_optimized=False, partitioned=False):
     """ Creates each table using the queries in `create_table_queries` list. 
 
     Parameters
@@ -66,36 +74,71 @@ def create_tables(cur, conn):
         connection to sparkifydb that autocommits transactions
     cur : psycopg2.cursor
         cursor for sparkifydb to manage transactions
+    load_optimized : bool, default False
+        use the `create_table_queries_load_optimized` list instead, creating songplays without primary and foreign keys
+        so they can be added by post_load.py after loading
+    partitioned : bool, default False
+        create songplays partitioned by start_time month
         
     Returns
     -------
     None
     """
-    for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
-
-
-def main():
+    queries = create_table_queries_load_optimized if load_optimized else create_table_queries
+    if partitioned:
+        replace = {
+            songplay_table_create: songplay_table_create_partitioned,
+            songplay_table_create_unconstrained: songplay_table_create_partitioned_unconstrained
+        }
+        queries = [replace.get(query, query) for query in queries]
+    with metrics.stage('create') as record:
+        for query in queries:
+            cur.execute(query)
+            conn.commit()
+        record['rows_out'] += len(queries)
+
+
+def main(load_optimized=False, partitioned=False, metrics_dir=None):
     """ Performs database and table creation steps.
 
     Drops (if exists) then creates the sparkify database.  Creates all tables needed within the sparkify database. 
 
     Parameters
     ----------
-    None
+    load_optimized : bool, default False
+        create songplays without primary and foreign keys to speed up loading
+    partitioned : bool, default False
+        create songplays partitioned by start_time month
+    metrics_dir : str, optional
+        directory to write the run report postgres_create_tables.json and Prometheus textfile postgres_create_tables.prom
         
     Returns
     -------
     None 
     """
-    cur, conn = create_database()
+    run = metrics.start('postgres_create_tables')
+
+    with metrics.stage('create', 'sparkifydb'):
+        cur, conn = create_database()
     
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    try:
+        drop_tables(cur, conn)
+        create_tables(cur, conn, load_optimized, partitioned)
+    finally:
+        conn.close()
 
-    conn.close()
+        print(run.summary())
+        if metrics_dir:
+            run.write(metrics_dir)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--load-optimized', action='store_true', help='create songplays without keys until post_load.py')
+    parser.add_argument('--partitioned', action='store_true', help='create songplays partitioned by start_time month')
+    parser.add_argument('--metrics-dir', type=str, default=None, help='directory to write the run report and Prometheus textfile')
+
+    args = parser.parse_args()
+
+    main(load_optimized=args.load_optimized, partitioned=args.partitioned, metrics_dir=args.metrics_dir)
\ No newline at end of file
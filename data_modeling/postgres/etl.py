@@ -1,12 +1,110 @@
 import os
+import io
 import glob
+import argparse
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
 import psycopg2
 import pandas as pd
+from collections import deque
+from itertools import islice
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import metrics
 from sql_queries import *
+from song_index import SongIndex
+from time_dimension import TimeDimension, time_frame
+from ingest_manifest import fingerprint, unprocessed_files, record_file
+from partitions import SongplayPartitions
 
 
-def process_song_file(cur, filepath):
-    """ Reads each song file then saves in an SQL table as defined by sql_queries.artist_table_insert.
+def read_log_file(filepath):
+    """ Reads a log file keeping only NextSong actions, with the ts column converted to datetime column t.
+
+    Parameters
+    ----------
+    filepath : str
+        path to a single log file
+
+    Returns
+    -------
+    log : pandas.DataFrame
+        song play events from the log file
+    """
+
+    # open log file
+    with metrics.stage('parse', 'log_data') as record:
+        log = pd.read_json(filepath, lines=True)
+        record['bytes_read'] += os.path.getsize(filepath)
+        record['rows_out'] += len(log)
+
+    return filter_log(log)
+
+
+def read_log_chunks(filepath, chunksize):
+    """ Reads a log file chunksize lines at a time, keeping only NextSong actions like read_log_file.
+
+    Only one chunk is held in memory at a time, so memory use depends on chunksize instead of the size of the file.
+
+    Parameters
+    ----------
+    filepath : str
+        path to a single log file
+    chunksize : int
+        number of lines read at a time
+
+    Returns
+    -------
+    log : generator
+        pandas.DataFrame of song play events for each chunk of the log file
+    """
+
+    metrics.current.add('parse', 'log_data', bytes_read=os.path.getsize(filepath))
+
+    with pd.read_json(filepath, lines=True, chunksize=chunksize) as reader:
+        chunks = iter(reader)
+        while True:
+            # time reading each chunk separately from processing it
+            with metrics.stage('parse', 'log_data') as record:
+                log = next(chunks, None)
+                if log is None:
+                    break
+                record['rows_out'] += len(log)
+            yield filter_log(log)
+
+
+def filter_log(log):
+    """ Keeps only NextSong actions of log events, with the ts column converted to datetime column t.
+
+    Parameters
+    ----------
+    log : pandas.DataFrame
+        events read from a log file
+
+    Returns
+    -------
+    log : pandas.DataFrame
+        song play events
+    """
+
+    with metrics.stage('transform', 'log_data') as record:
+        record['rows_in'] += len(log)
+
+        # filter by NextSong action
+        log = log[log['page']=='NextSong']
+
+        # convert timestamp column to datetime
+        log['t'] = pd.to_datetime(log['ts'], unit='ms')
+        record['rows_out'] += len(log)
+
+    return log
+
+
+def process_song_file(cur, filepath, song_index=None):
+    """ Reads each song file then saves every record in an SQL table as defined by sql_queries.song_table_insert and sql_queries.artist_table_insert.
 
     Parameters
     ----------
@@ -14,28 +112,45 @@ def process_song_file(cur, filepath):
         cursor for sparkifydb to manage transactions
     filepath : str
         path to a single song file
+    song_index : song_index.SongIndex, optional
+        index kept up to date with the inserted song and artist
 
     Returns
     -------
-    None
+    row_counts : dict
+        keys = table name, values = number of records inserted
     """
 
     # open song file
-    song_file = pd.read_json(filepath, lines=True)
+    with metrics.stage('parse', 'song_data') as record:
+        song_file = pd.read_json(filepath, lines=True)
+        record['bytes_read'] += os.path.getsize(filepath)
+        record['rows_out'] += len(song_file)
 
-    # insert song record
-    song_data = song_file[['song_id','title','artist_id','year','duration']].values[0]
-    cur.execute(song_table_insert, song_data)
+    # insert song records
+    with metrics.stage('insert', 'songs') as record:
+        for song_data in song_file[['song_id','title','artist_id','year','duration']].values:
+            cur.execute(song_table_insert, song_data)
+            record['rows_out'] += cur.rowcount
+        record['rows_in'] += len(song_file)
     
-    # insert artist record
-    artist_data = song_file[['artist_id','artist_name','artist_location','artist_latitude','artist_longitude']].values[0]
-    cur.execute(artist_table_insert, artist_data)
+    # insert artist records
+    with metrics.stage('insert', 'artists') as record:
+        for artist_data in song_file[['artist_id','artist_name','artist_location','artist_latitude','artist_longitude']].values:
+            cur.execute(artist_table_insert, artist_data)
+            record['rows_out'] += cur.rowcount
+        record['rows_in'] += len(song_file)
+
+    if song_index is not None:
+        song_index.add(song_file, song_file.rename(columns={'artist_name': 'name'}))
+
+    return {'songs': len(song_file), 'artists': len(song_file)}
 
 
-def process_log_file(cur, filepath):
+def process_log_file(cur, filepath, song_index=None, time_dimension=None, partitions=None):
     """ Reads each log file then saves in an SQL table as defined by sql_queries.user_table_insert and sql_queries.songplays_table_insert.
 
-    Retrives song_id & artist_id for sql_queries.songplays_table_insert using sql_queries.song_select.
+    Retrives song_id & artist_id for sql_queries.songplays_table_insert using song_index if given, otherwise using sql_queries.song_select.
 
     Parameters
     ----------
@@ -43,93 +158,812 @@ def process_log_file(cur, filepath):
         cursor for sparkifydb to manage transactions
     filepath : str
         path to a single long file
+    song_index : song_index.SongIndex, optional
+        index to find song_id & artist_id of all song plays at once instead of querying for each song play
+    time_dimension : time_dimension.TimeDimension, optional
+        known timestamps so that only new time records are inserted
+    partitions : partitions.SongplayPartitions, optional
+        creates the songplays partitions for the months of the song plays
 
     Returns
     -------
-    None
+    row_counts : dict
+        keys = table name, values = number of records inserted
     """
 
     # open log file
-    log = pd.read_json(filepath, lines=True)
-
-    # filter by NextSong action
-    log = log[log['page']=='NextSong']
-
-    # convert timestamp column to datetime
-    log['t'] = pd.to_datetime(log['ts'], unit='ms')
+    log = read_log_file(filepath)
     
     # insert time data records
-    time_data = (log['t'], log['t'].dt.hour, log['t'].dt.day, log['t'].dt.week, log['t'].dt.month, log['t'].dt.year, log['t'].dt.weekday)
-    column_labels = ('timestamp', 'hour', 'day', 'week of year', 'month', 'year', 'weekday')
-    time_df = pd.DataFrame({col: time_data[idx] for idx,col in enumerate(column_labels)})
+    with metrics.stage('transform', 'time') as record:
+        time_df = time_frame(log['t'])
+        record['rows_in'] += len(time_df)
+        if time_dimension is not None:
+            time_df = time_dimension.new_rows(time_df)
+        record['rows_out'] += len(time_df)
 
-    for _, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+    with metrics.stage('insert', 'time') as record:
+        for _, row in time_df.iterrows():
+            cur.execute(time_table_insert, list(row))
+            record['rows_out'] += cur.rowcount
+        record['rows_in'] += len(time_df)
 
     # load user table
     user_df = log[['userId','firstName','lastName','gender','level']]
 
     # insert user records
-    for _, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
-
-    # insert songplay records
-    for _, row in log.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
-
-        # insert songplay record
-        songplay_data = (row.t, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
-
-
-def process_data(cur, conn, filepath, func):
+    with metrics.stage('insert', 'users') as record:
+        for _, row in user_df.iterrows():
+            cur.execute(user_table_insert, row)
+            record['rows_out'] += cur.rowcount
+        record['rows_in'] += len(user_df)
+
+    with metrics.stage('insert', 'songplays') as record:
+
+        # get songid and artistid of all song plays from the index
+        if song_index is not None:
+            found = song_index.match(log)
+
+        if partitions is not None:
+            partitions.ensure(cur, log['t'])
+
+        # insert songplay records
+        for idx, row in log.iterrows():
+            
+            # get songid and artistid from song and artist tables
+            if song_index is not None:
+                songid, artistid = found.at[idx, 'song_id'], found.at[idx, 'artist_id']
+            else:
+                cur.execute(song_select, (row.song, row.artist, row.length))
+                results = cur.fetchone()
+            
+                if results:
+                    songid, artistid = results
+                else:
+                    songid, artistid = None, None
+
+            # insert songplay record
+            songplay_data = (row.t, row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
+            cur.execute(songplay_table_insert, songplay_data)
+            record['rows_out'] += cur.rowcount
+        record['rows_in'] += len(log)
+
+    return {'time': len(time_df), 'users': len(user_df), 'songplays': len(log)}
+
+
+def copy_dataframe(cur, df, table):
+    """ Streams a DataFrame into an SQL table using a single COPY FROM STDIN statement.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    df : pandas.DataFrame
+        records to copy with column names matching the SQL table
+    table : str
+        name of the SQL table to copy into
+
+    Returns
+    -------
+    None
+    """
+
+    # write as CSV using an explicit null marker so empty strings are not loaded as nulls
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=False, na_rep='\\N')
+    buffer.seek(0)
+
+    query = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(table, ', '.join(df.columns))
+    with metrics.stage('copy', table) as record:
+        cur.copy_expert(query, buffer)
+        record['rows_in'] += len(df)
+        record['rows_out'] += cur.rowcount
+
+
+def merge_staged(cur, query, table, rows_in):
+    """ Merges staged records into an SQL table, recording the merge as the insert stage of the table.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    query : str
+        merge from sql_queries such as song_table_merge
+    table : str
+        name of the SQL table merged into
+    rows_in : int
+        number of staged records
+
+    Returns
+    -------
+    None
+    """
+
+    with metrics.stage('insert', table) as record:
+        cur.execute(query)
+        record['rows_in'] += rows_in
+        record['rows_out'] += cur.rowcount
+
+
+def parse_song_file(filepath):
+    """ Reads each song file into records ready to load into the songs and artists tables.
+
+    Only uses the file path so it can run in a separate process from the database connection.
+
+    Parameters
+    ----------
+    filepath : str
+        path to a single song file
+
+    Returns
+    -------
+    batch : dict
+        keys = table name, values = pandas.DataFrame of records with column names matching the SQL table
+    """
+
+    # open song file
+    with metrics.stage('parse', 'song_data') as record:
+        song_file = pd.read_json(filepath, lines=True)
+        record['bytes_read'] += os.path.getsize(filepath)
+        record['rows_out'] += len(song_file)
+
+    # keep the first record for each song and artist like song_table_insert and artist_table_insert
+    with metrics.stage('transform', 'song_data') as record:
+        song_df = song_file[['song_id','title','artist_id','year','duration']].drop_duplicates('song_id')
+        artist_df = song_file[['artist_id','artist_name','artist_location','artist_latitude','artist_longitude']].drop_duplicates('artist_id')
+        artist_df.columns = ['artist_id','name','location','latitude','longitude']
+        record['rows_in'] += len(song_file)
+        record['rows_out'] += len(song_df) + len(artist_df)
+
+    return {'songs': song_df, 'artists': artist_df}
+
+
+def parse_log_file(filepath):
+    """ Reads each log file into records ready to load into the time, users and songplays tables.
+
+    Only uses the file path so it can run in a separate process from the database connection. Song plays keep the song,
+    artist and length columns as song_id & artist_id are found when loading.
+
+    Parameters
+    ----------
+    filepath : str
+        path to a single log file
+
+    Returns
+    -------
+    batch : dict
+        keys = table name, values = pandas.DataFrame of records with column names matching the SQL table
+    """
+
+    # open log file
+    log = read_log_file(filepath)
+
+    return log_batch(log)
+
+
+def log_batch(log):
+    """ Transforms song play events into records ready to load into the time, users and songplays tables.
+
+    Parameters
+    ----------
+    log : pandas.DataFrame
+        song play events from read_log_file or read_log_chunks
+
+    Returns
+    -------
+    batch : dict
+        keys = table name, values = pandas.DataFrame of records with column names matching the SQL table
+    """
+
+    with metrics.stage('transform', 'log_data') as record:
+        time_df = time_frame(log['t']).drop_duplicates('start_time')
+
+        # keep the last level for each user like repeated user_table_insert calls
+        user_df = log[['userId','firstName','lastName','gender','level']].drop_duplicates('userId', keep='last')
+        user_df.columns = ['user_id','first_name','last_name','gender','level']
+
+        songplay_df = log[['t','userId','level','song','artist','length','sessionId','location','userAgent']]
+        songplay_df.columns = ['start_time','user_id','level','song','artist','length','session_id','location','user_agent']
+
+    return {'time': time_df, 'users': user_df, 'songplays': songplay_df}
+
+
+def load_song_batch(cur, batch, song_index=None):
+    """ Bulk loads records from parse_song_file into the songs and artists tables.
+
+    Records are copied into staging tables then merged using sql_queries.song_table_merge and sql_queries.artist_table_merge.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    batch : dict
+        records returned by parse_song_file
+    song_index : song_index.SongIndex, optional
+        index kept up to date with the inserted songs and artists
+
+    Returns
+    -------
+    row_counts : dict
+        keys = table name, values = number of records loaded
+    """
+
+    for query in staging_table_queries:
+        cur.execute(query)
+    cur.execute(staging_table_truncate)
+
+    # stage then merge song records
+    copy_dataframe(cur, batch['songs'], 'songs_staging')
+    merge_staged(cur, song_table_merge, 'songs', len(batch['songs']))
+
+    # stage then merge artist records
+    copy_dataframe(cur, batch['artists'], 'artists_staging')
+    merge_staged(cur, artist_table_merge, 'artists', len(batch['artists']))
+
+    if song_index is not None:
+        song_index.add(batch['songs'], batch['artists'])
+
+    return {table: len(df) for table, df in batch.items()}
+
+
+def load_log_batch(cur, batch, song_index=None, time_dimension=None, partitions=None):
+    """ Bulk loads records from parse_log_file into the time, users and songplays tables.
+
+    Records are copied into staging tables then merged using sql_queries.time_table_merge, sql_queries.user_table_merge
+    and sql_queries.songplay_table_merge. song_id & artist_id are found during the merge instead of one query per record,
+    or if song_index is given found in memory with song plays copied directly into the songplays table.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    batch : dict
+        records returned by parse_log_file
+    song_index : song_index.SongIndex, optional
+        index to find song_id & artist_id of all song plays at once
+    time_dimension : time_dimension.TimeDimension, optional
+        known timestamps so that only new time records are loaded
+    partitions : partitions.SongplayPartitions, optional
+        creates the songplays partitions for the months of the song plays
+
+    Returns
+    -------
+    row_counts : dict
+        keys = table name, values = number of records loaded
+    """
+
+    for query in staging_table_queries:
+        cur.execute(query)
+    cur.execute(staging_table_truncate)
+
+    # stage then merge time records
+    time_df = batch['time']
+    if time_dimension is not None:
+        time_df = time_dimension.new_rows(time_df)
+    copy_dataframe(cur, time_df, 'time_staging')
+    merge_staged(cur, time_table_merge, 'time', len(time_df))
+
+    # stage then merge user records
+    copy_dataframe(cur, batch['users'], 'users_staging')
+    merge_staged(cur, user_table_merge, 'users', len(batch['users']))
+
+    songplay_df = batch['songplays']
+
+    if partitions is not None:
+        partitions.ensure(cur, songplay_df['start_time'])
+
+    # songplays have no conflict rule so can be copied directly once song_id and artist_id are known
+    if song_index is not None:
+        found = song_index.match(songplay_df)
+        songplay_df = songplay_df.drop(columns=['song','artist','length'])
+        songplay_df.insert(3, 'song_id', found['song_id'])
+        songplay_df.insert(4, 'artist_id', found['artist_id'])
+        copy_dataframe(cur, songplay_df, 'songplays')
+    else:
+        # stage then merge songplay records
+        copy_dataframe(cur, songplay_df, 'songplays_staging')
+        merge_staged(cur, songplay_table_merge, 'songplays', len(songplay_df))
+
+    return {'time': len(time_df), 'users': len(batch['users']), 'songplays': len(songplay_df)}
+
+
+def process_song_file_bulk(cur, filepath, song_index=None):
+    """ Reads each song file then bulk loads it into the songs and artists tables using load_song_batch.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    filepath : str
+        path to a single song file
+    song_index : song_index.SongIndex, optional
+        index kept up to date with the inserted songs and artists
+
+    Returns
+    -------
+    row_counts : dict
+        keys = table name, values = number of records loaded
+    """
+
+    return load_song_batch(cur, parse_song_file(filepath), song_index)
+
+
+def process_log_file_bulk(cur, filepath, song_index=None, time_dimension=None, partitions=None):
+    """ Reads each log file then bulk loads it into the time, users and songplays tables using load_log_batch.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    filepath : str
+        path to a single log file
+    song_index : song_index.SongIndex, optional
+        index to find song_id & artist_id of all song plays at once
+    time_dimension : time_dimension.TimeDimension, optional
+        known timestamps so that only new time records are loaded
+    partitions : partitions.SongplayPartitions, optional
+        creates the songplays partitions for the months of the song plays
+
+    Returns
+    -------
+    row_counts : dict
+        keys = table name, values = number of records loaded
+    """
+
+    return load_log_batch(cur, parse_log_file(filepath), song_index, time_dimension, partitions)
+
+
+def process_log_file_streaming(cur, filepath, song_index=None, time_dimension=None, partitions=None, chunksize=10000):
+    """ Reads each log file in chunks then bulk loads each chunk using load_log_batch, to limit memory use for large files.
+
+    The peak resident memory while processing the file is printed to help choose chunksize.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    filepath : str
+        path to a single log file
+    song_index : song_index.SongIndex, optional
+        index to find song_id & artist_id of all song plays at once
+    time_dimension : time_dimension.TimeDimension, optional
+        known timestamps so that only new time records are loaded
+    partitions : partitions.SongplayPartitions, optional
+        creates the songplays partitions for the months of the song plays
+    chunksize : int, default 10000
+        number of lines read at a time
+
+    Returns
+    -------
+    row_counts : dict
+        keys = table name, values = number of records loaded
+    """
+
+    row_counts = {}
+    peak = memory_rss()
+    peak_before = memory_peak()
+
+    # read, transform and load one chunk at a time
+    batches = (log_batch(log) for log in read_log_chunks(filepath, chunksize))
+    for batch in batches:
+        peak = max(peak, memory_rss())
+        for table, rows in load_log_batch(cur, batch, song_index, time_dimension, partitions).items():
+            row_counts[table] = row_counts.get(table, 0) + rows
+
+    # samples between chunks miss the memory used while a chunk is transformed and loaded, which the process peak
+    # includes if it was reached while processing this file
+    peak_after = memory_peak()
+    if peak_after > peak_before:
+        peak = max(peak, peak_after)
+
+    if peak:
+        print('Peak memory of {:.1f} MB processing {}.'.format(peak/1e6, filepath))
+
+    return row_counts
+
+
+def memory_rss():
+    """ Resident memory of this process, or its peak if the current value is not available.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    rss : int
+        bytes of resident memory, 0 if not available on this platform
+    """
+
+    # current value on Linux
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+
+    return memory_peak()
+
+
+def memory_peak():
+    """ Peak resident memory of this process since it started.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    rss : int
+        bytes of peak resident memory, 0 if not available on this platform
+    """
+
+    # kilobytes on Linux and bytes on macOS
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if os.uname().sysname == 'Darwin' else rss * 1024
+
+    return 0
+
+
+def find_files(filepath):
+    """ Finds all json files within a directory and its subdirectories.
+
+    Parameters
+    ----------
+    filepath : str
+        directory to search
+
+    Returns
+    -------
+    all_files : list
+        absolute path of each json file
+    """
+
+    # get all files matching extension from directory
+    with metrics.stage('discover', os.path.basename(os.path.normpath(filepath))) as record:
+        all_files = []
+        for root, dirs, files in os.walk(filepath):
+            files = glob.glob(os.path.join(root,'*.json'))
+            for f in files :
+                all_files.append(os.path.abspath(f))
+        record['rows_out'] += len(all_files)
+
+    return all_files
+
+
+def process_data(cur, conn, filepath, func, incremental=False, reload_changed=True):
+    """ Processes each json file within a directory, committing after each file.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    conn : psycopg2.connection
+        connection to sparkifydb
+    filepath : str
+        directory of json files to process
+    func : function
+        called with cur and the path of each file, such as process_song_file or process_log_file
+    incremental : bool, default False
+        only process files that are new or changed since recorded in the etl_manifest table, otherwise process every
+        file, each file is recorded in the etl_manifest table either way
+    reload_changed : bool, default True
+        when incremental, also process files changed since recorded, False for log files whose song plays would be
+        duplicated
+
+    Returns
+    -------
+    None
+    """
+
     # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
+    all_files = find_files(filepath)
 
     # get total number of files found
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
 
-    # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
+    # skip files already processed in a previous run
+    if incremental:
+        pending = unprocessed_files(cur, all_files, reload_changed)
+        num_files = len(pending)
+        print('{} files are new or changed since the previous run.'.format(num_files))
+    else:
+        pending = [fingerprint(datafile) for datafile in all_files]
+
+    # iterate over files and process, recording each file in the same transaction as its records
+    for i, info in enumerate(pending, 1):
+        row_counts = func(cur, info['filepath'])
+        record_file(cur, info, row_counts)
         conn.commit()
         print('{}/{} files processed.'.format(i, num_files))
 
 
-def main():
-    """ Processes song and log files by determining folder contents and then calling the appropriate processing function.
-    
+def parse_recorded(parse, filepath):
+    """ Parses a file in a worker process, returning the stages recorded by the worker so they can be added to the run.
+
     Parameters
     ----------
+    parse : function
+        parse_song_file or parse_log_file
+    filepath : str
+        path to a single data file
+
+    Returns
+    -------
+    batch : dict
+        records returned by parse
+    stages : dict
+        metrics.Metrics.stages recorded while parsing
+    """
+
+    run = metrics.start('worker')
+    batch = parse(filepath)
+
+    return batch, run.stages
+
+
+def process_data_parallel(cur, conn, filepath, parse, load, workers=None, queue_depth=None, incremental=False,
+    reload_changed=True):
+    """ Parses files in a pool of processes while loading the parsed records using a single connection.
+
+    Records are loaded in the same order as process_data would process the files. At most queue_depth files are parsed
+    or waiting to be loaded at one time to limit memory use.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    conn : psycopg2.connection
+        connection to sparkifydb
+    filepath : str
+        directory of json files to process
+    parse : function
+        parse_song_file or parse_log_file, called with each file path in a separate process
+    load : function
+        load_song_batch or load_log_batch, called with cur and the records returned by parse
+    workers : int, optional
+        number of processes, defaults to the number of CPUs
+    queue_depth : int, optional
+        maximum number of files parsed ahead of loading, defaults to twice the number of processes
+    incremental : bool, default False
+        only process files that are new or changed since recorded in the etl_manifest table, otherwise process every
+        file, each file is recorded in the etl_manifest table either way
+    reload_changed : bool, default True
+        when incremental, also process files changed since recorded, False for log files whose song plays would be
+        duplicated
+
+    Returns
+    -------
     None
+    """
+
+    all_files = find_files(filepath)
+
+    # get total number of files found
+    num_files = len(all_files)
+    print('{} files found in {}'.format(num_files, filepath))
+
+    # skip files already processed in a previous run
+    if incremental:
+        files = unprocessed_files(cur, all_files, reload_changed)
+        num_files = len(files)
+        print('{} files are new or changed since the previous run.'.format(num_files))
+    else:
+        files = [fingerprint(datafile) for datafile in all_files]
+
+    workers = workers or os.cpu_count()
+    queue_depth = queue_depth or 2*workers
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        # start parsing the first files then parse another file each time one is loaded
+        remaining = iter(files)
+        pending = deque((info, executor.submit(parse_recorded, parse, info['filepath'])) for info in islice(remaining, queue_depth))
+
+        i = 0
+        while pending:
+            info, parsed = pending.popleft()
+            batch, stages = parsed.result()
+            metrics.current.merge(stages)
+            for following in islice(remaining, 1):
+                pending.append((following, executor.submit(parse_recorded, parse, following['filepath'])))
+
+            row_counts = load(cur, batch)
+            record_file(cur, info, row_counts)
+            conn.commit()
+            i += 1
+            print('{}/{} files processed.'.format(i, num_files))
+
+
+def process_song_files_batched(cur, conn, filepath, song_index=None, files_per_read=1000, commit_rows=50000, incremental=False):
+    """ Bulk loads song files many at a time instead of one file per transaction.
+
+    Every record of each file is read, then songs and artists already loaded during this run are removed in memory
+    before the remaining records are loaded using load_song_batch. Changes are committed once at least commit_rows
+    records have been loaded since the previous commit.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    conn : psycopg2.connection
+        connection to sparkifydb
+    filepath : str
+        directory of song files to process
+    song_index : song_index.SongIndex, optional
+        index kept up to date with the inserted songs and artists
+    files_per_read : int, default 1000
+        number of files read into a single DataFrame before loading
+    commit_rows : int, default 50000
+        minimum number of records loaded between commits
+    incremental : bool, default False
+        only process files that are new or changed since recorded in the etl_manifest table, otherwise process every
+        file, each file is recorded in the etl_manifest table either way
 
     Returns
     -------
     None
+    """
+
+    all_files = find_files(filepath)
+
+    # get total number of files found
+    num_files = len(all_files)
+    print('{} files found in {}'.format(num_files, filepath))
+
+    # skip files already processed in a previous run
+    if incremental:
+        files = unprocessed_files(cur, all_files)
+        num_files = len(files)
+        print('{} files are new or changed since the previous run.'.format(num_files))
+    else:
+        files = [fingerprint(datafile) for datafile in all_files]
+
+    seen_songs, seen_artists = set(), set()
+    uncommitted, processed = 0, 0
+    for start in range(0, num_files, files_per_read):
+        chunk = files[start:start+files_per_read]
+        batches = [parse_song_file(info['filepath']) for info in chunk]
+
+        # dedup records within the chunk and against earlier chunks
+        song_df = pd.concat([batch['songs'] for batch in batches], ignore_index=True).drop_duplicates('song_id')
+        song_df = song_df[~song_df['song_id'].isin(seen_songs)]
+        artist_df = pd.concat([batch['artists'] for batch in batches], ignore_index=True).drop_duplicates('artist_id')
+        artist_df = artist_df[~artist_df['artist_id'].isin(seen_artists)]
+        seen_songs.update(song_df['song_id'])
+        seen_artists.update(artist_df['artist_id'])
+
+        load_song_batch(cur, {'songs': song_df, 'artists': artist_df}, song_index)
+        for info, batch in zip(chunk, batches):
+            record_file(cur, info, {table: len(df) for table, df in batch.items()})
+
+        uncommitted += len(song_df) + len(artist_df)
+        processed += len(chunk)
+        if uncommitted >= commit_rows or processed == num_files:
+            conn.commit()
+            uncommitted = 0
+            print('{}/{} files processed.'.format(processed, num_files))
+
+
+def main(bulk=False, workers=0, queue_depth=None, files_per_read=1000, commit_rows=50000, chunksize=None, data_dir='data', metrics_dir=None,
+    incremental=True):
+    """ Processes song and log files by determining folder contents and then calling the appropriate processing function.
+    
+    Parameters
+    ----------
+    bulk : bool, default False
+        load each file using COPY into staging tables and set-based merges instead of one insert per record
+    workers : int, default 0
+        number of processes parsing files for a bulk load, 0 parses each file as it is loaded
+    queue_depth : int, optional
+        maximum number of parsed files waiting to be loaded when workers are used
+    files_per_read : int, default 1000
+        number of song files read at once for a bulk load without workers
+    commit_rows : int, default 50000
+        minimum number of song and artist records loaded between commits for a bulk load without workers
+    chunksize : int, optional
+        number of lines of each log file read at a time for a bulk load without workers, whole files if not given
+    data_dir : str, default 'data'
+        directory containing the song_data and log_data directories
+    metrics_dir : str, optional
+        directory to write the run report postgres_etl.json and Prometheus textfile postgres_etl.prom, only printed
+        if not given
+    incremental : bool, default True
+        only process files that are new or changed since recorded in the etl_manifest table, otherwise process every
+        file such as after recreating the tables with create_tables.py
+
+    Returns
+    -------
+    timings : dict
+        keys = stage name, values = seconds taken by the stage
     
     """
 
+    song_data = os.path.join(data_dir, 'song_data')
+    log_data = os.path.join(data_dir, 'log_data')
+    run = metrics.start('postgres_etl')
+
     conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
     cur = conn.cursor()
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    try:
+        with metrics.stage('setup'):
+
+            # find song_id and artist_id in memory, starting with songs from any previous run
+            song_index = SongIndex()
+            song_index.load(cur)
 
-    conn.close()
+            # only emit time records for timestamps not loaded by any previous file or run
+            time_dimension = TimeDimension()
+            time_dimension.load(cur)
+
+            # create monthly partitions as needed if songplays was created partitioned
+            partitions = SongplayPartitions()
+            if not partitions.load(cur):
+                partitions = None
+
+        # files already recorded in the etl_manifest table are skipped, so a run resumes after the last committed file
+        # changed log files are skipped too as their song plays would be inserted again
+        with metrics.stage('load', 'song_data'):
+            if workers:
+                process_data_parallel(cur, conn, filepath=song_data, parse=parse_song_file,
+                    load=partial(load_song_batch, song_index=song_index), workers=workers, queue_depth=queue_depth, incremental=incremental)
+            elif bulk:
+                process_song_files_batched(cur, conn, filepath=song_data, song_index=song_index,
+                    files_per_read=files_per_read, commit_rows=commit_rows, incremental=incremental)
+            else:
+                process_data(cur, conn, filepath=song_data, func=partial(process_song_file, song_index=song_index),
+                    incremental=incremental)
+
+        print('Song index of {} songs uses {:.1f} MB of memory.'.format(len(song_index.index), song_index.memory_usage()/1e6))
+
+        with metrics.stage('load', 'log_data'):
+            if workers:
+                process_data_parallel(cur, conn, filepath=log_data, parse=parse_log_file,
+                    load=partial(load_log_batch, song_index=song_index, time_dimension=time_dimension, partitions=partitions),
+                    workers=workers, queue_depth=queue_depth, incremental=incremental, reload_changed=False)
+            else:
+                if bulk and chunksize:
+                    process_log = partial(process_log_file_streaming, chunksize=chunksize)
+                elif bulk:
+                    process_log = process_log_file_bulk
+                else:
+                    process_log = process_log_file
+                process_data(cur, conn, filepath=log_data,
+                    func=partial(process_log, song_index=song_index, time_dimension=time_dimension, partitions=partitions),
+                    incremental=incremental, reload_changed=False)
+    finally:
+        conn.close()
+
+        # report the stages that ran even if the run failed
+        print(run.summary())
+        if metrics_dir:
+            run.write(metrics_dir)
+            print('Saved run report and Prometheus metrics into directory {}.'.format(metrics_dir))
+
+    timings = {stage: run.stages[key]['seconds'] for stage, key in
+        [('setup', ('setup', None)), ('song_data', ('load', 'song_data')), ('log_data', ('load', 'log_data'))]}
+
+    return timings
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bulk', action='store_true', help='load files using COPY and set-based merges')
+    parser.add_argument('--workers', type=int, default=0, help='processes parsing files for a bulk load')
+    parser.add_argument('--queue-depth', type=int, default=None, help='maximum parsed files waiting to be loaded')
+    parser.add_argument('--files-per-read', type=int, default=1000, help='song files read at once for a bulk load')
+    parser.add_argument('--commit-rows', type=int, default=50000, help='song and artist records loaded between commits')
+    parser.add_argument('--chunksize', type=int, default=None, help='log file lines read at a time for a bulk load')
+    parser.add_argument('--data-dir', type=str, default='data', help='directory containing song_data and log_data')
+    parser.add_argument('--metrics-dir', type=str, default=None, help='directory to write the run report and Prometheus textfile')
+    parser.add_argument('--full', action='store_true', help='process every file, such as after recreating the tables')
+
+    args = parser.parse_args()
+
+    main(bulk=args.bulk or args.workers>0, workers=args.workers, queue_depth=args.queue_depth,
+        files_per_read=args.files_per_read, commit_rows=args.commit_rows, chunksize=args.chunksize, data_dir=args.data_dir,
+        metrics_dir=args.metrics_dir, incremental=not args.full)
\ No newline at end of file
@@ -0,0 +1,130 @@
+""" Tracks the files loaded by etl.py so that later runs only process new or changed files."""
+
+import os
+import json
+import hashlib
+import metrics
+from sql_queries import manifest_select, manifest_upsert
+
+
+def fingerprint(filepath):
+    """ Describes a file by its size, modification time and content hash.
+
+    Parameters
+    ----------
+    filepath : str
+        path to a single data file
+
+    Returns
+    -------
+    info : dict
+        filepath, size in bytes, mtime in seconds since the epoch and sha256 hex digest
+    """
+
+    stat = os.stat(filepath)
+    info = {'filepath': filepath, 'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': file_hash(filepath)}
+
+    return info
+
+
+def file_hash(filepath):
+    """ Computes the sha256 hex digest of a file, reading it in blocks to limit memory use.
+
+    Parameters
+    ----------
+    filepath : str
+        path to a single data file
+
+    Returns
+    -------
+    digest : str
+        sha256 hex digest of the file contents
+    """
+
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 20), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def unprocessed_files(cur, all_files, reload_changed=True):
+    """ Finds files not yet recorded in the manifest or changed since they were recorded.
+
+    Files with the same size and modification time as recorded are skipped without being read. Otherwise the content
+    hash is compared, so a file that was only touched is also skipped.
+
+    Songs and artists are upserted by their keys so a changed song file can be loaded again. Songplays have no natural
+    key, so loading a changed log file again would insert its earlier song plays a second time. Such files are listed
+    and skipped when reload_changed is False, to be reloaded by a full run after recreating the tables.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    all_files : list
+        absolute path of each data file
+    reload_changed : bool, default True
+        process files changed since they were recorded, otherwise skip them
+
+    Returns
+    -------
+    pending : list
+        fingerprint of each file to process, in the order of all_files
+    """
+
+    with metrics.stage('discover', 'etl_manifest') as record:
+        cur.execute(manifest_select)
+        recorded = {row[0]: row[1:] for row in cur.fetchall()}
+
+        pending, changed = [], []
+        for filepath in all_files:
+            previous = recorded.get(filepath)
+            if previous is not None:
+                size, mtime, sha256 = previous
+                stat = os.stat(filepath)
+                if stat.st_size == size and stat.st_mtime == mtime:
+                    continue
+
+            info = fingerprint(filepath)
+            record['bytes_read'] += info['size']
+            if previous is not None:
+                if info['sha256'] == sha256:
+                    continue
+                if not reload_changed:
+                    changed.append(filepath)
+                    continue
+                print('File {} changed since it was processed and will be loaded again.'.format(filepath))
+            pending.append(info)
+        record['rows_in'] += len(all_files)
+        record['rows_out'] += len(pending)
+
+    if changed:
+        print('{} files changed since they were processed and are skipped, as loading them again would duplicate their '
+            'song plays. Recreate the tables and run etl.py --full to reload them:'.format(len(changed)))
+        for filepath in changed:
+            print('  {}'.format(filepath))
+
+    return pending
+
+
+def record_file(cur, info, row_counts):
+    """ Records a processed file in the manifest. Executed in the same transaction as loading the file so a file is
+    either loaded and recorded or neither.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    info : dict
+        fingerprint of the file
+    row_counts : dict
+        keys = table name, values = number of records loaded from the file
+
+    Returns
+    -------
+    None
+    """
+
+    cur.execute(manifest_upsert, (info['filepath'], info['size'], info['mtime'], info['sha256'], json.dumps(row_counts)))
@@ -1,7 +1,9 @@
-'''Explorary data analysis to determine null-able columns.'''
+'''Explorary data analysis to determine null-able columns.
+
+Null counts are computed in SQL by column_profile.py so rows are not read into pandas.'''
 
 import psycopg2
-import pandas as pd
+from column_profile import profile_table
 
 conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
 cur = conn.cursor()
@@ -10,15 +12,11 @@ cur = conn.cursor()
 tables = ['artists','songplays','songs','time','users']
 for t in tables:
 
-    # select all values into a dataframe
-    cur.execute(f'SELECT * FROM {t}')
-    columns = [x.name for x in cur.description]
-    result = cur.fetchall()
-    df = pd.DataFrame(result, columns=columns)
+    # profile all columns with a single scan of the table
+    profile = profile_table(cur, t)
 
     # determine columsn without nulls
-    not_null = df.notna().all()
-    not_null = list(not_null[not_null].index)
+    not_null = [column for column, stats in profile['columns'].items() if not stats['nullable']]
 
     # output result for each table
     print(f'table: {t} not_null columns: {not_null}')
\ No newline at end of file
@@ -0,0 +1,190 @@
+""" Manages the monthly partitions of the songplays table when created with create_tables.py --partitioned.
+
+Partitions for the months of each batch of song plays are created by etl.py. This script removes old partitions for
+retention and shows partition pruning of a time range query.
+
+Retention Example
+-----------------
+partitions.py retain 2018-11
+
+Explain Example
+---------------
+partitions.py explain 2018-11-05 2018-11-06
+"""
+
+import argparse
+import psycopg2
+import pandas as pd
+from sql_queries import (
+    songplay_partition_create, songplay_partition_detach, songplay_partition_detach_finalize, songplay_partition_drop,
+    songplay_partition_select, songplay_partitioned_select, songplay_hourly_select
+)
+
+
+def partition_month(partition):
+    """ Month of a partition from its name such as songplays_2018_11.
+
+    Parameters
+    ----------
+    partition : str
+        partition table name
+
+    Returns
+    -------
+    month : pandas.Timestamp
+        first day of the month
+    """
+
+    return pd.Timestamp(partition[-7:].replace('_', '-') + '-01')
+
+
+class SongplayPartitions:
+    """ Creates monthly partitions of the songplays table as song plays for new months are loaded.
+
+    Attributes
+    ----------
+    months : set
+        first day of each month with a partition
+    """
+
+    def __init__(self):
+        self.months = set()
+
+    def load(self, cur):
+        """ Loads the existing partitions.
+
+        Parameters
+        ----------
+        cur : psycopg2.cursor
+            cursor for sparkifydb to manage transactions
+
+        Returns
+        -------
+        partitioned : bool
+            if the songplays table is partitioned
+        """
+
+        cur.execute(songplay_partitioned_select)
+        partitioned = cur.fetchone()[0]
+
+        cur.execute(songplay_partition_select)
+        self.months.update(partition_month(row[0]) for row in cur.fetchall())
+
+        return partitioned
+
+    def ensure(self, cur, start_time):
+        """ Creates the partitions needed for song plays, in the same transaction that loads them.
+
+        Parameters
+        ----------
+        cur : psycopg2.cursor
+            cursor for sparkifydb to manage transactions
+        start_time : pandas.Series
+            start time of each song play to load
+
+        Returns
+        -------
+        None
+        """
+
+        months = start_time.dt.to_period('M').dt.to_timestamp().unique()
+        months = {pd.Timestamp(month) for month in months} - self.months
+        for month in sorted(months):
+            cur.execute(songplay_partition_create.format(month=month, next_month=month + pd.DateOffset(months=1)))
+            self.months.add(month)
+
+
+def drop_partitions(cur, conn, before, detach_only=False):
+    """ Removes partitions of months before a given month.
+
+    Each partition is detached with DETACH PARTITION ... CONCURRENTLY, which waits for running queries on songplays
+    instead of blocking them, then dropped once it is a standalone table no query on songplays can read. Both run in
+    autocommit as CONCURRENTLY cannot run inside a transaction block.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    conn : psycopg2.connection
+        connection to sparkifydb
+    before : str
+        first month to keep such as '2018-11'
+    detach_only : bool, default False
+        keep the detached partitions as standalone tables instead of dropping them
+
+    Returns
+    -------
+    removed : list
+        name of each removed partition
+    """
+
+    before = pd.Timestamp(before)
+
+    cur.execute(songplay_partition_select)
+    removed = sorted(row[0] for row in cur.fetchall() if partition_month(row[0]) < before)
+    conn.commit()
+
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        for partition in removed:
+            try:
+                cur.execute(songplay_partition_detach.format(partition=partition))
+            except psycopg2.errors.ObjectNotInPrerequisiteState:
+                # a previous detach was interrupted and left the partition pending detach
+                cur.execute(songplay_partition_detach_finalize.format(partition=partition))
+            if not detach_only:
+                cur.execute(songplay_partition_drop.format(partition=partition))
+    finally:
+        conn.autocommit = autocommit
+
+    return removed
+
+
+def explain(cur, start, stop):
+    """ Query plan of hourly play counts between two times, which only scans partitions for months in the range.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    start : str
+        inclusive start time
+    stop : str
+        exclusive stop time
+
+    Returns
+    -------
+    plan : str
+        output of EXPLAIN
+    """
+
+    cur.execute('EXPLAIN ' + songplay_hourly_select, (start, stop))
+    plan = '\n'.join(row[0] for row in cur.fetchall())
+
+    return plan
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='plan', required=True)
+    retain = subparsers.add_parser('retain', help='remove partitions of months before a month')
+    retain.add_argument('before', type=str, help='first month to keep such as 2018-11')
+    retain.add_argument('--detach-only', action='store_true', help='detach partitions without dropping them')
+    plan = subparsers.add_parser('explain', help='show the query plan of hourly play counts between two times')
+    plan.add_argument('start', type=str)
+    plan.add_argument('stop', type=str)
+
+    args = parser.parse_args()
+
+    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    cur = conn.cursor()
+
+    if args.plan == 'retain':
+        removed = drop_partitions(cur, conn, args.before, args.detach_only)
+        print('Removed partitions: {}.'.format(removed))
+    elif args.plan == 'explain':
+        print(explain(cur, args.start, args.stop))
+
+    conn.close()
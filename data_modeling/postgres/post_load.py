@@ -0,0 +1,112 @@
+import time
+import psycopg2
+from sql_queries import (
+    post_load_index_queries, songplay_primary_key_add, songplay_foreign_key_add, songplay_foreign_key_validate,
+    songplay_foreign_key_add_partitioned, songplay_foreign_keys, songplay_constraint_select, songplay_partitioned_select,
+    analyze_tables
+)
+
+
+def build_indexes(cur, conn):
+    """ Creates each index using the queries in `post_load_index_queries` list, skipping indexes that already exist.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    conn : psycopg2.connection
+        connection to sparkifydb
+
+    Returns
+    -------
+    None
+    """
+    for query in post_load_index_queries:
+        cur.execute(query)
+        conn.commit()
+
+
+def add_constraints(cur, conn):
+    """ Adds the songplays primary and foreign keys that are not already defined.
+
+    Foreign keys are added as NOT VALID, so adding them does not check existing rows, then validated in a separate step.
+    If songplays is partitioned the primary key includes start_time and foreign keys are checked when added.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    conn : psycopg2.connection
+        connection to sparkifydb
+
+    Returns
+    -------
+    None
+    """
+    cur.execute(songplay_constraint_select)
+    existing = {row[0] for row in cur.fetchall()}
+
+    cur.execute(songplay_partitioned_select)
+    partitioned = cur.fetchone()[0]
+
+    if 'songplays_pkey' not in existing:
+        columns = 'songplay_id, start_time' if partitioned else 'songplay_id'
+        cur.execute(songplay_primary_key_add.format(columns=columns))
+        conn.commit()
+
+    for column, table in songplay_foreign_keys.items():
+        if partitioned:
+            if column not in existing:
+                cur.execute(songplay_foreign_key_add_partitioned.format(column=column, table=table))
+                conn.commit()
+            continue
+        if column not in existing:
+            cur.execute(songplay_foreign_key_add.format(column=column, table=table))
+            conn.commit()
+        cur.execute(songplay_foreign_key_validate.format(column=column))
+        conn.commit()
+
+
+def analyze(cur, conn):
+    """ Updates planner statistics for all tables after loading.
+
+    Parameters
+    ----------
+    cur : psycopg2.cursor
+        cursor for sparkifydb to manage transactions
+    conn : psycopg2.connection
+        connection to sparkifydb
+
+    Returns
+    -------
+    None
+    """
+    cur.execute(analyze_tables)
+    conn.commit()
+
+
+def main():
+    """ Builds indexes, adds constraints and analyzes tables after etl.py has loaded the data, reporting the time of each phase.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+
+    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    cur = conn.cursor()
+
+    for phase, func in [('Building indexes', build_indexes), ('Adding constraints', add_constraints), ('Analyzing tables', analyze)]:
+        time_start = time.time()
+        func(cur, conn)
+        print('{} completed in {:.2f} seconds.'.format(phase, time.time()-time_start))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+""" In-memory index to find song_id & artist_id for song plays without querying the database for each play."""
+
+import pandas as pd
+from sql_queries import song_index_select
+
+
+class SongIndex:
+    """ Lookup of song_id & artist_id keyed on song title, artist name and song duration.
+
+    Songs and artists are kept the same way the songs and artists tables keep them, where the first record
+    for a song_id or artist_id wins, so matching gives the same result as joining the two tables.
+
+    Attributes
+    ----------
+    songs : pandas.DataFrame
+        song_id, title, artist_id and duration for each known song
+    artists : pandas.DataFrame
+        artist_id and name for each known artist
+    """
+
+    def __init__(self):
+        self.songs = pd.DataFrame(columns=['song_id','title','artist_id','duration']).astype({'duration': float})
+        self.artists = pd.DataFrame(columns=['artist_id','name'])
+        self._index = None
+
+    def load(self, cur):
+        """ Loads songs and artists already stored in the database.
+
+        Parameters
+        ----------
+        cur : psycopg2.cursor
+            cursor for sparkifydb to manage transactions
+
+        Returns
+        -------
+        None
+        """
+
+        cur.execute(song_index_select)
+        found = pd.DataFrame(cur.fetchall(), columns=['song_id','title','artist_id','duration','name'])
+        self.add(found, found)
+
+    def add(self, songs, artists):
+        """ Adds songs and artists as they are inserted into the database.
+
+        Parameters
+        ----------
+        songs : pandas.DataFrame
+            records with the song_id, title, artist_id and duration columns
+        artists : pandas.DataFrame
+            records with the artist_id and name columns
+
+        Returns
+        -------
+        None
+        """
+
+        # ignore records already known, like ON CONFLICT DO NOTHING in the database
+        songs = songs[['song_id','title','artist_id','duration']].drop_duplicates('song_id')
+        songs = songs[~songs['song_id'].isin(self.songs['song_id'])]
+        artists = artists[['artist_id','name']].drop_duplicates('artist_id')
+        artists = artists[~artists['artist_id'].isin(self.artists['artist_id'])]
+
+        if len(songs) > 0:
+            self.songs = pd.concat([self.songs, songs], ignore_index=True)
+            self._index = None
+        if len(artists) > 0:
+            self.artists = pd.concat([self.artists, artists], ignore_index=True)
+            self._index = None
+
+    @property
+    def index(self):
+        """ pandas.DataFrame : one song_id & artist_id per title, name and duration, rebuilt after songs or artists are added."""
+
+        if self._index is None:
+            index = self.songs.merge(self.artists, on='artist_id', how='inner')
+            # take the first match for a key like song_select does
+            self._index = index.drop_duplicates(['title','name','duration'])[['title','name','duration','song_id','artist_id']]
+
+        return self._index
+
+    def match(self, log):
+        """ Finds the song_id & artist_id of each song play.
+
+        Parameters
+        ----------
+        log : pandas.DataFrame
+            song plays with the song, artist and length columns
+
+        Returns
+        -------
+        found : pandas.DataFrame
+            song_id & artist_id aligned to the index of log, None if a song play is not found
+        """
+
+        found = log[['song','artist','length']].merge(
+            self.index, left_on=['song','artist','length'], right_on=['title','name','duration'], how='left'
+        )
+        found = found[['song_id','artist_id']].astype(object)
+        found = found.where(found.notna(), None)
+        found.index = log.index
+
+        return found
+
+    def memory_usage(self):
+        """ Bytes of memory used by the songs, artists and key index.
+
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        usage : int
+            total bytes including the contents of string columns
+        """
+
+        frames = [self.songs, self.artists, self.index]
+        usage = sum(int(df.memory_usage(deep=True).sum()) for df in frames)
+
+        return usage
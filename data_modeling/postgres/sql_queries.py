@@ -7,6 +7,7 @@ user_table_drop = "DROP TABLE IF EXISTS dim_users"
 song_table_drop = "DROP TABLE IF EXISTS dim_songs"
 artist_table_drop = "DROP TABLE IF EXISTS dim_artists"
 time_table_drop = "DROP TABLE IF EXISTS dim_time"
+manifest_table_drop = "DROP TABLE IF EXISTS etl_manifest"
 
 # CREATE TABLES
 
@@ -30,6 +31,71 @@ CONSTRAINT start_time FOREIGN KEY (start_time) REFERENCES time(start_time)
 )
 """)
 
+## fact table: songplay for bulk loading
+## created without primary and foreign keys, which are added after loading by post_load.py
+songplay_table_create_unconstrained = ("""
+CREATE TABLE songplays(
+songplay_id SERIAL,
+start_time TIMESTAMP NOT NULL,
+user_id SMALLINT NOT NULL,
+level VARCHAR NOT NULL,
+song_id VARCHAR,
+artist_id VARCHAR,
+session_id SMALLINT NOT NULL,
+location VARCHAR NOT NULL, 
+user_agent VARCHAR NOT NULL
+)
+""")
+
+## fact table: songplay partitioned by start_time month, partitions are created as needed by etl.py
+## the primary key must include the partition column
+songplay_table_create_partitioned = ("""
+CREATE TABLE songplays(
+songplay_id SERIAL,
+start_time TIMESTAMP NOT NULL,
+user_id SMALLINT NOT NULL,
+level VARCHAR NOT NULL,
+song_id VARCHAR,
+artist_id VARCHAR,
+session_id SMALLINT NOT NULL,
+location VARCHAR NOT NULL, 
+user_agent VARCHAR NOT NULL,
+PRIMARY KEY (songplay_id, start_time),
+CONSTRAINT user_id FOREIGN KEY (user_id) REFERENCES users(user_id),
+CONSTRAINT song_id FOREIGN KEY (song_id) REFERENCES songs(song_id),
+CONSTRAINT artist_id FOREIGN KEY (artist_id) REFERENCES artists(artist_id),
+CONSTRAINT start_time FOREIGN KEY (start_time) REFERENCES time(start_time)
+) PARTITION BY RANGE (start_time)
+""")
+
+## fact table: songplay partitioned by start_time month for bulk loading, keys are added after loading by post_load.py
+songplay_table_create_partitioned_unconstrained = ("""
+CREATE TABLE songplays(
+songplay_id SERIAL,
+start_time TIMESTAMP NOT NULL,
+user_id SMALLINT NOT NULL,
+level VARCHAR NOT NULL,
+song_id VARCHAR,
+artist_id VARCHAR,
+session_id SMALLINT NOT NULL,
+location VARCHAR NOT NULL, 
+user_agent VARCHAR NOT NULL
+) PARTITION BY RANGE (start_time)
+""")
+
+## fact table: songplay partition for a single month
+songplay_partition_create = ("""
+CREATE TABLE IF NOT EXISTS songplays_{month:%Y_%m} PARTITION OF songplays
+FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month:%Y-%m-%d}')
+""")
+
+## fact table: songplay partitions removed for retention, detached concurrently first so queries on songplays only wait
+## for the brief SHARE UPDATE EXCLUSIVE lock instead of the ACCESS EXCLUSIVE lock of a plain detach or drop.
+## CONCURRENTLY needs PostgreSQL 14 and cannot run inside a transaction block, FINALIZE completes an interrupted detach
+songplay_partition_detach = "ALTER TABLE songplays DETACH PARTITION {partition} CONCURRENTLY"
+songplay_partition_detach_finalize = "ALTER TABLE songplays DETACH PARTITION {partition} FINALIZE"
+songplay_partition_drop = "DROP TABLE IF EXISTS {partition}"
+
 ## dimension table: users
 user_table_create = ("""
 CREATE TABLE users(
@@ -76,6 +142,18 @@ weekday SMALLINT NOT NULL
 )
 """)
 
+## etl bookkeeping: files already processed, used to only process new or changed files
+manifest_table_create = ("""
+CREATE TABLE etl_manifest(
+filepath VARCHAR PRIMARY KEY,
+size BIGINT NOT NULL,
+mtime DOUBLE PRECISION NOT NULL,
+sha256 VARCHAR(64) NOT NULL,
+row_counts JSON NOT NULL,
+processed_at TIMESTAMP NOT NULL DEFAULT NOW()
+)
+""")
+
 # INSERT RECORDS
 
 ## fact table: songplay
@@ -121,15 +199,223 @@ ON CONFLICT (start_time)
 DO NOTHING;
 """)
 
+# STAGING TABLES
+## session-local tables that bulk loads COPY into, emptied when the transaction of each file commits
+
+songplay_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songplays_staging(
+start_time TIMESTAMP,
+user_id SMALLINT,
+level VARCHAR,
+song VARCHAR,
+artist VARCHAR,
+length DOUBLE PRECISION,
+session_id SMALLINT,
+location VARCHAR,
+user_agent VARCHAR
+) ON COMMIT DELETE ROWS
+""")
+
+user_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS users_staging(
+user_id SMALLINT,
+first_name VARCHAR,
+last_name VARCHAR,
+gender VARCHAR,
+level VARCHAR
+) ON COMMIT DELETE ROWS
+""")
+
+song_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS songs_staging(
+song_id VARCHAR,
+title VARCHAR,
+artist_id VARCHAR,
+year SMALLINT,
+duration DOUBLE PRECISION
+) ON COMMIT DELETE ROWS
+""")
+
+artist_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS artists_staging(
+artist_id VARCHAR,
+name VARCHAR,
+location VARCHAR,
+latitude DOUBLE PRECISION,
+longitude DOUBLE PRECISION
+) ON COMMIT DELETE ROWS
+""")
+
+time_staging_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS time_staging(
+start_time TIMESTAMP,
+hour SMALLINT,
+day SMALLINT,
+week SMALLINT,
+month SMALLINT,
+year SMALLINT,
+weekday SMALLINT
+) ON COMMIT DELETE ROWS
+""")
+
+## empty staging tables when more than one batch is loaded in a transaction
+staging_table_truncate = "TRUNCATE users_staging, songs_staging, artists_staging, time_staging, songplays_staging"
+
+# MERGE STAGED RECORDS
+## set-based equivalents of the insert statements above using the same conflict rules
+
+## fact table: songplay
+### song_id and artist_id are found by title, artist name and duration, taking the first match like song_select
+songplay_table_merge = ("""
+INSERT INTO songplays
+(start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+SELECT staged.start_time, staged.user_id, staged.level, found.song_id, found.artist_id,
+staged.session_id, staged.location, staged.user_agent
+FROM songplays_staging AS staged
+LEFT JOIN LATERAL (
+    SELECT songs.song_id, artists.artist_id FROM songs
+    JOIN artists ON (songs.artist_id = artists.artist_id)
+    WHERE songs.title = staged.song AND artists.name = staged.artist AND songs.duration = staged.length
+    LIMIT 1
+) AS found ON TRUE
+""")
+
+## dimension table: users
+### staged users are unique so a single statement never updates the same user twice
+user_table_merge = ("""
+INSERT INTO users
+(user_id, first_name, last_name, gender, level)
+SELECT user_id, first_name, last_name, gender, level FROM users_staging
+ON CONFLICT (user_id) DO UPDATE SET level=EXCLUDED.level
+""")
+
+## dimension table: songs
+song_table_merge = ("""
+INSERT INTO songs
+(song_id, title, artist_id, year, duration)
+SELECT song_id, title, artist_id, year, duration FROM songs_staging
+ON CONFLICT (song_id)
+DO NOTHING;
+""")
+
+## dimension table: artists
+artist_table_merge = ("""
+INSERT INTO artists
+(artist_id, name, location, latitude, longitude)
+SELECT artist_id, name, location, latitude, longitude FROM artists_staging
+ON CONFLICT (artist_id)
+DO NOTHING;
+""")
+
+## dimension table: time
+time_table_merge = ("""
+INSERT INTO time
+(start_time, hour, day, week, month, year, weekday)
+SELECT start_time, hour, day, week, month, year, weekday FROM time_staging
+ON CONFLICT (start_time)
+DO NOTHING;
+""")
+
+## etl bookkeeping: record a processed file, replacing the record of a changed file
+manifest_upsert = ("""
+INSERT INTO etl_manifest
+(filepath, size, mtime, sha256, row_counts)
+VALUES (%s, %s, %s, %s, %s)
+ON CONFLICT (filepath) DO UPDATE SET
+size=EXCLUDED.size, mtime=EXCLUDED.mtime, sha256=EXCLUDED.sha256, row_counts=EXCLUDED.row_counts, processed_at=NOW()
+""")
+
 # FIND SONGS
 # # determine song_id and artist_id as logs only contains song & artist name
 song_select = ("""
 SELECT songs.song_id, artists.artist_id FROM songs 
-JOIN artists ON (songs.artist_id = songs.artist_id)
+JOIN artists ON (songs.artist_id = artists.artist_id)
 WHERE songs.title = %s AND artists.name = %s AND duration = %s
 """)
 
+# # all songs with artist names to find song_id and artist_id in memory using song_index.SongIndex
+song_index_select = ("""
+SELECT songs.song_id, songs.title, songs.artist_id, songs.duration, artists.name FROM songs
+JOIN artists ON (songs.artist_id = artists.artist_id)
+""")
+
+# # files already processed
+manifest_select = ("""
+SELECT filepath, size, mtime, sha256 FROM etl_manifest
+""")
+
+# # timestamps already in the time table to only emit new records using time_dimension.TimeDimension
+time_key_select = ("""
+SELECT start_time FROM time
+""")
+
+# POST-LOAD INDEXES AND CONSTRAINTS
+
+## find songs by title, artist name and duration
+song_title_index_create = "CREATE INDEX IF NOT EXISTS songs_title_duration_idx ON songs (title, duration)"
+artist_name_index_create = "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (name)"
+
+## song plays filtered by time range or user
+songplay_start_time_index_create = "CREATE INDEX IF NOT EXISTS songplays_start_time_idx ON songplays (start_time)"
+songplay_user_index_create = "CREATE INDEX IF NOT EXISTS songplays_user_id_idx ON songplays (user_id)"
+
+## fact table: songplay primary key, with the name given when created with songplay_table_create
+### a partitioned table also includes the partition column
+songplay_primary_key_add = "ALTER TABLE songplays ADD CONSTRAINT songplays_pkey PRIMARY KEY ({columns})"
+
+## fact table: songplay foreign keys, named the same as in songplay_table_create
+### added without checking existing rows, which are then checked without blocking writes
+songplay_foreign_key_add = "ALTER TABLE songplays ADD CONSTRAINT {column} FOREIGN KEY ({column}) REFERENCES {table}({column}) NOT VALID"
+songplay_foreign_key_validate = "ALTER TABLE songplays VALIDATE CONSTRAINT {column}"
+### NOT VALID is not supported for a partitioned table, so existing rows are checked when the key is added
+songplay_foreign_key_add_partitioned = "ALTER TABLE songplays ADD CONSTRAINT {column} FOREIGN KEY ({column}) REFERENCES {table}({column})"
+songplay_foreign_keys = {'user_id': 'users', 'song_id': 'songs', 'artist_id': 'artists', 'start_time': 'time'}
+
+## constraints already on the songplays table
+songplay_constraint_select = "SELECT conname FROM pg_constraint WHERE conrelid = 'songplays'::regclass"
+
+analyze_tables = "ANALYZE users, songs, artists, time, songplays"
+
+# # partitions of the songplays table, none if songplays is not partitioned
+songplay_partition_select = ("""
+SELECT child.relname FROM pg_inherits
+JOIN pg_class AS parent ON (pg_inherits.inhparent = parent.oid)
+JOIN pg_class AS child ON (pg_inherits.inhrelid = child.oid)
+WHERE parent.relname = 'songplays'
+""")
+
+# # whether the songplays table is partitioned
+songplay_partitioned_select = ("""
+SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'songplays'::regclass)
+""")
+
+# # hourly play counts over a time range, used to show partition pruning with EXPLAIN
+songplay_hourly_select = ("""
+SELECT DATE_TRUNC('hour', start_time) AS hour, COUNT(*) AS plays FROM songplays
+WHERE start_time >= %s AND start_time < %s
+GROUP BY 1 ORDER BY 1
+""")
+
+# # columns of a table in the order they were defined, used to profile each column
+column_select = ("""
+SELECT column_name, data_type FROM information_schema.columns
+WHERE table_schema = 'public' AND table_name = %s
+ORDER BY ordinal_position
+""")
+
+# # planner estimate of distinct values in each column of a table, available after the table is analyzed
+column_stats_select = ("""
+SELECT attname, n_distinct FROM pg_stats
+WHERE schemaname = 'public' AND tablename = %s
+""")
+
+# # gathers the planner statistics of a single table when it has not been analyzed yet
+table_analyze = 'ANALYZE "{table}"'
+
 # QUERY LISTS
 
-create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [user_table_drop, song_table_drop, artist_table_drop, time_table_drop, songplay_table_drop]
\ No newline at end of file
+create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create, manifest_table_create]
+create_table_queries_load_optimized = [user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create_unconstrained, manifest_table_create]
+drop_table_queries = [user_table_drop, song_table_drop, artist_table_drop, time_table_drop, songplay_table_drop, manifest_table_drop]
+staging_table_queries = [user_staging_create, song_staging_create, artist_staging_create, time_staging_create, songplay_staging_create]
+post_load_index_queries = [song_title_index_create, artist_name_index_create, songplay_start_time_index_create, songplay_user_index_create]
\ No newline at end of file
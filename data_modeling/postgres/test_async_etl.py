@@ -0,0 +1,23 @@
+import json
+import async_etl
+import metrics
+from conftest import TEST_DSN
+from etl import process_song_file, process_log_file
+from test_etl import load, table_contents
+
+
+def test_same_table_contents_as_etl(sparkifydb, sample_data, tmp_path, monkeypatch):
+    cur, conn = sparkifydb
+    inserted = load(cur, conn, sample_data, process_song_file, process_log_file)
+    monkeypatch.setattr(async_etl, 'DSN', TEST_DSN)
+
+    timings = async_etl.main(concurrency=2, workers=2, data_dir=sample_data, metrics_dir=str(tmp_path / 'metrics'))
+
+    assert table_contents(cur) == inserted
+    assert set(timings) == {'setup', 'song_data', 'log_data'}
+    # stages of the worker processes and connection threads are recorded in the run
+    stages = {(stage['stage'], stage['table']): stage for stage in metrics.current.report()['stages']}
+    assert stages[('parse', 'song_data')]['calls'] == 2
+    assert stages[('insert', 'users')]['rows_in'] == 4
+    with open(tmp_path / 'metrics' / 'postgres_async_etl.json', encoding='utf-8') as fh:
+        assert json.load(fh)['job'] == 'postgres_async_etl'
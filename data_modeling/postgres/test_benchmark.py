@@ -0,0 +1,48 @@
+import os
+import json
+import random
+import pytest
+import benchmark
+
+
+def test_scale_counts_fit_smallint_at_top_scale():
+    num_songs, num_users = benchmark.scale_counts(10_000_000)
+
+    assert num_songs == 1_000_000
+    assert num_users == benchmark.SMALLINT_MAX
+
+
+def test_scale_counts_rejects_users_beyond_smallint():
+    with pytest.raises(ValueError):
+        benchmark.scale_counts(1000, num_users=benchmark.SMALLINT_MAX + 1)
+
+
+def test_session_ids_wrap_within_smallint():
+    # 10M events start 200,000 sessions of 50 events
+    session_id = 0
+    seen = set()
+    for _ in range(10_000_000 // 50):
+        session_id = benchmark.next_session_id(session_id)
+        seen.add(session_id)
+
+    assert min(seen) == 1
+    assert max(seen) == benchmark.SMALLINT_MAX
+
+
+def test_generated_ids_in_smallint_range(tmp_path):
+    rng = random.Random(0)
+    songs = benchmark.generate_songs(str(tmp_path), 10, rng)
+    benchmark.generate_logs(str(tmp_path), 2000, 500, 20, songs, rng)
+
+    user_ids, session_ids = set(), set()
+    for root, _, files in os.walk(tmp_path / 'log_data'):
+        for name in files:
+            with open(os.path.join(root, name), encoding='utf-8') as fh:
+                for line in fh:
+                    event = json.loads(line)
+                    user_ids.add(int(event['userId']))
+                    session_ids.add(event['sessionId'])
+
+    assert len(session_ids) == 2000 // 50
+    assert 1 <= min(user_ids) and max(user_ids) <= 20
+    assert 1 <= min(session_ids) and max(session_ids) <= benchmark.SMALLINT_MAX
@@ -0,0 +1,74 @@
+import os
+from functools import partial
+import pytest
+import metrics
+from etl import (process_data, process_song_file, process_log_file, process_song_file_bulk, process_log_file_bulk,
+    process_log_file_streaming)
+from song_index import SongIndex
+
+TABLES = {
+    'songs': "SELECT song_id, title, artist_id, year, duration FROM songs ORDER BY song_id",
+    'artists': "SELECT artist_id, name, location, latitude, longitude FROM artists ORDER BY artist_id",
+    'users': "SELECT user_id, first_name, last_name, gender, level FROM users ORDER BY user_id",
+    'time': "SELECT start_time, hour, day, week, month, year, weekday FROM time ORDER BY start_time",
+    'songplays': """SELECT start_time, user_id, level, song_id, artist_id, session_id, location, user_agent FROM songplays
+        ORDER BY start_time, user_id""",
+}
+
+
+def table_contents(cur):
+    contents = {}
+    for table, query in TABLES.items():
+        cur.execute(query)
+        contents[table] = cur.fetchall()
+
+    return contents
+
+
+def load(cur, conn, data_dir, process_song, process_log):
+    metrics.start('test')
+    process_data(cur, conn, os.path.join(data_dir, 'song_data'), process_song)
+    process_data(cur, conn, os.path.join(data_dir, 'log_data'), process_log, reload_changed=False)
+    contents = table_contents(cur)
+    cur.execute("TRUNCATE songplays, users, songs, artists, time, etl_manifest RESTART IDENTITY")
+    conn.commit()
+
+    return contents
+
+
+@pytest.mark.parametrize('bulk', ['merge', 'song_index', 'streaming'])
+def test_bulk_load_keeps_the_same_records_as_inserts(sparkifydb, sample_data, bulk):
+    cur, conn = sparkifydb
+    inserted = load(cur, conn, sample_data, process_song_file, process_log_file)
+
+    if bulk == 'merge':
+        loaded = load(cur, conn, sample_data, process_song_file_bulk, process_log_file_bulk)
+    elif bulk == 'song_index':
+        song_index = SongIndex()
+        loaded = load(cur, conn, sample_data, partial(process_song_file_bulk, song_index=song_index),
+            partial(process_log_file_bulk, song_index=song_index))
+    else:
+        loaded = load(cur, conn, sample_data, process_song_file_bulk, partial(process_log_file_streaming, chunksize=2))
+
+    assert loaded == inserted
+
+
+def test_conflict_rules(sparkifydb, sample_data):
+    cur, conn = sparkifydb
+
+    metrics.start('test')
+    for filepath in ['song_data/A/TRA.json', 'song_data/B/TRB.json']:
+        process_song_file_bulk(cur, os.path.join(sample_data, filepath))
+    for filepath in ['log_data/2018-11-01-events.json', 'log_data/2018-11-02-events.json']:
+        process_log_file_bulk(cur, os.path.join(sample_data, filepath))
+    conn.commit()
+    contents = table_contents(cur)
+
+    # the first record of a song or artist is kept
+    assert [row[:2] for row in contents['songs']] == [('SOA', 'Alpha'), ('SOB', 'Beta')]
+    assert [row[:3] for row in contents['artists']] == [('ARA', 'Artist A', 'London'), ('ARB', 'Artist B', 'London')]
+    # the level of a user is updated to the last one seen, keeping the first name
+    assert [(row[0], row[1], row[4]) for row in contents['users']] == [(1, 'Ann', 'free'), (2, 'Bob', 'paid')]
+    # one time record per timestamp and one song play per NextSong event
+    assert len(contents['time']) == 3
+    assert [(row[1], row[3]) for row in contents['songplays']] == [(1, 'SOA'), (2, 'SOB'), (1, None), (1, 'SOB'), (2, 'SOA')]
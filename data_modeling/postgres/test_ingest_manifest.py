@@ -0,0 +1,63 @@
+import os
+import metrics
+from ingest_manifest import fingerprint, unprocessed_files
+
+
+class ManifestCursor:
+    """ Cursor returning recorded files for sql_queries.manifest_select."""
+
+    def __init__(self, recorded):
+        self.recorded = recorded
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return [(info['filepath'], info['size'], info['mtime'], info['sha256']) for info in self.recorded]
+
+
+def write(filepath, text, mtime=None):
+    filepath.write_text(text)
+    if mtime is not None:
+        os.utime(filepath, (mtime, mtime))
+
+    return str(filepath)
+
+
+def pending_files(recorded, all_files, reload_changed=True):
+    metrics.start('test')
+    return [info['filepath'] for info in unprocessed_files(ManifestCursor(recorded), all_files, reload_changed)]
+
+
+def test_skips_unchanged_and_touched_files(tmp_path):
+    unchanged = write(tmp_path / 'unchanged.json', '{"a": 1}\n', mtime=1000)
+    touched = write(tmp_path / 'touched.json', '{"a": 2}\n', mtime=1000)
+    recorded = [fingerprint(unchanged), fingerprint(touched)]
+    # same contents with a new modification time
+    os.utime(touched, (2000, 2000))
+    new = write(tmp_path / 'new.json', '{"a": 3}\n')
+
+    assert pending_files(recorded, [unchanged, touched, new]) == [new]
+
+
+def test_unchanged_files_are_not_read(tmp_path, monkeypatch):
+    unchanged = write(tmp_path / 'unchanged.json', '{"a": 1}\n', mtime=1000)
+    recorded = [fingerprint(unchanged)]
+    monkeypatch.setattr('ingest_manifest.file_hash', lambda filepath: 1 / 0)
+
+    assert pending_files(recorded, [unchanged]) == []
+
+
+def test_changed_files_are_reloaded_or_listed(tmp_path, capsys):
+    changed = write(tmp_path / 'changed.json', '{"a": 1}\n', mtime=1000)
+    recorded = [fingerprint(changed)]
+    write(tmp_path / 'changed.json', '{"a": 1}\n{"a": 2}\n', mtime=1000)
+    new = write(tmp_path / 'new.json', '{"a": 3}\n')
+
+    assert pending_files(recorded, [changed, new]) == [changed, new]
+    assert 'will be loaded again' in capsys.readouterr().out
+
+    assert pending_files(recorded, [changed, new], reload_changed=False) == [new]
+    out = capsys.readouterr().out
+    assert '1 files changed since they were processed and are skipped' in out
+    assert '  {}'.format(changed) in out
@@ -0,0 +1,52 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+
+def test_stage_counts_and_errors():
+    run = metrics.start('test')
+
+    with metrics.stage('copy', 'songs') as record:
+        record['rows_in'] += 3
+        record['rows_out'] += 2
+    try:
+        with metrics.stage('copy', 'songs'):
+            raise ValueError('failed')
+    except ValueError:
+        pass
+
+    counters = run.stages[('copy', 'songs')]
+    assert (counters['calls'], counters['rows_in'], counters['rows_out'], counters['errors']) == (2, 3, 2, 1)
+
+
+def test_stages_from_many_threads_are_all_counted():
+    run = metrics.start('test')
+
+    def load(number):
+        for _ in range(1000):
+            with metrics.stage('copy', 'songs') as record:
+                record['rows_in'] += 1
+            run.add('parse', 'songs', bytes_read=2)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(load, range(8)))
+
+    assert run.stages[('copy', 'songs')]['calls'] == 8000
+    assert run.stages[('copy', 'songs')]['rows_in'] == 8000
+    assert run.stages[('parse', 'songs')]['bytes_read'] == 16000
+
+
+def test_merge_and_write(tmp_path):
+    run = metrics.start('test')
+    worker = metrics.Metrics('worker')
+    with worker.stage('parse', 'log_data') as record:
+        record['rows_out'] += 5
+
+    run.merge(worker.stages)
+    run.merge(worker.stages)
+    report = run.write(str(tmp_path))
+
+    assert report['stages'][0]['rows_out'] == 10
+    assert json.loads((tmp_path / 'test.json').read_text())['job'] == 'test'
+    assert 'etl_stage_rows_out{job="test",stage="parse",table="log_data"} 10' in (tmp_path / 'test.prom').read_text()
@@ -0,0 +1,75 @@
+import pytest
+import metrics
+from conftest import song, event, write_records
+from etl import process_song_file, read_log_file
+from song_index import SongIndex
+from sql_queries import song_select
+
+SONGS = [
+    song('SOA1', 'Home', 'ARA', 'Artist A', 218.93179),
+    # same title by another artist and with another duration
+    song('SOB1', 'Home', 'ARB', 'Artist B', 218.93179),
+    song('SOA2', 'Home', 'ARA', 'Artist A', 180.0),
+    # repeated song_id where the first record is kept
+    song('SOA1', 'Home (live)', 'ARA', 'Artist A', 240.0),
+    # written as 0.30000000000000004, which pandas.read_json rounds to 0.3 in song and log files alike
+    song('SOC1', 'Short', 'ARC', 'Artist C', 0.1 + 0.2),
+]
+
+PLAYS = [
+    event(1541030400000, 1, 'free', 'Home', 'Artist A', 218.93179),
+    event(1541030401000, 1, 'free', 'Home', 'Artist B', 218.93179),
+    event(1541030402000, 1, 'free', 'Home', 'Artist A', 180.0),
+    event(1541030403000, 1, 'free', 'Home (live)', 'Artist A', 240.0),
+    event(1541030404000, 1, 'free', 'Short', 'Artist C', 0.3),
+    event(1541030405000, 1, 'free', 'Short', 'Artist C', 0.1 + 0.2),
+    # artist name not in the artists table
+    event(1541030406000, 1, 'free', 'Home', 'Nobody', 218.93179),
+    event(1541030407000, 1, 'free', 'Home', 'Artist A', 218.9318),
+]
+
+
+@pytest.fixture
+def loaded(sparkifydb, tmp_path):
+    cur, conn = sparkifydb
+    write_records(tmp_path / 'song_data' / 'songs.json', SONGS)
+    write_records(tmp_path / 'log_data' / 'events.json', PLAYS)
+
+    metrics.start('test')
+    song_index = SongIndex()
+    process_song_file(cur, str(tmp_path / 'song_data' / 'songs.json'), song_index)
+    # a song whose artist was never loaded is not found by either
+    cur.execute("INSERT INTO songs VALUES ('SOD1', 'Home', 'ARD', 2000, 218.93179)")
+    conn.commit()
+    log = read_log_file(str(tmp_path / 'log_data' / 'events.json'))
+
+    return cur, song_index, log
+
+
+def selected(cur, log):
+    found = []
+    for _, row in log.iterrows():
+        cur.execute(song_select, (row.song, row.artist, row.length))
+        found.append(cur.fetchone() or (None, None))
+
+    return found
+
+
+def matched(song_index, log):
+    return [tuple(row) for row in song_index.match(log)[['song_id','artist_id']].values]
+
+
+def test_match_finds_the_same_songs_as_song_select(loaded):
+    cur, song_index, log = loaded
+
+    assert matched(song_index, log) == selected(cur, log) == [
+        ('SOA1', 'ARA'), ('SOB1', 'ARB'), ('SOA2', 'ARA'), (None, None), ('SOC1', 'ARC'), ('SOC1', 'ARC'), (None, None),
+        (None, None)]
+
+
+def test_loaded_index_matches_like_the_added_index(loaded):
+    cur, song_index, log = loaded
+    reloaded = SongIndex()
+    reloaded.load(cur)
+
+    assert matched(reloaded, log) == matched(song_index, log)
@@ -0,0 +1,89 @@
+""" Builds records for the time table from song play timestamps.
+
+The calendar columns are defined once here so every load path of etl.py and async_etl.py computes identical values. week
+is the ISO 8601 week of the year and weekday counts from Monday = 0 to Sunday = 6. The Redshift time table of
+cloud_data_warehouses computes the same columns in SQL with time_columns in its sql_queries.py.
+"""
+
+import pandas as pd
+from sql_queries import time_key_select
+
+TIME_COLUMNS = ['start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday']
+
+
+def time_frame(t):
+    """ Breaks down song play timestamps into the columns of the time table in a single vectorized pass.
+
+    Parameters
+    ----------
+    t : pandas.Series
+        song play timestamps
+
+    Returns
+    -------
+    time_df : pandas.DataFrame
+        one record per timestamp in the column order of sql_queries.time_table_insert
+    """
+
+    time_df = pd.DataFrame({
+        'start_time': t,
+        'hour': t.dt.hour,
+        'day': t.dt.day,
+        'week': t.dt.isocalendar().week.astype('int64'),
+        'month': t.dt.month,
+        'year': t.dt.year,
+        'weekday': t.dt.weekday,
+    }, columns=TIME_COLUMNS)
+
+    return time_df
+
+
+class TimeDimension:
+    """ Emits time table records only for timestamps not already in the time table.
+
+    Attributes
+    ----------
+    known : set
+        nanoseconds since the epoch of each timestamp in the time table
+    """
+
+    def __init__(self):
+        self.known = set()
+
+    def load(self, cur):
+        """ Loads the timestamps already stored in the database.
+
+        Parameters
+        ----------
+        cur : psycopg2.cursor
+            cursor for sparkifydb to manage transactions
+
+        Returns
+        -------
+        None
+        """
+
+        cur.execute(time_key_select)
+        found = pd.to_datetime(pd.Series([row[0] for row in cur.fetchall()], dtype=object))
+        self.known.update(found.astype('int64'))
+
+    def new_rows(self, time_df):
+        """ Removes records of timestamps repeated within time_df or already known, then marks the rest as known.
+
+        Parameters
+        ----------
+        time_df : pandas.DataFrame
+            records from time_frame
+
+        Returns
+        -------
+        time_df : pandas.DataFrame
+            records with a start_time not yet in the time table
+        """
+
+        time_df = time_df.drop_duplicates('start_time')
+        keys = time_df['start_time'].astype('int64')
+        new = ~keys.isin(self.known)
+        self.known.update(keys[new])
+
+        return time_df[new]